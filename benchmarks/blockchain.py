@@ -0,0 +1,191 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+##########################
+# Block change benchmark #
+##########################
+
+# Usage (from the mpbm directory): python -m benchmarks.blockchain [options]
+
+
+
+import time
+import random
+from threading import RLock
+from optparse import OptionParser
+from core.util import Bunch
+from core.objectregistry import ObjectRegistry
+from core.workqueue import WorkQueue
+from core.blockchain import Blockchain
+from core.baseworksource import BaseWorkSource
+
+
+
+class BenchmarkCore(object):
+
+
+  def __init__(self):
+    self.settings = Bunch(name = "Benchmark core")
+    self.registry = ObjectRegistry(self)
+    self.blockchainlock = RLock()
+    self.workqueue = WorkQueue(self)
+
+
+  def get_blockchain_by_name(self, name):
+    return None
+
+
+  def event(self, *args, **kwargs):
+    pass
+
+
+  def log(self, *args, **kwargs):
+    pass
+
+
+
+class ReferenceBlockchain(Blockchain):
+  # The job list and prevhash history that Blockchain used to keep, to measure the gain
+
+  def _reset(self):
+    super(ReferenceBlockchain, self)._reset()
+    self.knownprevhashes = []
+    self.timeoutend = 0
+    self.jobs = []
+
+
+  def add_job(self, job):
+    if not job in self.jobs: self.jobs.append(job)
+
+
+  def remove_job(self, job):
+    while job in self.jobs: self.jobs.remove(job)
+
+
+  def check_job(self, job):
+    if self.currentprevhash == job.prevhash: return True
+    cancel = []
+    with self.blocklock:
+      now = time.time()
+      timeout_expired = now > self.timeoutend
+      self.timeoutend = now + self.settings.timeout
+      if job.prevhash in self.knownprevhashes: return False
+      if timeout_expired: self.knownprevhashes = [self.currentprevhash]
+      else: self.knownprevhashes.append(self.currentprevhash)
+      self.currentprevhash = job.prevhash
+      with self.core.workqueue.get_shard(self).lock:
+        while self.jobs:
+          job = self.jobs.pop(0)
+          if job.worker: cancel.append(job)
+          else: job.destroy()
+      self.jobs = []
+    self.core.workqueue.cancel_jobs(cancel, callback = self._cancel_done)
+    return True
+
+
+
+class ReferenceWorkSource(BaseWorkSource):
+
+  def _reset(self):
+    super(ReferenceWorkSource, self)._reset()
+    self.jobs = []
+
+
+  def add_job(self, job):
+    if not job in self.jobs: self.jobs.append(job)
+
+
+  def remove_job(self, job):
+    while job in self.jobs: self.jobs.remove(job)
+
+
+
+class BenchmarkJob(object):
+  # Registers and destroys itself like core.job.Job does
+
+
+  def __init__(self, core, worksource, blockchain, prevhash):
+    self.core = core
+    self.worksource = worksource
+    self.blockchain = blockchain
+    self.prevhash = prevhash
+    self.expiry = time.time() + 60
+    self.worker = None
+
+
+  def register(self):
+    self.worksource.add_job(self)
+    self.blockchain.add_job(self)
+
+
+  def destroy(self):
+    self.worksource.remove_job(self)
+    self.blockchain.remove_job(self)
+    self.core.workqueue.remove_job(self)
+
+
+
+def block_changes(core, blockchain, worksources, blocks, count, busy):
+  # Returns the time spent registering jobs, switching blocks with count live jobs
+  # (including destroying the jobs that workers were busy with afterwards) and
+  # rejecting stale work for the previous block.
+  rng = random.Random(0)
+  registering = switching = rejecting = 0
+  for block in range(blocks):
+    prevhash = b"%032d" % block
+    jobs = [BenchmarkJob(core, rng.choice(worksources), blockchain, prevhash) for i in range(count)]
+    start = time.time()
+    for job in jobs: job.register()
+    registering += time.time() - start
+    for job in rng.sample(jobs, busy): job.worker = True
+    start = time.time()
+    blockchain.check_job(BenchmarkJob(core, worksources[0], blockchain, b"%032d" % (block + 1)))
+    if busy:
+      for job in core.workqueue.cancelqueue.get()[0]: job.destroy()
+    switching += time.time() - start
+    start = time.time()
+    for job in jobs[:busy]: blockchain.check_job(job)
+    rejecting += time.time() - start
+  return registering, switching, rejecting
+
+
+def main():
+  parser = OptionParser("Usage: python -m benchmarks.blockchain [options]")
+  parser.add_option("--jobs", "-n", action = "store", type = "int", default = 5000, help = "Number of live jobs when the block changes")
+  parser.add_option("--busy", action = "store", type = "int", default = 500, help = "Number of those that workers are busy with")
+  parser.add_option("--worksources", "-w", action = "store", type = "int", default = 4, help = "Number of work sources the jobs are spread across")
+  parser.add_option("--blocks", "-b", action = "store", type = "int", default = 5, help = "Number of block changes")
+  (options, args) = parser.parse_args()
+  results = []
+  for name, blockchainclass, worksourceclass in (("reference lists", ReferenceBlockchain, ReferenceWorkSource),
+                                                 ("ordered dicts", Blockchain, BaseWorkSource)):
+    core = BenchmarkCore()
+    blockchain = blockchainclass(core)
+    worksources = [worksourceclass(core) for i in range(options.worksources)]
+    result = block_changes(core, blockchain, worksources, options.blocks, options.jobs, options.busy)
+    results.append(result)
+    print("%-16s register %8.2f ms, block change %8.2f ms, %d stale jobs %7.2f ms" %
+          ((name,) + tuple(1000 * elapsed / options.blocks for elapsed in result[:2]) + (options.busy, 1000 * result[2] / options.blocks)))
+  print("Block change speedup at %d live jobs: %.1fx" % (options.jobs, results[0][1] / results[1][1]))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,272 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+#############################
+# Getwork load test harness #
+#############################
+
+# Usage (from the mpbm directory): python -m benchmarks.loadtest [options]
+
+# Drives a complete MPBM core with simulated workers against the local pool emulator
+# (or any other getwork or stratum pool, or a bitcoin node) and reports fetch and upload performance.
+
+
+
+import sys
+import time
+from datetime import datetime
+from optparse import OptionParser
+from threading import RLock
+from core.core import Core
+from core.blockchain import Blockchain
+from core.basefrontend import BaseFrontend
+from core.util import Bunch
+from benchmarks.poolemulator import PoolEmulator
+from benchmarks.stratumemulator import StratumEmulator
+from benchmarks.nodeemulator import NodeEmulator
+
+
+
+class LoadTestProbe(BaseFrontend):
+  # Collects timing information from the core's event stream and prints important log messages
+
+  version = "benchmarks.loadtest probe"
+  default_name = "Load test probe"
+  can_log = True
+  can_handle_events = True
+
+
+  def __init__(self, core, state = None):
+    super(LoadTestProbe, self).__init__(core, state)
+    self.lock = RLock()
+    # The core echoes messages to the console itself until it is started, don't print those twice
+    self.since = datetime.max
+    self.fetchlatencies = []
+    self.sharelatencies = []
+    self.pendingshares = {}
+    self.counters = dict(registerjob = 0, acquirejob = 0, canceljob = 0, noncefound = 0,
+                         nonceaccepted = 0, noncerejected = 0, stale = 0)
+
+
+  def write_log_message(self, source, timestamp, loglevel, messages):
+    if loglevel > self.core.default_loglevel or timestamp < self.since: return
+    prefix = "%s [%3d] %s: " % (timestamp.strftime("%Y-%m-%d %H:%M:%S.%f"), loglevel, source.settings.name)
+    for message, format in messages:
+      for line in message.splitlines(True): self.core.stderr.write(prefix + line)
+
+
+  def handle_stats_event(self, level, source, event, arg, message, worker, worksource, blockchain, job, timestamp):
+    with self.lock:
+      # Job templates are registered once for all of the jobs that they stand for
+      if event == "registerjob": self.counters[event] += arg or 1
+      elif event in self.counters: self.counters[event] += 1
+      if event == "fetchlatency": self.fetchlatencies.append(arg / 1000.)
+      elif event == "noncefound": self.pendingshares[(job, arg)] = timestamp
+      elif event in ("nonceaccepted", "noncerejected"):
+        if event == "noncerejected" and message == "stale": self.counters["stale"] += 1
+        start = self.pendingshares.pop((job, arg), None)
+        if start: self.sharelatencies.append((timestamp - start).total_seconds())
+
+
+
+def describe(values):
+  if not values: return "no samples"
+  values = sorted(values)
+  percentile = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+  return "n=%d  avg %.1f ms  p50 %.1f ms  p90 %.1f ms  p99 %.1f ms  max %.1f ms" % \
+         (len(values), 1000. * sum(values) / len(values), 1000 * percentile(0.5), 1000 * percentile(0.9),
+          1000 * percentile(0.99), 1000 * values[-1])
+
+
+def main():
+  parser = OptionParser("Usage: python -m benchmarks.loadtest [options]")
+  parser.add_option("--workers", "-w", action = "store", type = "int", default = 100, help = "Number of simulated workers")
+  parser.add_option("--hashrate", action = "store", type = "float", default = 1000, help = "Hash rate per worker in MH/s")
+  parser.add_option("--paralleljobs", action = "store", type = "int", default = 1, help = "Parallel jobs per worker")
+  parser.add_option("--jobinterval", action = "store", type = "float", default = 60, help = "Worker job interval")
+  parser.add_option("--duration", "-t", action = "store", type = "float", default = 60, help = "Test duration in seconds")
+  parser.add_option("--controller", action = "store", type = "choice", choices = ["legacy", "predictive"],
+                    default = "legacy", help = "Work fetcher controller")
+  parser.add_option("--getworkconnections", action = "store", type = "int", default = 1, help = "Job fetching connections")
+  parser.add_option("--uploadconnections", action = "store", type = "int", default = 1, help = "Share upload connections")
+  parser.add_option("--batchsize", action = "store", type = "int", default = 4,
+                    help = "Maximum getwork requests per round trip")
+  parser.add_option("--uploadbatchsize", action = "store", type = "int", default = 16,
+                    help = "Maximum shares per upload request")
+  parser.add_option("--spool", action = "store_true", default = False, help = "Spool shares to disk (in config/spool)")
+  parser.add_option("--transport", action = "store", type = "choice", choices = ["threads", "eventloop"],
+                    default = "threads", help = "Work source transport")
+  parser.add_option("--protocol", action = "store", type = "choice", choices = ["getwork", "stratum", "gbt"],
+                    default = "getwork", help = "Pool protocol")
+  parser.add_option("--pool", action = "store", default = None,
+                    help = "Use an external pool (host:port) instead of starting the emulator")
+  parser.add_option("--blockinterval", "-b", action = "store", type = "float", default = 30,
+                    help = "Emulator: average time between block changes")
+  parser.add_option("--difficulty", "-d", action = "store", type = "float", default = 1, help = "Emulator: share difficulty")
+  parser.add_option("--rollntime", action = "store", type = "int", default = 0, help = "Emulator: X-Roll-NTime expiry")
+  parser.add_option("--no-longpoll", action = "store_true", default = False, help = "Emulator: don't offer long polling")
+  parser.add_option("--p2pool", action = "store_true", default = False, help = "Emulator: pretend to be p2pool")
+  parser.add_option("--latency", "-l", action = "store", type = "float", default = 0, help = "Emulator: getwork delay")
+  parser.add_option("--seed", action = "store", type = "int", default = 0, help = "Emulator: block timing seed")
+  parser.add_option("--no-batch", action = "store_true", default = False, help = "Emulator: reject batched requests")
+  parser.add_option("--transactions", action = "store", type = "int", default = 500,
+                    help = "Emulator: mempool transactions per block (gbt)")
+  parser.add_option("--txinterval", action = "store", type = "float", default = 5,
+                    help = "Emulator: time between new transactions (gbt)")
+  parser.add_option("--loglevel", action = "store", type = "int", default = 100, help = "Core log level")
+  (options, args) = parser.parse_args()
+
+  pool = None
+  if options.pool:
+    host, port = options.pool.rsplit(":", 1)
+    port = int(port)
+  elif options.protocol == "stratum":
+    pool = StratumEmulator("127.0.0.1", 0, options.blockinterval, options.difficulty, False, options.seed)
+    pool.start()
+    host, port = pool.host, pool.port
+  elif options.protocol == "gbt":
+    pool = NodeEmulator("127.0.0.1", 0, options.blockinterval, options.difficulty, options.transactions,
+                        options.txinterval, False, options.seed)
+    pool.start()
+    host, port = pool.host, pool.port
+  else:
+    pool = PoolEmulator("127.0.0.1", 0, options.blockinterval, options.difficulty, options.rollntime,
+                        not options.no_longpoll, options.p2pool, options.latency, False, options.seed,
+                        not options.no_batch)
+    pool.start()
+    host, port = pool.host, pool.port
+
+  # The core redirects stdout into its logging system, so keep a handle on the real one
+  output = sys.stdout
+  core = Core(instance = "loadtest", default_loglevel = options.loglevel)
+  # Don't leave a configuration file for this throwaway instance behind
+  core.save = lambda: None
+  from modules.theseven.bcjsonrpc.bcjsonrpcworksource import BCJSONRPCWorkSource
+  from modules.theseven.stratum.stratumworksource import StratumWorkSource
+  from modules.theseven.gbt.gbtworksource import GBTWorkSource
+  from modules.theseven.simulated.simulatedworker import SimulatedWorker
+  blockchain = Blockchain(core)
+  blockchain.settings.name = "Load test"
+  core.add_blockchain(blockchain)
+  if options.protocol == "stratum": worksource = StratumWorkSource(core)
+  elif options.protocol == "gbt":
+    worksource = GBTWorkSource(core)
+    worksource.settings.payoutaddress = "1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh"
+  else:
+    worksource = BCJSONRPCWorkSource(core)
+    worksource.settings.getworkconnections = options.getworkconnections
+    worksource.settings.uploadconnections = options.uploadconnections
+    worksource.settings.transport = options.transport
+    worksource.settings.getworkbatchsize = options.batchsize
+    worksource.settings.uploadbatchsize = options.uploadbatchsize
+  worksource.set_blockchain(blockchain)
+  worksource.settings.name = "Load test pool"
+  worksource.settings.host = host
+  worksource.settings.port = port
+  worksource.settings.sharespool = options.spool
+  worksource.apply_settings()
+  core.get_root_work_source().add_work_source(worksource)
+  for i in range(options.workers):
+    worker = SimulatedWorker(core)
+    worker.settings.name = "Simulated worker %d" % i
+    worker.settings.hashrate = options.hashrate
+    worker.settings.paralleljobs = options.paralleljobs
+    worker.settings.jobinterval = options.jobinterval
+    worker.apply_settings()
+    core.add_worker(worker)
+  probe = LoadTestProbe(core)
+  core.add_frontend(probe)
+  core.fetcher.settings.controller = options.controller
+  core.fetcher.apply_settings()
+
+  starttime = time.time()
+  core.start()
+  probe.since = datetime.now()
+  try:
+    while time.time() < starttime + options.duration: time.sleep(min(1, starttime + options.duration - time.time()))
+  except KeyboardInterrupt: pass
+  elapsed = time.time() - starttime
+  fetcherstats = core.get_fetcher_statistics()
+  worksourcestats = worksource.get_statistics()
+  httppoolstats = core.get_httppool_statistics()
+  corestats = core.get_core_statistics()
+  workerghashes = core.get_worker_statistics().calculatefieldsum("ghashes")
+  # Don't count what happens while shutting down
+  with probe.lock:
+    counters = dict(probe.counters)
+    fetchlatencies = list(probe.fetchlatencies)
+    sharelatencies = list(probe.sharelatencies)
+  if pool:
+    with pool.lock:
+      poolstats = Bunch(**pool.stats)
+      servicetimes = list(getattr(pool, "servicetimes", []))
+  core.stop()
+  if pool: pool.stop()
+
+  submitted = counters["nonceaccepted"] + counters["noncerejected"]
+  output.write("Duration:               %.1f s, %d workers at %.1f MH/s\n" % (elapsed, options.workers, options.hashrate))
+  output.write("Fetch latency:          %s\n" % describe(fetchlatencies))
+  output.write("Share submit latency:   %s\n" % describe(sharelatencies))
+  if "sharelatency_p50" in worksourcestats:
+    percentiles = []
+    for percentile in (50, 90, 99):
+      value = worksourcestats["sharelatency_p%d" % percentile]
+      percentiles.append("p%d %s" % (percentile, "n/a" if value == None else "%.1f ms" % (1000 * value)))
+    output.write("Work source submit:     %s\n" % ", ".join(percentiles))
+  output.write("Jobs fetched:           %d (%.1f/s)\n" % (counters["registerjob"], counters["registerjob"] / elapsed))
+  if "roundtripssaved" in worksourcestats:
+    output.write("Round trips saved:      %d (batching %s)\n" % (worksourcestats.roundtripssaved,
+          {None: "unused", True: "supported", False: "unsupported"}[worksourcestats.supports_batch]))
+  if "jobsminted" in worksourcestats:
+    if "notifications" in worksourcestats:
+      output.write("Jobs minted locally:    %d from %d notifications\n" % (worksourcestats.jobsminted, worksourcestats.notifications))
+    else:
+      output.write("Jobs minted locally:    %d from %d templates, %d merkle nodes hashed, %d reused\n" %
+            (worksourcestats.jobsminted, worksourcestats.templates, worksourcestats.merklenodeshashed,
+             worksourcestats.merklenodesreused))
+  if httppoolstats.created:
+    output.write("HTTP connections:       %d opened, %d reused (%.1f%%), %d evicted, %d unhealthy, %d failed, %d DNS lookups\n" %
+          (httppoolstats.created, httppoolstats.reused, 100 * httppoolstats.reuseratio, httppoolstats.evicted,
+           httppoolstats.unhealthy, httppoolstats.failed, httppoolstats.dnslookups))
+  output.write("Jobs started:           %d (%.1f/s)\n" % (counters["acquirejob"], counters["acquirejob"] / elapsed))
+  output.write("Hashes calculated:      %.1f GH (%.1f MH/s), workers report %.1f GH\n" %
+               (corestats.ghashes, corestats.avgmhps, workerghashes))
+  output.write("Jobs discarded unused:  %d\n" % fetcherstats.jobsdiscarded)
+  output.write("Worker idle time:       %.1f s total, %d starvations\n" % (fetcherstats.idletime, fetcherstats.starvations))
+  output.write("Shares found:           %d (%.2f/s)\n" % (counters["noncefound"], counters["noncefound"] / elapsed))
+  output.write("Shares submitted:       %d, %d rejected, stale rate %.2f%%\n" %
+        (submitted, counters["noncerejected"], 100. * counters["stale"] / max(1, submitted)))
+  if options.protocol == "stratum" and pool:
+    output.write("Pool: %d connections, %d notifications, %d blocks, %d accepted, %d stale, %d duplicate, %d invalid\n" %
+          (poolstats.connections, poolstats.notifies, poolstats.blocks, poolstats.accepted, poolstats.stale,
+           poolstats.duplicate, poolstats.invalid))
+  elif options.protocol == "gbt" and pool:
+    output.write("Node: %d templates, %d long polls, %d blocks, %d transactions, %d accepted, %d stale, %d duplicate, %d invalid\n" %
+          (poolstats.templates, poolstats.longpolls, poolstats.blocks, poolstats.transactions, poolstats.accepted,
+           poolstats.stale, poolstats.duplicate, poolstats.invalid))
+  elif pool:
+    output.write("Pool: %d getworks in %d batches (server side %s), %d share batches, %d long polls, %d blocks, %d accepted, %d stale, %d duplicate\n" %
+          (poolstats.getworks, poolstats.batches, describe(servicetimes), poolstats.submitbatches, poolstats.longpolls, poolstats.blocks,
+           poolstats.accepted, poolstats.stale, poolstats.duplicate))
+
+if __name__ == "__main__":
+  main()
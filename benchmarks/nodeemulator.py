@@ -0,0 +1,306 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+##########################################
+# Getblocktemplate bitcoin node emulator #
+##########################################
+
+# Usage (from the mpbm directory): python -m benchmarks.nodeemulator [options]
+
+# A minimal local stand-in for a bitcoin node: getblocktemplate (with BIP22 long polling)
+# and submitblock over JSON-RPC. The mempool is filled with random fake transactions, and
+# a new one arrives every few seconds, which changes the template like it would on a real
+# node. Blocks change at random intervals from a seeded generator. Submitted blocks are
+# only checked for staleness and duplicates unless verification is enabled, so that
+# simulated workers can be pointed at it. Verified blocks that meet the target extend
+# the chain.
+
+
+
+import os
+import sys
+import time
+import json
+import random
+import struct
+from hashlib import sha256
+from binascii import hexlify, unhexlify
+from optparse import OptionParser
+from threading import Condition, Thread
+from core.util import Bunch
+from benchmarks.poolemulator import PoolEmulator
+try: from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError: from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+try: from socketserver import ThreadingMixIn
+except ImportError: from SocketServer import ThreadingMixIn
+
+
+
+def dsha256(data):
+  return sha256(sha256(data).digest()).digest()
+
+
+
+class NodeEmulator(object):
+
+
+  def __init__(self, host = "127.0.0.1", port = 0, blockinterval = 600, difficulty = 1, transactions = 500,
+               txinterval = 5, verify = False, seed = 0, witness = True):
+    self.blockinterval = blockinterval
+    self.transactioncount = transactions
+    self.txinterval = txinterval
+    self.verify = verify
+    self.witness = witness
+    self.random = random.Random(seed)
+    self.target = PoolEmulator.difficulty_to_target(difficulty)
+    self.bits = NodeEmulator.target_to_bits(self.target)
+    self.lock = Condition()
+    self.shutdown = False
+    self.height = 100000
+    self.prevhash = None
+    self.generation = 0
+    self.transactions = []
+    self.submitted = set()
+    self.stats = Bunch(templates = 0, longpolls = 0, blocks = 0, transactions = 0, accepted = 0, stale = 0,
+                       duplicate = 0, invalid = 0)
+    with self.lock: self._new_block(os.urandom(32))
+    self.server = _Server((host, port), _RequestHandler)
+    self.server.node = self
+    self.host, self.port = self.server.server_address[:2]
+    self.serverthread = Thread(None, self.server.serve_forever, "nodeemulator_server")
+    self.serverthread.daemon = True
+    self.eventthread = Thread(None, self._eventloop, "nodeemulator_events")
+    self.eventthread.daemon = True
+
+
+  @staticmethod
+  def target_to_bits(target):
+    # Compact representation of a little endian 256 bit target
+    value = int(hexlify(target[::-1]), 16)
+    size = (value.bit_length() + 7) // 8
+    if size <= 3: mantissa = value << (8 * (3 - size))
+    else: mantissa = value >> (8 * (size - 3))
+    if mantissa & 0x800000:
+      mantissa >>= 8
+      size += 1
+    return struct.pack(">I", (size << 24) | mantissa)
+
+
+  def start(self):
+    self.serverthread.start()
+    self.eventthread.start()
+
+
+  def stop(self):
+    with self.lock:
+      self.shutdown = True
+      self.lock.notify_all()
+    self.server.shutdown()
+    self.server.server_close()
+
+
+  def _new_block(self, hash):
+    # Called with the lock held. The mempool is replaced, as if it had all been mined.
+    self.height += 1
+    self.prevhash = hash
+    self.transactions = []
+    for i in range(self.transactioncount): self._add_transaction()
+    self.submitted = set()
+
+
+  def _add_transaction(self):
+    # Called with the lock held. The contents are random, only the size resembles a real transaction.
+    data = os.urandom(self.random.randint(200, 600))
+    self.transactions.append(Bunch(data = data, txid = dsha256(data)))
+    self.generation += 1
+    self.lock.notify_all()
+
+
+  def _eventloop(self):
+    with self.lock:
+      nextblock = time.time() + self.random.expovariate(1. / self.blockinterval)
+      nexttx = time.time() + self.txinterval
+      while not self.shutdown:
+        self.lock.wait(max(0, min(nextblock, nexttx) - time.time()))
+        if self.shutdown: return
+        now = time.time()
+        if now >= nextblock:
+          self._new_block(os.urandom(32))
+          self.stats.blocks += 1
+          nextblock = now + self.random.expovariate(1. / self.blockinterval)
+        if now >= nexttx:
+          self._add_transaction()
+          self.stats.transactions += 1
+          nexttx = now + self.txinterval
+
+
+  def _longpollid(self):
+    return "%s%d" % (hexlify(self.prevhash[::-1]).decode("ascii"), self.generation)
+
+
+  def get_template(self, request = {}):
+    # Blocks until the template changed if the request carries the current long poll id
+    with self.lock:
+      longpollid = request.get("longpollid")
+      if longpollid is not None:
+        self.stats.longpolls += 1
+        while longpollid == self._longpollid() and not self.shutdown: self.lock.wait(1)
+      self.stats.templates += 1
+      template = {
+        "version": 0x20000000,
+        "previousblockhash": hexlify(self.prevhash[::-1]).decode("ascii"),
+        "transactions": [{"data": hexlify(tx.data).decode("ascii"), "txid": hexlify(tx.txid[::-1]).decode("ascii"),
+                          "hash": hexlify(tx.txid[::-1]).decode("ascii"), "depends": [], "fee": 1000, "sigops": 0,
+                          "weight": 4 * len(tx.data)} for tx in self.transactions],
+        "coinbasevalue": 625000000 + 1000 * len(self.transactions),
+        "longpollid": self._longpollid(),
+        "target": hexlify(self.target[::-1]).decode("ascii"),
+        "mintime": int(time.time()) - 3600,
+        "mutable": ["time", "transactions", "prevblock"],
+        "noncerange": "00000000ffffffff",
+        "curtime": int(time.time()),
+        "bits": hexlify(self.bits).decode("ascii"),
+        "height": self.height,
+      }
+      if self.witness: template["default_witness_commitment"] = "6a24aa21a9ed" + hexlify(os.urandom(32)).decode("ascii")
+    return template
+
+
+  def submit_block(self, block):
+    # Returns None if the block was accepted, or a BIP22 reject reason otherwise
+    header = block[:80]
+    with self.lock:
+      if header[4:36] != self.prevhash:
+        self.stats.stale += 1
+        return "stale-prevblk"
+      transactions = list(self.transactions)
+    if self.verify:
+      reason = self._verify_block(block, transactions)
+      if reason:
+        with self.lock: self.stats.invalid += 1
+        return reason
+    with self.lock:
+      if header in self.submitted:
+        self.stats.duplicate += 1
+        return "duplicate"
+      self.submitted.add(header)
+      self.stats.accepted += 1
+      if self.verify:
+        self._new_block(dsha256(header))
+        self.stats.blocks += 1
+    return None
+
+
+  def _verify_block(self, block, transactions):
+    # The transaction list only ever grows between blocks, so the block must contain a prefix of it
+    if len(block) < 81: return "bad-blk-length"
+    count = struct.unpack("B", block[80:81])[0]
+    offset = 81
+    if count == 0xfd:
+      count = struct.unpack("<H", block[81:83])[0]
+      offset = 83
+    if count < 1 or count - 1 > len(transactions): return "bad-txns"
+    included = transactions[:count - 1]
+    tail = b"".join(tx.data for tx in included)
+    if block[len(block) - len(tail):] != tail: return "bad-txns"
+    coinbase = block[offset:len(block) - len(tail)]
+    if coinbase[4:6] == b"\0\1":
+      # Strip the segwit marker and the witness reserved value to get the transaction id
+      coinbase = coinbase[:4] + coinbase[6:-38] + coinbase[-4:]
+    hashes = [dsha256(coinbase)] + [tx.txid for tx in included]
+    while len(hashes) > 1:
+      if len(hashes) % 2: hashes.append(hashes[-1])
+      hashes = [dsha256(hashes[i] + hashes[i + 1]) for i in range(0, len(hashes), 2)]
+    if hashes[0] != block[36:68]: return "bad-txnmrklroot"
+    hash = dsha256(block[:80])
+    if hash[::-1] > self.target[::-1]: return "high-hash"
+    return None
+
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+  protocol_version = "HTTP/1.1"
+  # Headers and body are written separately, don't let Nagle's algorithm delay the body
+  disable_nagle_algorithm = True
+
+
+  def log_message(self, format, *args):
+    pass
+
+
+  def _respond(self, result, error = None, id = 0):
+    body = json.dumps({"result": result, "error": error, "id": id}).encode("utf_8")
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+  def do_POST(self):
+    node = self.server.node
+    request = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf_8"))
+    id = request.get("id")
+    method = request.get("method")
+    params = request.get("params", [])
+    if method == "getblocktemplate": self._respond(node.get_template(params[0] if params else {}), None, id)
+    elif method == "submitblock": self._respond(node.submit_block(unhexlify(params[0].encode("ascii"))), None, id)
+    else: self._respond(None, {"code": -32601, "message": "Method not found"}, id)
+
+
+
+def main():
+  parser = OptionParser("Usage: python -m benchmarks.nodeemulator [options]")
+  parser.add_option("--host", action = "store", default = "127.0.0.1", help = "Address to listen on")
+  parser.add_option("--port", "-p", action = "store", type = "int", default = 8332, help = "Port to listen on")
+  parser.add_option("--blockinterval", "-b", action = "store", type = "float", default = 600,
+                    help = "Average time between block changes in seconds")
+  parser.add_option("--difficulty", "-d", action = "store", type = "float", default = 1, help = "Block difficulty")
+  parser.add_option("--transactions", action = "store", type = "int", default = 500,
+                    help = "Mempool transactions at the start of each block")
+  parser.add_option("--txinterval", action = "store", type = "float", default = 5,
+                    help = "Time between new transactions in seconds")
+  parser.add_option("--no-witness", action = "store_true", default = False, help = "Don't send a witness commitment")
+  parser.add_option("--verify", action = "store_true", default = False, help = "Verify submitted blocks")
+  parser.add_option("--seed", action = "store", type = "int", default = 0, help = "Seed for block change timing")
+  (options, args) = parser.parse_args()
+  node = NodeEmulator(options.host, options.port, options.blockinterval, options.difficulty, options.transactions,
+                      options.txinterval, options.verify, options.seed, not options.no_witness)
+  node.start()
+  sys.stderr.write("Node emulator listening on %s:%d\n" % (node.host, node.port))
+  try:
+    while True:
+      time.sleep(10)
+      with node.lock: sys.stderr.write("%r\n" % node.stats)
+  except KeyboardInterrupt: node.stop()
+
+if __name__ == "__main__":
+  main()
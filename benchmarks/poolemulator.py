@@ -0,0 +1,291 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+#########################
+# Getwork pool emulator #
+#########################
+
+# Usage (from the mpbm directory): python -m benchmarks.poolemulator [options]
+
+# A minimal local stand-in for a getwork pool, speaking the protocol dialect that
+# the BCJSONRPC work source implements: long polling, X-Roll-NTime, X-Reject-Reason
+# and the p2pool headers. Blocks change at random intervals from a seeded generator.
+# Shares are only checked for staleness and duplicates unless verification is enabled,
+# so that simulated workers can be pointed at it.
+
+
+
+import os
+import sys
+import time
+import json
+import random
+import struct
+import socket
+from binascii import hexlify, unhexlify
+from optparse import OptionParser
+from threading import Condition, Thread
+from core.job import Job
+from core.util import Bunch
+try: from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError: from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+try: from socketserver import ThreadingMixIn
+except ImportError: from SocketServer import ThreadingMixIn
+
+
+
+class PoolEmulator(object):
+
+
+  def __init__(self, host = "127.0.0.1", port = 0, blockinterval = 600, difficulty = 1, rollntime = 0,
+               longpoll = True, p2pool = False, latency = 0, verify = False, seed = 0, batch = True):
+    self.blockinterval = blockinterval
+    self.rollntime = rollntime
+    self.longpoll = longpoll
+    self.p2pool = p2pool
+    self.latency = latency
+    self.verify = verify
+    self.batch = batch
+    self.random = random.Random(seed)
+    self.target = PoolEmulator.difficulty_to_target(difficulty)
+    self.lock = Condition()
+    self.shutdown = False
+    self.block = 0
+    self.prevhash = None
+    self.submitted = set()
+    self.stats = Bunch(getworks = 0, batches = 0, submitbatches = 0, longpolls = 0, blocks = 0, accepted = 0, stale = 0, duplicate = 0, invalid = 0)
+    self.servicetimes = []
+    with self.lock: self._new_block()
+    self.server = _Server((host, port), _RequestHandler)
+    self.server.pool = self
+    self.host, self.port = self.server.server_address[:2]
+    self.serverthread = Thread(None, self.server.serve_forever, "poolemulator_server")
+    self.serverthread.daemon = True
+    self.blockthread = Thread(None, self._blockloop, "poolemulator_blocks")
+    self.blockthread.daemon = True
+
+
+  @staticmethod
+  def difficulty_to_target(difficulty):
+    target = int(0xffff * 2**208 / difficulty)
+    return struct.pack("<4Q", target & 0xffffffffffffffff, (target >> 64) & 0xffffffffffffffff,
+                       (target >> 128) & 0xffffffffffffffff, target >> 192)
+
+
+  def start(self):
+    self.serverthread.start()
+    self.blockthread.start()
+
+
+  def stop(self):
+    with self.lock:
+      self.shutdown = True
+      self.lock.notify_all()
+    self.server.shutdown()
+    self.server.server_close()
+
+
+  def _new_block(self):
+    # Called with the lock held
+    self.block += 1
+    self.prevhash = os.urandom(32)
+    self.submitted = set()
+    self.lock.notify_all()
+
+
+  def _blockloop(self):
+    with self.lock:
+      while not self.shutdown:
+        self.lock.wait(self.random.expovariate(1. / self.blockinterval))
+        if self.shutdown: return
+        self._new_block()
+        self.stats.blocks += 1
+
+
+  def get_work(self, count = 1):
+    # Returns a list of work items, the artificial latency applies once per request
+    with self.lock:
+      self.stats.getworks += count
+      if count > 1: self.stats.batches += 1
+      prevhash = self.prevhash
+      block = self.block
+    if self.latency: time.sleep(self.latency)
+    return [self._make_work(prevhash, block) for i in range(count)]
+
+
+  def wait_for_block(self, timeout = 600):
+    with self.lock:
+      self.stats.longpolls += 1
+      block = self.block
+      end = time.time() + timeout
+      while self.block == block and not self.shutdown and time.time() < end: self.lock.wait(end - time.time())
+      prevhash = self.prevhash
+      block = self.block
+    return self._make_work(prevhash, block)
+
+
+  def _make_work(self, prevhash, block):
+    # Getwork data is the block header in 32 bit word swapped byte order, with SHA256 padding
+    header = struct.pack(">I", 2) + prevhash + os.urandom(32) + struct.pack(">III", int(time.time()), 0x1d00ffff, 0)
+    data = header + struct.pack("<12I", 0x80000000, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 640)
+    result = {"data": hexlify(data).decode("ascii"), "target": hexlify(self.target).decode("ascii")}
+    if self.p2pool: result["identifier"] = str(block)
+    return result
+
+
+  def submit_share(self, data):
+    if len(data) < 80:
+      with self.lock: self.stats.invalid += 1
+      return "invalid"
+    if self.verify:
+      hash = Job.calculate_hash(data[:80])
+      if hash[-4:] != b"\0\0\0\0" or hash[::-1] > self.target[::-1]:
+        with self.lock: self.stats.invalid += 1
+        return "high-hash"
+    with self.lock:
+      if data[4:36] != self.prevhash:
+        self.stats.stale += 1
+        return "stale"
+      if data[:80] in self.submitted:
+        self.stats.duplicate += 1
+        return "duplicate"
+      self.submitted.add(data[:80])
+      self.stats.accepted += 1
+    return None
+
+
+  def work_headers(self):
+    headers = []
+    if self.longpoll: headers.append(("X-Long-Polling", "/longpoll"))
+    if self.rollntime: headers.append(("X-Roll-NTime", "expire=%d" % self.rollntime))
+    if self.p2pool: headers.append(("X-Is-P2Pool", "true"))
+    return headers
+
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+  protocol_version = "HTTP/1.1"
+  # Headers and body are written separately, don't let Nagle's algorithm delay the body
+  disable_nagle_algorithm = True
+
+
+  def log_message(self, format, *args):
+    pass
+
+
+  def _respond(self, result, error = None, headers = [], id = 0):
+    self._send({"result": result, "error": error, "id": id}, headers)
+
+
+  def _send(self, reply, headers = []):
+    body = json.dumps(reply).encode("utf_8")
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    for header in headers: self.send_header(*header)
+    self.end_headers()
+    self.wfile.write(body)
+
+
+  def do_POST(self):
+    pool = self.server.pool
+    start = time.time()
+    request = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf_8"))
+    if isinstance(request, list):
+      # Batched requests, answered in one response
+      if not pool.batch: return self._respond(None, {"code": -32600, "message": "Invalid request"}, id = None)
+      shares = [item for item in request if item.get("params")]
+      if shares:
+        # Share submissions, per-share reject reasons can't be sent as a header here
+        with pool.lock: pool.stats.submitbatches += 1
+        replies = []
+        for item in shares:
+          reason = pool.submit_share(unhexlify(item["params"][0].encode("ascii")))
+          if reason: replies.append({"result": False, "error": None, "reject-reason": reason, "id": item.get("id")})
+          else: replies.append({"result": True, "error": None, "id": item.get("id")})
+        return self._send(replies)
+      works = pool.get_work(len(request))
+      self._send([{"result": work, "error": None, "id": item.get("id")} for item, work in zip(request, works)],
+                 pool.work_headers())
+      with pool.lock: pool.servicetimes.append(time.time() - start)
+      return
+    params = request.get("params")
+    if params:
+      reason = pool.submit_share(unhexlify(params[0].encode("ascii")))
+      if reason: self._respond(False, None, [("X-Reject-Reason", reason)])
+      else: self._respond(True)
+    else:
+      self._respond(pool.get_work()[0], None, pool.work_headers())
+      with pool.lock: pool.servicetimes.append(time.time() - start)
+
+
+  def do_GET(self):
+    pool = self.server.pool
+    if self.path.split("?")[0] != "/longpoll" or not pool.longpoll:
+      self.send_error(404)
+      return
+    work = pool.wait_for_block()
+    # Miners abort long polls that they don't need any more, that's not an error
+    try: self._respond(work, None, pool.work_headers())
+    except socket.error: pass
+
+
+
+def main():
+  parser = OptionParser("Usage: python -m benchmarks.poolemulator [options]")
+  parser.add_option("--host", action = "store", default = "127.0.0.1", help = "Address to listen on")
+  parser.add_option("--port", "-p", action = "store", type = "int", default = 8332, help = "Port to listen on")
+  parser.add_option("--blockinterval", "-b", action = "store", type = "float", default = 600,
+                    help = "Average time between block changes in seconds")
+  parser.add_option("--difficulty", "-d", action = "store", type = "float", default = 1, help = "Share difficulty")
+  parser.add_option("--rollntime", action = "store", type = "int", default = 0,
+                    help = "Allow rolling ntime for this many seconds (X-Roll-NTime), 0 to disable")
+  parser.add_option("--no-longpoll", action = "store_true", default = False, help = "Don't offer long polling")
+  parser.add_option("--p2pool", action = "store_true", default = False, help = "Pretend to be p2pool (X-Is-P2Pool)")
+  parser.add_option("--latency", "-l", action = "store", type = "float", default = 0,
+                    help = "Artificial getwork processing delay in seconds")
+  parser.add_option("--verify", action = "store_true", default = False, help = "Verify share hashes")
+  parser.add_option("--seed", action = "store", type = "int", default = 0, help = "Seed for block change timing")
+  parser.add_option("--no-batch", action = "store_true", default = False, help = "Reject batched JSON-RPC requests")
+  (options, args) = parser.parse_args()
+  pool = PoolEmulator(options.host, options.port, options.blockinterval, options.difficulty, options.rollntime,
+                      not options.no_longpoll, options.p2pool, options.latency, options.verify, options.seed,
+                      not options.no_batch)
+  pool.start()
+  sys.stderr.write("Pool emulator listening on %s:%d\n" % (pool.host, pool.port))
+  try:
+    while True:
+      time.sleep(10)
+      with pool.lock: sys.stderr.write("%r\n" % pool.stats)
+  except KeyboardInterrupt: pool.stop()
+
+if __name__ == "__main__":
+  main()
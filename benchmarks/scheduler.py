@@ -0,0 +1,357 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+###################################
+# Work source scheduler benchmark #
+###################################
+
+# Usage (from the mpbm directory): python -m benchmarks.scheduler [options]
+
+
+
+import time
+import random
+from threading import RLock
+from optparse import OptionParser
+from core.util import Bunch
+from core.objectregistry import ObjectRegistry
+from core.baseworksource import BaseWorkSource
+from core.worksourcegroup import WorkSourceGroup
+
+
+
+JOBMHASHES = 2**32 / 1000000.
+
+
+
+class BenchmarkCore(object):
+
+
+  def __init__(self):
+    self.settings = Bunch(name = "Benchmark core")
+    self.registry = ObjectRegistry(self)
+
+
+  def event(self, *args, **kwargs):
+    pass
+
+
+  def log(self, *args, **kwargs):
+    pass
+
+
+
+class BenchmarkWorkSource(BaseWorkSource):
+  # Every fetch delivers a fixed number of jobs right away, which are charged like registered jobs.
+  # Stale work is penalized like the work queue does.
+
+  def __init__(self, core, jobsperfetch):
+    super(BenchmarkWorkSource, self).__init__(core)
+    self.jobsperfetch = jobsperfetch
+    self.fetched = 0
+    self.fetches = 0
+    self.stale = False
+
+
+  def start_fetchers(self, count):
+    self.fetches += 1
+    if self.stale: self.add_deferred_mhashes(JOBMHASHES)
+    else:
+      self.fetched += self.jobsperfetch
+      self.add_pending_mhashes(-self.jobsperfetch * JOBMHASHES)
+    return 1
+
+
+
+class ReferenceWorkSource(object):
+  # The leaf side of the round robin distribution that WorkSourceGroup used to do,
+  # kept here to measure the gain and to compare the resulting shares.
+
+  is_group = False
+
+
+  def __init__(self, parent, priority, hashrate, jobsperfetch):
+    self.parent = parent
+    self.settings = Bunch(enabled = True, priority = priority, hashrate = hashrate)
+    self.statelock = RLock()
+    self.mhashes_pending = 0
+    self.mhashes_deferred = 0
+    self.jobsperfetch = jobsperfetch
+    self.fetched = 0
+    self.fetches = 0
+    self.stale = False
+
+
+  def add_pending_mhashes(self, mhashes):
+    with self.statelock: self.mhashes_pending += mhashes
+    if self.parent: self.parent.add_pending_mhashes(mhashes)
+
+
+  def add_deferred_mhashes(self, mhashes):
+    with self.statelock: self.mhashes_deferred += mhashes
+    if self.parent: self.parent.add_deferred_mhashes(mhashes)
+
+
+  def start_fetchers(self, count):
+    self.fetches += 1
+    if self.stale:
+      self.add_pending_mhashes(-JOBMHASHES)
+      self.add_deferred_mhashes(JOBMHASHES)
+    else:
+      self.fetched += self.jobsperfetch
+      self.add_pending_mhashes(-self.jobsperfetch * JOBMHASHES)
+    return 1
+
+
+
+class ReferenceGroup(ReferenceWorkSource):
+
+  is_group = True
+
+
+  def __init__(self, parent, priority, hashrate):
+    super(ReferenceGroup, self).__init__(parent, priority, hashrate, 0)
+    self.settings.distribution_granularity = 16
+    self.children = []
+    self.last_index = 0
+    self.last_time = time.time()
+
+
+  def _distribute_mhashes(self):
+    with self.statelock:
+      now = time.time()
+      timestep = now - self.last_time
+      self.last_time = now
+      mhashes_remaining = 2**32 / 1000000. * self.settings.distribution_granularity
+      total_priority = 0
+      for child in self.children:
+        if child.settings.enabled:
+          with child.statelock:
+            total_priority += child.settings.priority
+            mhashes = timestep * child.settings.hashrate
+            child.mhashes_pending += mhashes + child.mhashes_deferred * 0.1
+            mhashes_remaining -= mhashes
+            child.mhashes_deferred *= 0.9
+      if mhashes_remaining > 0 and total_priority > 0:
+        unit = mhashes_remaining / total_priority
+        for child in self.children:
+          if child.settings.enabled:
+            with child.statelock:
+              mhashes = unit * child.settings.priority
+              child.mhashes_pending += mhashes
+              mhashes_remaining -= mhashes
+
+
+  def _get_start_index(self):
+    with self.statelock:
+      self.last_index += 1
+      if self.last_index >= len(self.children): self.last_index = 0
+      return self.last_index
+
+
+  def _start_fetcher(self, force = False):
+    children = [child for child in self.children]
+    startindex = self._get_start_index()
+    best = False
+    found = False
+    iteration = 0
+    while not found:
+      index = startindex
+      first = True
+      while index != startindex or first:
+        worksource = children[index]
+        mhashes = 0
+        if not worksource.is_group: mhashes = 2**32 / 1000000.
+        if force or worksource.mhashes_pending >= mhashes:
+          found = True
+          if mhashes: worksource.add_pending_mhashes(-mhashes)
+          result = worksource.start_fetchers(1)
+          if result is not False:
+            if mhashes: worksource.add_pending_mhashes(mhashes)
+            if result: return result
+            best = result
+        index += 1
+        if index >= len(children): index = 0
+        first = False
+      if not found: self._distribute_mhashes()
+      iteration += 1
+      if iteration > 150: break
+      if iteration > 100: force = True
+    return best
+
+
+  def start_fetchers(self, count):
+    started = 0
+    result = False
+    while started < count:
+      result = self._start_fetcher()
+      if not result: result = self._start_fetcher(True)
+      if not result: break
+      started += result
+    if started: return started
+    return result
+
+
+
+def build_tree(rng, depth, fanout, make_group, make_leaf, parent = None):
+  # The same seed builds the same shape and settings for both implementations
+  children = []
+  for i in range(fanout):
+    priority = rng.randint(1, 10)
+    if depth > 1:
+      group = make_group(parent, priority)
+      build_tree(rng, depth - 1, fanout, make_group, make_leaf, group)
+      children.append(group)
+    else: children.append(make_leaf(parent, priority, rng.choice((1, 1, 1, 8))))
+  for child in children: parent.children.append(child)
+  return parent
+
+
+def leaves(group):
+  result = []
+  for child in group.children:
+    if child.is_group: result.extend(leaves(child))
+    else: result.append(child)
+  return result
+
+
+def expected_shares(group, share = 1.):
+  # Fraction of the hashes that every leaf should get by priority
+  result = {}
+  total = sum(child.settings.priority for child in group.children)
+  for child in group.children:
+    childshare = share * child.settings.priority / total
+    if child.is_group: result.update(expected_shares(child, childshare))
+    else: result[child] = childshare
+  return result
+
+
+def deviation(root):
+  # Largest relative difference between the hashes a leaf got and its share by priority
+  expected = expected_shares(root)
+  total = float(sum(leaf.fetched for leaf in expected))
+  return max(abs(leaf.fetched / total - share) / share for leaf, share in expected.items())
+
+
+def block_changes(blocks, latencies):
+  # Equal priorities, but different fetch latencies. Every block, a number of fetches are
+  # started, and then half of the fetched jobs are thrown away unused when the block changes.
+  core = BenchmarkCore()
+  root = WorkSourceGroup(core)
+  root.settings.selection = "latency"
+  root.apply_settings()
+  for latency in latencies:
+    leaf = BenchmarkWorkSource(core, 1)
+    leaf.estimated_latency = latency
+    leaf.set_parent(root)
+    root.children.append(leaf)
+  for worksource in core.registry.objects.values(): worksource.started = True
+  first = dict((leaf, 0) for leaf in root.children)
+  for block in range(blocks):
+    fetched = dict((leaf, leaf.fetched) for leaf in root.children)
+    for i in range(48):
+      if i == 16:
+        for leaf in root.children: first[leaf] += leaf.fetched - fetched[leaf]
+      root.start_fetchers(1)
+    for leaf in root.children: leaf.add_pending_mhashes((leaf.fetched - fetched[leaf]) * JOBMHASHES / 2)
+  total = float(sum(leaf.fetched for leaf in root.children))
+  for leaf in root.children:
+    print("Latency %5.0f ms: %5.1f%% of the first 16 fetches per block, %5.1f%% overall" %
+          (1000 * leaf.estimated_latency, 100. * first[leaf] / (16 * blocks), 100 * leaf.fetched / total))
+
+
+def stale_work(root, leaves, phase):
+  # The first leaf delivers stale work for a while, then recovers. Returns its share of the
+  # fetches while it is stale, and in the two phases after that.
+  shares = []
+  for stale in (True, False, False):
+    leaves[0].stale = stale
+    fetches = [leaf.fetches for leaf in leaves]
+    for i in range(phase): root.start_fetchers(1)
+    shares.append(float(leaves[0].fetches - fetches[0]) / sum(leaf.fetches - count for leaf, count in zip(leaves, fetches)))
+  return shares
+
+
+def measure(name, count, function):
+  start = time.time()
+  function()
+  elapsed = time.time() - start
+  print("%-40s %10.0f ops/s  (%d ops in %.3f s)" % (name, count / elapsed, count, elapsed))
+  return elapsed
+
+
+def main():
+  parser = OptionParser("Usage: python -m benchmarks.scheduler [options]")
+  parser.add_option("--depth", "-d", action = "store", type = "int", default = 3, help = "Depth of the work source tree")
+  parser.add_option("--fanout", "-f", action = "store", type = "int", default = 5, help = "Children per work source group")
+  parser.add_option("--fetches", "-n", action = "store", type = "int", default = 20000, help = "Number of fetchers to start")
+  parser.add_option("--seed", action = "store", type = "int", default = 0, help = "Seed for priorities and jobs per fetch")
+  (options, args) = parser.parse_args()
+  count = options.fetches
+
+  core = BenchmarkCore()
+  def make_group(parent, priority):
+    group = WorkSourceGroup(core)
+    group.settings.priority = priority
+    group.apply_settings()
+    if parent: group.set_parent(parent)
+    return group
+  def make_leaf(parent, priority, jobsperfetch):
+    leaf = BenchmarkWorkSource(core, jobsperfetch)
+    leaf.settings.priority = priority
+    leaf.apply_settings()
+    leaf.set_parent(parent)
+    return leaf
+  root = build_tree(random.Random(options.seed), options.depth, options.fanout, make_group, make_leaf, make_group(None, 1))
+  for worksource in core.registry.objects.values(): worksource.started = True
+  reference = build_tree(random.Random(options.seed), options.depth, options.fanout, lambda parent, priority: ReferenceGroup(parent, priority, 0),
+                         lambda parent, priority, jobsperfetch: ReferenceWorkSource(parent, priority, 0, jobsperfetch), ReferenceGroup(None, 1, 0))
+  print("%d leaves in %d levels, %d to %d jobs per fetch" % (len(leaves(root)), options.depth, 1, 8))
+
+  old = measure("reference round robin", count, lambda: [reference.start_fetchers(1) for i in range(count)])
+  new = measure("flattened scheduler", count, lambda: [root.start_fetchers(1) for i in range(count)])
+  print("Speedup: %.2fx" % (old / new))
+  # The fetcher controller asks for several fetchers at once after a block change
+  old = measure("reference round robin, 5 at a time", count, lambda: [reference.start_fetchers(5) for i in range(count // 5)])
+  new = measure("flattened scheduler, 5 at a time", count, lambda: [root.start_fetchers(5) for i in range(count // 5)])
+  print("Speedup: %.2fx" % (old / new))
+  print("Largest deviation from the priority shares: reference %.1f%%, flattened %.1f%%" %
+        (100 * deviation(reference), 100 * deviation(root)))
+  start = time.time()
+  root.scheduler.invalidate()
+  root.scheduler.get_weights()
+  print("Recomputing the weights takes %.3f ms" % (1000 * (time.time() - start)))
+  block_changes(200, (0.05, 0.5, 2))
+
+  # Four leaves with equal priorities, the first one of which delivers stale work for a while
+  core = BenchmarkCore()
+  root = make_group(None, 1)
+  for i in range(4): root.children.append(make_leaf(root, 1, 1))
+  for worksource in core.registry.objects.values(): worksource.started = True
+  reference = ReferenceGroup(None, 1, 0)
+  for i in range(4): reference.children.append(ReferenceWorkSource(reference, 1, 0, 1))
+  for name, group in (("reference", reference), ("flattened", root)):
+    print("Stale work source, %-9s %4.1f%% of the fetches while stale, %4.1f%% and %4.1f%% after recovering (25%% fair)" %
+          ((name,) + tuple(100 * share for share in stale_work(group, group.children, 400))))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,160 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+####################
+# SHA256 benchmark #
+####################
+
+# Usage (from the mpbm directory): python -m benchmarks.sha256 [options]
+
+
+
+import os
+import time
+import struct
+from hashlib import sha256
+from optparse import OptionParser
+from core.sha256 import SHA256
+from core.job import Job, ValidationJob
+
+
+
+class ReferenceSHA256(object):
+  # The straightforward implementation that core.sha256 used to ship,
+  # kept here to check the optimized one against and to measure the gain.
+
+  _k = SHA256._k
+
+        
+  def __init__(self):        
+    self._buffer = b""
+    self._length = 0
+    self.state = (0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
+        
+        
+  def _rotr(self, x, y):
+      return ((x >> y) | (x << (32 - y))) & 0xffffffff
+
+      
+  def _round(self, data):
+    w = [0] * 64
+    w[0:15] = struct.unpack("!16L", data)
+    
+    for i in range(16, 64):
+      s0 = self._rotr(w[i - 15], 7) ^ self._rotr(w[i - 15], 18) ^ (w[i - 15] >> 3)
+      s1 = self._rotr(w[i - 2], 17) ^ self._rotr(w[i - 2], 19) ^ (w[i - 2] >> 10)
+      w[i] = (w[i - 16] + s0 + w[i - 7] + s1) & 0xffffffff
+    
+    a, b, c, d, e, f, g, h = self.state
+    
+    for i in range(64):
+      t1 = h + (self._rotr(e, 6) ^ self._rotr(e, 11) ^ self._rotr(e, 25)) + ((e & f) ^ ((~e) & g)) + self._k[i] + w[i]
+      t2 = (self._rotr(a, 2) ^ self._rotr(a, 13) ^ self._rotr(a, 22)) + ((a & b) ^ (a & c) ^ (b & c))
+      h, g, f, e, d, c, b, a = g, f, e, (d + t1) & 0xffffffff, c, b, a, (t1 + t2) & 0xffffffff
+        
+    self.state = tuple((x + y) & 0xffffffff for x, y in zip(self.state, (a, b, c, d, e, f, g, h)))
+
+    
+  def update(self, data):
+    self._buffer += data
+    self._length += len(data)
+    while len(self._buffer) >= 64:
+      self._round(self._buffer[:64])
+      self._buffer = self._buffer[64:]
+      
+      
+  def finalize(self):
+    tailbytes = self._length & 0x3f
+    if tailbytes < 56: padding = 55 - tailbytes
+    else: padding = 119 - tailbytes
+    self.update(b"\x80" + (b"\0" * padding) + struct.pack("!Q", self._length << 3))
+
+      
+  def get_bytes(self):
+    return struct.pack("!8L", *self.state)
+
+    
+  @classmethod
+  def hash(cls, data, finalize = True):
+    hash = cls()
+    hash.update(data)
+    if finalize: hash.finalize()
+    return hash.get_bytes()
+
+
+
+def verify(count):
+  for i in range(count):
+    data = os.urandom(i % 200)
+    expected = sha256(data).digest()
+    if SHA256.hash(data) != expected or ReferenceSHA256.hash(data) != expected:
+      raise Exception("Hash mismatch for %d byte message" % len(data))
+    if SHA256.hash(data, False) != ReferenceSHA256.hash(data, False):
+      raise Exception("Midstate mismatch for %d byte message" % len(data))
+    # Feed the same data in odd-sized pieces
+    hash = SHA256()
+    for offset in range(0, len(data), 7): hash.update(data[offset : offset + 7])
+    hash.finalize()
+    if hash.get_bytes() != expected: raise Exception("Incremental hash mismatch for %d byte message" % len(data))
+  print("%d messages verified against hashlib and the reference implementation" % count)
+
+
+def measure(name, count, function, repeat = 3):
+  # Take the best of a few runs to filter out scheduling noise
+  elapsed = None
+  for i in range(repeat):
+    start = time.time()
+    function()
+    elapsed = min(elapsed or float("inf"), time.time() - start)
+  print("%-40s %10.0f ops/s  (%d ops in %.3f s)" % (name, count / elapsed, count, elapsed))
+  return elapsed
+
+
+def main():
+  parser = OptionParser("Usage: python -m benchmarks.sha256 [options]")
+  parser.add_option("--midstates", "-n", action = "store", type = "int", default = 5000,
+                    help = "Number of midstates to calculate")
+  parser.add_option("--verify", "-v", action = "store", type = "int", default = 1000,
+                    help = "Number of random messages to check for bit-exact results")
+  (options, args) = parser.parse_args()
+  verify(options.verify)
+  count = options.midstates
+  headers = [os.urandom(128) for i in range(count)]
+  blocks = [struct.pack("<16I", *struct.unpack(">16I", data[:64])) for data in headers]
+  reference = measure("reference midstate", count, lambda: [ReferenceSHA256.hash(block, False) for block in blocks])
+  optimized = measure("optimized midstate", count, lambda: [SHA256.hash(block, False) for block in blocks])
+  measure("Job.calculate_midstate", count, lambda: [Job.calculate_midstate(data) for data in headers])
+  print("Speedup: %.2fx" % (reference / optimized))
+  # Checking a share: rebuilding and byte swapping the whole header, or reusing the job's prepared one
+  jobs = [ValidationJob(None, data) for data in headers]
+  nonces = [os.urandom(4) for i in range(count)]
+  for job, nonce in zip(jobs, nonces):
+    if Job.calculate_job_hashes(job, [nonce])[0] != Job.calculate_hash(job.data[:76] + nonce + job.data[80:]):
+      raise Exception("Share hash mismatch")
+  rebuilt = measure("share check, header rebuilt", count,
+                    lambda: [Job.calculate_hash(job.data[:76] + nonce + job.data[80:]) for job, nonce in zip(jobs, nonces)])
+  prepared = measure("share check, header prepared", count,
+                     lambda: [Job.calculate_job_hashes(job, [nonce]) for job, nonce in zip(jobs, nonces)])
+  print("Speedup: %.2fx" % (rebuilt / prepared))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,251 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+#########################
+# Stratum pool emulator #
+#########################
+
+# Usage (from the mpbm directory): python -m benchmarks.stratumemulator [options]
+
+# A minimal local stand-in for a stratum pool: mining.subscribe, mining.authorize,
+# mining.set_difficulty, mining.notify and mining.submit over line delimited JSON.
+# Every connection gets its own extranonce1. Blocks change at random intervals from a
+# seeded generator and are announced with clean_jobs set. Shares are only checked for
+# staleness and duplicates unless verification is enabled, so that simulated workers
+# can be pointed at it.
+
+
+
+import os
+import sys
+import time
+import json
+import random
+import struct
+from hashlib import sha256
+from binascii import hexlify, unhexlify
+from optparse import OptionParser
+from threading import Condition, Thread, RLock
+from core.job import Job
+from core.util import Bunch
+from benchmarks.poolemulator import PoolEmulator
+try: from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+except ImportError: from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+
+
+
+class StratumEmulator(object):
+
+
+  def __init__(self, host = "127.0.0.1", port = 0, blockinterval = 600, difficulty = 1, verify = False, seed = 0,
+               branches = 4, extranonce2size = 4):
+    self.blockinterval = blockinterval
+    self.difficulty = difficulty
+    self.verify = verify
+    self.branches = branches
+    self.extranonce2size = extranonce2size
+    self.random = random.Random(seed)
+    self.target = PoolEmulator.difficulty_to_target(difficulty)
+    self.lock = Condition()
+    self.shutdown = False
+    self.block = 0
+    self.jobs = {}
+    self.job = None
+    self.nextjobid = 0
+    self.nextextranonce1 = 0
+    self.submitted = set()
+    self.sessions = []
+    self.stats = Bunch(connections = 0, notifies = 0, blocks = 0, accepted = 0, stale = 0, duplicate = 0, invalid = 0)
+    with self.lock: self._new_block()
+    self.server = _Server((host, port), _RequestHandler)
+    self.server.pool = self
+    self.host, self.port = self.server.server_address[:2]
+    self.serverthread = Thread(None, self.server.serve_forever, "stratumemulator_server")
+    self.serverthread.daemon = True
+    self.blockthread = Thread(None, self._blockloop, "stratumemulator_blocks")
+    self.blockthread.daemon = True
+
+
+  def start(self):
+    self.serverthread.start()
+    self.blockthread.start()
+
+
+  def stop(self):
+    with self.lock:
+      self.shutdown = True
+      self.lock.notify_all()
+    self.server.shutdown()
+    self.server.server_close()
+
+
+  def _new_block(self):
+    # Called with the lock held
+    self.block += 1
+    self.nextjobid += 1
+    prevhash = os.urandom(32)
+    # The coinbase is split around the extranonces, the transaction contents don't matter here
+    self.job = Bunch(id = "%x" % self.nextjobid, block = self.block, prevhash = prevhash,
+                     coinbase1 = b"\1\0\0\0\1" + os.urandom(41), coinbase2 = os.urandom(60),
+                     merklebranch = [os.urandom(32) for i in range(self.branches)],
+                     version = struct.pack(">I", 2), nbits = struct.pack(">I", 0x1d00ffff), ntime = struct.pack(">I", int(time.time())))
+    self.jobs = {self.job.id: self.job}
+    self.submitted = set()
+    self.lock.notify_all()
+
+
+  def _blockloop(self):
+    with self.lock:
+      while not self.shutdown:
+        self.lock.wait(self.random.expovariate(1. / self.blockinterval))
+        if self.shutdown: return
+        self._new_block()
+        self.stats.blocks += 1
+        for session in self.sessions: session.send_job(True)
+
+
+  def get_notify_params(self, clean):
+    with self.lock:
+      self.stats.notifies += 1
+      job = self.job
+    return [job.id, hexlify(job.prevhash).decode("ascii"), hexlify(job.coinbase1).decode("ascii"),
+            hexlify(job.coinbase2).decode("ascii"), [hexlify(branch).decode("ascii") for branch in job.merklebranch],
+            hexlify(job.version).decode("ascii"), hexlify(job.nbits).decode("ascii"), hexlify(job.ntime).decode("ascii"), clean]
+
+
+  def new_extranonce1(self):
+    with self.lock:
+      self.nextextranonce1 += 1
+      self.stats.connections += 1
+      return struct.pack(">I", self.nextextranonce1)
+
+
+  def submit_share(self, extranonce1, jobid, extranonce2, ntime, nonce):
+    # Returns None if the share was accepted, or a stratum error otherwise
+    with self.lock:
+      job = self.jobs.get(jobid)
+      if not job:
+        self.stats.stale += 1
+        return [21, "Job not found", None]
+    if len(extranonce2) != self.extranonce2size or len(ntime) != 4 or len(nonce) != 4:
+      with self.lock: self.stats.invalid += 1
+      return [20, "Malformed share", None]
+    if self.verify:
+      coinbase = job.coinbase1 + extranonce1 + extranonce2 + job.coinbase2
+      root = sha256(sha256(coinbase).digest()).digest()
+      for branch in job.merklebranch: root = sha256(sha256(root + branch).digest()).digest()
+      data = job.version + job.prevhash + struct.pack("<8I", *struct.unpack(">8I", root)) + ntime + job.nbits + nonce
+      hash = Job.calculate_hash(data)
+      if hash[-4:] != b"\0\0\0\0" or hash[::-1] > self.target[::-1]:
+        with self.lock: self.stats.invalid += 1
+        return [23, "Low difficulty share", None]
+    with self.lock:
+      key = (extranonce1, jobid, extranonce2, ntime, nonce)
+      if key in self.submitted:
+        self.stats.duplicate += 1
+        return [22, "Duplicate share", None]
+      self.submitted.add(key)
+      self.stats.accepted += 1
+    return None
+
+
+
+class _Server(ThreadingMixIn, TCPServer):
+
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+
+
+class _RequestHandler(StreamRequestHandler):
+
+  disable_nagle_algorithm = True
+
+
+  def setup(self):
+    StreamRequestHandler.setup(self)
+    self.pool = self.server.pool
+    self.sendlock = RLock()
+    self.extranonce1 = self.pool.new_extranonce1()
+
+
+  def send(self, message):
+    with self.sendlock: self.wfile.write((json.dumps(message) + "\n").encode("utf_8"))
+
+
+  def send_job(self, clean):
+    try: self.send({"id": None, "method": "mining.notify", "params": self.pool.get_notify_params(clean)})
+    except: pass
+
+
+  def handle(self):
+    try:
+      while True:
+        line = self.rfile.readline()
+        if not line: break
+        request = json.loads(line.decode("utf_8"))
+        id = request.get("id")
+        method = request.get("method")
+        params = request.get("params", [])
+        if method == "mining.subscribe":
+          self.send({"id": id, "result": [[["mining.set_difficulty", "1"], ["mining.notify", "1"]],
+                                          hexlify(self.extranonce1).decode("ascii"), self.pool.extranonce2size], "error": None})
+          self.send({"id": None, "method": "mining.set_difficulty", "params": [self.pool.difficulty]})
+          with self.pool.lock: self.pool.sessions.append(self)
+          self.send_job(True)
+        elif method == "mining.authorize": self.send({"id": id, "result": True, "error": None})
+        elif method == "mining.submit":
+          error = self.pool.submit_share(self.extranonce1, params[1], unhexlify(params[2].encode("ascii")),
+                                         unhexlify(params[3].encode("ascii")), unhexlify(params[4].encode("ascii")))
+          self.send({"id": id, "result": error is None, "error": error})
+        else: self.send({"id": id, "result": None, "error": [20, "Unknown method", None]})
+    except: pass
+    finally:
+      with self.pool.lock:
+        if self in self.pool.sessions: self.pool.sessions.remove(self)
+
+
+
+def main():
+  parser = OptionParser("Usage: python -m benchmarks.stratumemulator [options]")
+  parser.add_option("--host", action = "store", default = "127.0.0.1", help = "Address to listen on")
+  parser.add_option("--port", "-p", action = "store", type = "int", default = 3333, help = "Port to listen on")
+  parser.add_option("--blockinterval", "-b", action = "store", type = "float", default = 600,
+                    help = "Average time between block changes in seconds")
+  parser.add_option("--difficulty", "-d", action = "store", type = "float", default = 1, help = "Share difficulty")
+  parser.add_option("--branches", action = "store", type = "int", default = 4, help = "Merkle branch length")
+  parser.add_option("--verify", action = "store_true", default = False, help = "Verify share hashes")
+  parser.add_option("--seed", action = "store", type = "int", default = 0, help = "Seed for block change timing")
+  (options, args) = parser.parse_args()
+  pool = StratumEmulator(options.host, options.port, options.blockinterval, options.difficulty, options.verify,
+                         options.seed, options.branches)
+  pool.start()
+  sys.stderr.write("Stratum emulator listening on %s:%d\n" % (pool.host, pool.port))
+  try:
+    while True:
+      time.sleep(10)
+      with pool.lock: sys.stderr.write("%r\n" % pool.stats)
+  except KeyboardInterrupt: pool.stop()
+
+if __name__ == "__main__":
+  main()
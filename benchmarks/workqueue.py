@@ -0,0 +1,138 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+########################
+# Work queue benchmark #
+########################
+
+# Usage (from the mpbm directory): python -m benchmarks.workqueue [options]
+
+
+
+import time
+import random
+from optparse import OptionParser
+from core.util import Bunch
+from core.workqueue import WorkQueue
+
+
+
+class BenchmarkCore(object):
+
+
+  def __init__(self):
+    self.settings = Bunch(name = "Benchmark core")
+    self.fetcher = Bunch(wakeup = lambda: None)
+
+
+  def event(self, *args, **kwargs):
+    pass
+
+
+  def log(self, *args, **kwargs):
+    pass
+
+
+
+class BenchmarkBlockchain(object):
+
+
+  def check_job(self, job):
+    return True
+
+
+
+class BenchmarkJob(object):
+
+
+  def __init__(self, core, blockchain, expiry):
+    self.core = core
+    self.blockchain = blockchain
+    self.expiry = expiry
+    self.worker = None
+
+
+  def register(self):
+    pass
+
+
+  def set_worker(self, worker):
+    self.worker = worker
+
+
+  def destroy(self):
+    self.core.workqueue.remove_job(self)
+
+
+
+def make_jobs(core, blockchains, count, spread):
+  now = time.time()
+  return [BenchmarkJob(core, random.choice(blockchains), now + 60 + random.random() * spread) for i in range(count)]
+
+
+def measure(name, count, function):
+  start = time.time()
+  function()
+  elapsed = time.time() - start
+  print("%-40s %10.0f ops/s  (%d ops in %.3f s)" % (name, count / elapsed, count, elapsed))
+
+
+def main():
+  parser = OptionParser("Usage: python -m benchmarks.workqueue [options]")
+  parser.add_option("--jobs", "-n", action = "store", type = "int", default = 10000,
+                    help = "Number of queued jobs")
+  parser.add_option("--blockchains", "-b", action = "store", type = "int", default = 1,
+                    help = "Number of block chains (work queue shards) to spread the jobs across")
+  parser.add_option("--spread", "-s", action = "store", type = "float", default = 600,
+                    help = "Spread of job expiry times in seconds")
+  (options, args) = parser.parse_args()
+  random.seed(0)
+  core = BenchmarkCore()
+  queue = WorkQueue(core)
+  core.workqueue = queue
+  worker = Bunch(settings = Bunch(name = "Benchmark worker"))
+  count = options.jobs
+  blockchains = [BenchmarkBlockchain() for i in range(options.blockchains)]
+
+  jobs = make_jobs(core, blockchains, count, options.spread)
+  measure("add_jobs (%d jobs)" % count, count, lambda: queue.add_jobs(jobs))
+
+  def get_all():
+    for i in range(count): queue.get_job(worker, random.random() * options.spread, True)
+  measure("get_job (queue drains from %d)" % count, count, get_all)
+
+  jobs = make_jobs(core, blockchains, count, options.spread)
+  queue.add_jobs(jobs)
+  def get_remove_steady():
+    for i in range(count):
+      job = queue.get_job(worker, random.random() * options.spread, True)
+      jobs.append(BenchmarkJob(core, job.blockchain, job.expiry))
+      queue.add_job(jobs[-1])
+      job.destroy()
+  measure("get_job+add_job+remove_job (at %d)" % count, count, get_remove_steady)
+
+  jobs = [job for job in jobs if not job.worker]
+  random.shuffle(jobs)
+  measure("remove_job (random order from %d)" % len(jobs), len(jobs), lambda: [job.destroy() for job in jobs])
+
+if __name__ == "__main__":
+  main()
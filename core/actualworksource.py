@@ -26,12 +26,16 @@
 
 
 
+import re
 import time
+import struct
 import traceback
 from binascii import hexlify
 from threading import RLock, Thread
 from .baseworksource import BaseWorkSource
 from .blockchain import DummyBlockchain
+from .sharespool import ShareSpool
+from .job import JobTemplate
 
 
 
@@ -43,6 +47,9 @@ class ActualWorkSource(BaseWorkSource):
     "errorlockout_factor": {"title": "Error lockout factor", "type": "int", "position": 20100},
     "errorlockout_max": {"title": "Error lockout maximum", "type": "int", "position": 20200},
     "stalelockout": {"title": "Stale lockout", "type": "int", "position": 20500},
+    "sharespool": {"title": "Spool shares to disk", "type": "boolean", "position": 20600},
+    "sharespoolexpiry": {"title": "Spooled share expiry", "type": "int", "position": 20700},
+    "dropstaleshares": {"title": "Drop shares for old blocks", "type": "boolean", "position": 20800},
   })
 
   def __init__(self, core, state = None):
@@ -61,11 +68,32 @@ class ActualWorkSource(BaseWorkSource):
     self.lockoutend = 0
     self.estimated_jobs = 1
     self.estimated_expiry = 60
+    self.estimated_latency = None
+    self.spool = None
+    self.lastprevhash = None
+    self.stats.sharesexpired = 0
+    self.stats.sharesdropped = 0
+    self.stats.lockouts = 0
+    self.stats.blocksannounced = 0
+    self.stats.blocksfirst = 0
+    self.stats.blocklag = 0
+    
+    
+  def _start(self):
+    super(ActualWorkSource, self)._start()
+    if self.settings.sharespool:
+      try: self.spool = ShareSpool("config/spool/%s_%s.spool" % (self.core.instance, re.sub(r"[^\w.-]", "_", self.settings.name)))
+      except: self.core.log(self, "Could not open share spool: %s\n" % traceback.format_exc(), 100, "rB")
+    if self.spool and self.spool.pending:
+      self.core.log(self, "Replaying %d spooled shares\n" % self.spool.pending, 300)
+      self._replay_spool()
     
       
   def _stop(self):
     self._cancel_jobs()
     super(ActualWorkSource, self)._stop()
+    if self.spool: self.spool.close()
+    self.spool = None
     
     
   def _get_statistics(self, stats, childstats):
@@ -74,8 +102,17 @@ class ActualWorkSource(BaseWorkSource):
     lockout = self.lockoutend - time.time()
     stats.locked_out = lockout if lockout > 0 else 0
     stats.consecutive_errors = self.errors
+    stats.lockouts = self.stats.lockouts
+    stats.sharesspooled = self.spool.pending if self.spool else 0
+    stats.sharesexpired = self.stats.sharesexpired
+    stats.sharesdropped = self.stats.sharesdropped
+    with self.stats.lock:
+      stats.blocksannounced = self.stats.blocksannounced
+      stats.blocksfirst = self.stats.blocksfirst
+      stats.avgblocklag = self.stats.blocklag / self.stats.blocksannounced if self.stats.blocksannounced else None
     stats.jobs_per_request = self.estimated_jobs
     stats.job_expiry = self.estimated_expiry
+    stats.fetch_latency = self.estimated_latency
     stats.blockchain = self.blockchain
     stats.blockchain_id = self.blockchain.id
     stats.blockchain_name = "None" if isinstance(self.blockchain, DummyBlockchain) else self.blockchain.settings.name
@@ -104,6 +141,11 @@ class ActualWorkSource(BaseWorkSource):
     if not "lockout_max" in self.settings or not self.settings.errorlockout_max:
       self.settings.errorlockout_max = 500
     if not "stalelockout" in self.settings: self.settings.stalelockout = 25
+    if not "sharespool" in self.settings: self.settings.sharespool = False
+    if self.started and self.settings.sharespool != bool(self.spool): self.async_restart()
+    if not "sharespoolexpiry" in self.settings or not self.settings.sharespoolexpiry:
+      self.settings.sharespoolexpiry = 600
+    if not "dropstaleshares" in self.settings: self.settings.dropstaleshares = False
     
   
   def get_blockchain(self):
@@ -122,14 +164,19 @@ class ActualWorkSource(BaseWorkSource):
     return time.time() <= self.lockoutend
     
       
-  def _handle_success(self, jobs = None):
+  def _handle_success(self, jobs = None, latency = None):
     with self.statelock:
       self.errors = 0
+      if latency is not None:
+        self.core.event(450, self, "fetchlatency", latency * 1000, "%f ms" % (latency * 1000), worksource = self)
+        if self.estimated_latency is None: self.estimated_latency = latency
+        else: self.estimated_latency = self.estimated_latency * 0.9 + latency * 0.1
       if jobs:
-        jobcount = len(jobs)
+        jobcount = JobTemplate.count_jobs(jobs)
         self.estimated_jobs = jobcount
         self.estimated_expiry = int(jobs[0].expiry - time.time())
         with self.stats.lock: self.stats.jobsreceived += jobcount
+    if jobs: self.core.fetcher.notify_jobs_received(self, jobcount, self.estimated_expiry, latency)
 
     
   def _handle_error(self, upload = False):
@@ -138,19 +185,41 @@ class ActualWorkSource(BaseWorkSource):
       if self.errors >= self.settings.errorlimit:
         lockout = min(self.settings.errorlockout_factor + self.errors, self.settings.errorlockout_max)
         self.lockoutend = max(self.lockoutend, time.time() + lockout)
+        lockedout = True
+      else: lockedout = False
     with self.stats.lock:
       if upload: self.stats.uploadretries += 1
       else: self.stats.failedjobreqs += 1
+      if lockedout: self.stats.lockouts += 1
 
     
   def _handle_stale(self):
     with self.statelock:
       self.lockoutend = max(self.lockoutend, time.time() + self.settings.stalelockout)
+    with self.stats.lock: self.stats.lockouts += 1
       
       
-  def _push_jobs(self, jobs):
-    self._handle_success(jobs)
-    if jobs: self.core.workqueue.add_jobs(jobs)
+  def _push_jobs(self, jobs, latency = None):
+    self._handle_success(jobs, latency)
+    if not jobs: return
+    self._announce_block(jobs[0].prevhash)
+    self.core.workqueue.add_jobs(jobs)
+
+
+  def _announce_block(self, prevhash):
+    # Measures how quickly this work source notices new blocks compared to the others on the same block chain
+    with self.statelock:
+      if prevhash == self.lastprevhash: return
+      startup = self.lastprevhash is None
+      self.lastprevhash = prevhash
+    lag = self.blockchain.announce_block(prevhash, time.time())
+    # The block that was current at startup says nothing about notification latency
+    if lag is None or startup: return
+    self.core.event(450, self, "blocklag", lag * 1000, "%f ms" % (lag * 1000), worksource = self)
+    with self.stats.lock:
+      self.stats.blocksannounced += 1
+      if not lag: self.stats.blocksfirst += 1
+      self.stats.blocklag += lag
       
       
   def get_running_fetcher_count(self):
@@ -176,24 +245,84 @@ class ActualWorkSource(BaseWorkSource):
     return False
 
 
+  def _spool_share(self, job, data, noncediff):
+    # Returns the spool slot of the share, or None if spooling is disabled
+    if not self.spool: return None
+    now = time.time()
+    return self.spool.append(now, now + self.settings.sharespoolexpiry, noncediff, job.difficulty, data, job)
+
+
+  def _is_share_stale(self, data, expiry):
+    # Returns why a spooled share won't be submitted anymore, or None. Shares for a block that was
+    # superseded are only dropped if asked to, otherwise the pool decides whether to accept them.
+    if expiry < time.time(): return "expired"
+    if not self.settings.dropstaleshares: return None
+    prevhash = self.blockchain.currentprevhash
+    if prevhash is not None and prevhash != data[4:36]: return "stale"
+    return None
+
+
+  def _expire_share(self, record, nonce, noncediff, reason):
+    self.core.log(self, "Dropping %s share %s (difficulty %.5f)\n" % (reason, hexlify(nonce).decode("ascii"), noncediff), 300, "y")
+    with self.stats.lock:
+      if reason == "stale": self.stats.sharesdropped += 1
+      else: self.stats.sharesexpired += 1
+    if record: record.spool.complete(record.slot)
+
+
+  def _spooled_share_handled(self, nonce, noncediff, difficulty, result):
+    # Shares replayed from the spool have outlived their job, so they are only accounted to the work source
+    nonceval = struct.unpack("<I", nonce)[0]
+    if result == True:
+      self.core.log(self, "Accepted spooled share %s (difficulty %.5f)\n" % (hexlify(nonce).decode("ascii"), noncediff), 250, "gB")
+      self.counters.add("sharesaccepted", difficulty)
+      self.core.event(350, self, "nonceaccepted", nonceval, None, None, self, self.blockchain)
+    else:
+      if result == False or result == None or len(result) == 0: result = "Unknown reason"
+      self.core.log(self, "Rejected spooled share %s (difficulty %.5f): %s\n" % (hexlify(nonce).decode("ascii"), noncediff, result), 200, "y")
+      self.counters.add("sharesrejected", difficulty)
+      self.core.event(300, self, "noncerejected", nonceval, result, None, self, self.blockchain)
+
+
+  def _replay_spool(self):
+    # Shares left over from a previous run are submitted one by one, new ones are handled as usual
+    thread = Thread(None, self._replay_spool_thread, self.settings.name + "_spool_replay", (self.spool, self.spool.tail))
+    thread.daemon = True
+    thread.start()
+
+
+  def _replay_spool_thread(self, spool, end):
+    while True:
+      record = spool.take(end)
+      if not record: return
+      self.nonce_found_thread(None, record.data, record.data[76:80], record.noncediff, record)
+
+
   def nonce_found(self, job, data, nonce, noncediff):
+    record = None
+    slot = self._spool_share(job, data, noncediff)
+    if slot is not None: record = self.spool.read(slot)
     if self.nonce_found_async:
-      thread = Thread(None, self.nonce_found_thread, self.settings.name + "_nonce_found_" + hexlify(nonce).decode("ascii"), (job, data, nonce, noncediff))
+      thread = Thread(None, self.nonce_found_thread, self.settings.name + "_nonce_found_" + hexlify(nonce).decode("ascii"), (job, data, nonce, noncediff, record))
       thread.daemon = True
       thread.start()
-    else: self.nonce_found_thread(job, data, nonce, noncediff)
+    else: self.nonce_found_thread(job, data, nonce, noncediff, record)
 
     
-  def nonce_found_thread(self, job, data, nonce, noncediff):
+  def nonce_found_thread(self, job, data, nonce, noncediff, record = None):
     tries = 0
     while True:
+      if record:
+        reason = self._is_share_stale(data, record.expiry)
+        if reason: return self._expire_share(record, nonce, noncediff, reason)
       try:
         result = self._nonce_found(job, data, nonce, noncediff)
         self._handle_success()
+        if record: record.spool.complete(record.slot)
+        if not job: return self._spooled_share_handled(nonce, noncediff, record.difficulty, result)
         return job.nonce_handled_callback(nonce, noncediff, result)
       except:
         self.core.log(self, "Error while sending share %s (difficulty %.5f): %s\n" % (hexlify(nonce).decode("ascii"), noncediff, traceback.format_exc()), 200, "y")
         tries += 1
         self._handle_error(True)
         time.sleep(min(30, tries))
-        
\ No newline at end of file
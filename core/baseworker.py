@@ -27,6 +27,7 @@
 
 
 import time
+import traceback
 from threading import RLock, Thread
 from .util import Bunch
 from .statistics import StatisticsProvider
@@ -69,26 +70,22 @@ class BaseWorker(StatisticsProvider, Startable, Inflatable):
     self.jobs_per_second = 0
     self.parallel_jobs = 0
     self.stats.starttime = time.time()
-    self.stats.ghashes = 0
     self.stats.mhps = 0
-    self.stats.jobsaccepted = 0
-    self.stats.jobscanceled = 0
-    self.stats.sharesaccepted = 0
-    self.stats.sharesrejected = 0
-    self.stats.sharesinvalid = 0
+    # Hashes, jobs and shares are counted by the jobs, see StripedCounters
+    self.counters.reset()
     
     
   def _get_statistics(self, stats, childstats):
     StatisticsProvider._get_statistics(self, stats, childstats)
     stats.starttime = self.stats.starttime
-    stats.ghashes = self.stats.ghashes + childstats.calculatefieldsum("ghashes")
+    stats.ghashes = self.counters.get("ghashes") + childstats.calculatefieldsum("ghashes")
     stats.avgmhps = 1000. * stats.ghashes / (time.time() - stats.starttime)
     stats.mhps = self.stats.mhps + childstats.calculatefieldsum("mhps")
-    stats.jobsaccepted = self.stats.jobsaccepted + childstats.calculatefieldsum("jobsaccepted")
-    stats.jobscanceled = self.stats.jobscanceled + childstats.calculatefieldsum("jobscanceled")
-    stats.sharesaccepted = self.stats.sharesaccepted + childstats.calculatefieldsum("sharesaccepted")
-    stats.sharesrejected = self.stats.sharesrejected + childstats.calculatefieldsum("sharesrejected")
-    stats.sharesinvalid = self.stats.sharesinvalid + childstats.calculatefieldsum("sharesinvalid")
+    stats.jobsaccepted = self.counters.get("jobsaccepted") + childstats.calculatefieldsum("jobsaccepted")
+    stats.jobscanceled = self.counters.get("jobscanceled") + childstats.calculatefieldsum("jobscanceled")
+    stats.sharesaccepted = self.counters.get("sharesaccepted") + childstats.calculatefieldsum("sharesaccepted")
+    stats.sharesrejected = self.counters.get("sharesrejected") + childstats.calculatefieldsum("sharesrejected")
+    stats.sharesinvalid = self.counters.get("sharesinvalid") + childstats.calculatefieldsum("sharesinvalid")
     stats.parallel_jobs = self.parallel_jobs + childstats.calculatefieldsum("parallel_jobs")
     stats.current_job = self.job
     stats.current_work_source = getattr(stats.current_job, "worksource", None) if stats.current_job else None
@@ -96,6 +93,14 @@ class BaseWorker(StatisticsProvider, Startable, Inflatable):
     stats.current_work_source_name = stats.current_work_source.settings.name if stats.current_work_source else None
     
     
+  def notify_canceled_batch(self, jobs, graceful):
+    # Called once per worker for all of its jobs that were canceled at the same time.
+    # Worker modules can override this to avoid taking their locks once per job.
+    for job in jobs:
+      try: self.notify_canceled(job, graceful)
+      except: self.core.log(self, "Exception while canceling job: %s" % (traceback.format_exc()), 100, "r")
+
+
   def get_jobs_per_second(self):
     result = self.jobs_per_second
     for child in self.children: result += child.get_jobs_per_second()
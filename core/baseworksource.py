@@ -27,6 +27,7 @@
 
 
 import time
+from collections import OrderedDict
 from threading import RLock
 from .util import Bunch
 from .statistics import StatisticsProvider
@@ -47,11 +48,13 @@ class BaseWorkSource(StatisticsProvider, Startable, Inflatable):
 
 
   def __init__(self, core, state = None):
+    self.parent = None
+    # Scheduling state of this work source in the groups above it, by scheduler
+    self.schedulers = {}
     StatisticsProvider.__init__(self)
     Inflatable.__init__(self, core, state)
     Startable.__init__(self)
 
-    self.parent = None
     self.statelock = RLock()
     
     
@@ -67,41 +70,41 @@ class BaseWorkSource(StatisticsProvider, Startable, Inflatable):
     if not "enabled" in self.settings: self.settings.enabled = True
     if not "hashrate" in self.settings: self.settings.hashrate = 0
     if not "priority" in self.settings: self.settings.priority = 1
+    if self.parent: self.parent.invalidate_schedule()
     
     
   def _reset(self):
     self.core.event(300, self, "reset", None, "Resetting work source state", worksource = self)
     Startable._reset(self)
-    self.mhashes_pending = 0
-    self.mhashes_deferred = 0
     self.stats.starttime = time.time()
-    self.stats.ghashes = 0
     self.stats.jobrequests = 0
     self.stats.failedjobreqs = 0
     self.stats.uploadretries = 0
     self.stats.jobsreceived = 0
-    self.stats.jobsaccepted = 0
-    self.stats.jobscanceled = 0
-    self.stats.sharesaccepted = 0
-    self.stats.sharesrejected = 0
     self.stats.difficulty = 0
-    self.jobs = []
+    # Hashes, jobs and shares are counted by the jobs, see StripedCounters
+    self.counters.reset()
+    self.jobs = OrderedDict()
     
     
   def _get_statistics(self, stats, childstats):
     StatisticsProvider._get_statistics(self, stats, childstats)
     stats.starttime = self.stats.starttime
-    stats.ghashes = self.stats.ghashes + childstats.calculatefieldsum("ghashes")
-    stats.avgmhps = 1000. * self.stats.ghashes / (time.time() - stats.starttime) + childstats.calculatefieldsum("avgmhps")
+    ghashes = self.counters.get("ghashes")
+    stats.ghashes = ghashes + childstats.calculatefieldsum("ghashes")
+    stats.avgmhps = 1000. * ghashes / (time.time() - stats.starttime) + childstats.calculatefieldsum("avgmhps")
     stats.jobrequests = self.stats.jobrequests + childstats.calculatefieldsum("jobrequests")
     stats.failedjobreqs = self.stats.failedjobreqs + childstats.calculatefieldsum("failedjobreqs")
     stats.uploadretries = self.stats.uploadretries + childstats.calculatefieldsum("uploadretries")
     stats.jobsreceived = self.stats.jobsreceived + childstats.calculatefieldsum("jobsreceived")
-    stats.jobsaccepted = self.stats.jobsaccepted + childstats.calculatefieldsum("jobsaccepted")
-    stats.jobscanceled = self.stats.jobscanceled + childstats.calculatefieldsum("jobscanceled")
-    stats.sharesaccepted = self.stats.sharesaccepted + childstats.calculatefieldsum("sharesaccepted")
-    stats.sharesrejected = self.stats.sharesrejected + childstats.calculatefieldsum("sharesrejected")
+    stats.jobsaccepted = self.counters.get("jobsaccepted") + childstats.calculatefieldsum("jobsaccepted")
+    stats.jobscanceled = self.counters.get("jobscanceled") + childstats.calculatefieldsum("jobscanceled")
+    stats.sharesaccepted = self.counters.get("sharesaccepted") + childstats.calculatefieldsum("sharesaccepted")
+    stats.sharesrejected = self.counters.get("sharesrejected") + childstats.calculatefieldsum("sharesrejected")
     stats.difficulty = self.stats.difficulty
+    # How fast this work source delivers usable work compared to the others, if a group cares
+    scores = [entry.score for entry in list(self.schedulers.values()) if entry.score is not None]
+    stats.selection_score = scores[0] if scores else None
     
     
   def set_parent(self, parent = None):
@@ -113,29 +116,29 @@ class BaseWorkSource(StatisticsProvider, Startable, Inflatable):
 
     
   def add_job(self, job):
-    if not job in self.jobs: self.jobs.append(job)
+    self.jobs[job] = True
   
 
   def remove_job(self, job):
-    while job in self.jobs: self.jobs.remove(job)
+    self.jobs.pop(job, None)
 
 
   def _cancel_jobs(self, graceful = False):
     cancel = []
-    with self.core.workqueue.lock:
-      while self.jobs:
-        job = self.jobs.pop(0)
+    with self.core.workqueue.get_shard(self.blockchain).lock:
+      jobs = list(self.jobs)
+      self.jobs = OrderedDict()
+      for job in jobs:
         if job.worker: cancel.append(job)
         else: job.destroy()
-    if not graceful: self.jobs = []
     self.core.workqueue.cancel_jobs(cancel, graceful)
   
 
   def add_pending_mhashes(self, mhashes):
-    with self.statelock: self.mhashes_pending += mhashes
-    if self.parent: self.parent.add_pending_mhashes(mhashes)
+    # Negative for hashes that were handed out, positive for hashes that were given back unused
+    for scheduler, entry in list(self.schedulers.items()): scheduler.charge(entry, -mhashes)
+
 
-    
   def add_deferred_mhashes(self, mhashes):
-    with self.statelock: self.mhashes_deferred += mhashes
-    if self.parent: self.parent.add_deferred_mhashes(mhashes)
+    # Charges hashes for stale work, which are given back over time
+    for scheduler, entry in list(self.schedulers.items()): scheduler.defer(entry, mhashes)
@@ -27,6 +27,7 @@
 
 
 import time
+from collections import OrderedDict
 from threading import RLock
 from .util import Bunch
 from .statistics import StatisticsProvider, StatisticsList
@@ -80,12 +81,20 @@ class Blockchain(StatisticsProvider, Startable, Inflatable):
     self.core.event(300, self, "reset", None, "Resetting blockchain state", blockchain = self)
     Startable._reset(self)
     self.currentprevhash = None
-    self.knownprevhashes = []
-    self.timeoutend = 0
-    self.jobs = []
+    # The block before the current one is remembered until the next block change, older ones
+    # by when any work source last delivered work for them, least recent first
+    self.previousprevhash = None
+    self.knownprevhashes = OrderedDict()
+    self.jobs = OrderedDict()
+    # When each of the recent blocks was first announced by any work source
+    self.announcements = OrderedDict()
     self.stats.starttime = time.time()
     self.stats.blocks = 0
     self.stats.lastblock = None
+    self.stats.cancellatency = 0
+    self.stats.maxcancellatency = 0
+    self.stats.totalcancellatency = 0
+    self.stats.canceledblocks = 0
 
     
   def _get_statistics(self, stats, childstats):
@@ -93,6 +102,9 @@ class Blockchain(StatisticsProvider, Startable, Inflatable):
     stats.starttime = self.stats.starttime
     stats.blocks = self.stats.blocks
     stats.lastblock = self.stats.lastblock
+    stats.cancellatency = self.stats.cancellatency
+    stats.maxcancellatency = self.stats.maxcancellatency
+    stats.avgcancellatency = self.stats.totalcancellatency / self.stats.canceledblocks if self.stats.canceledblocks else 0
     stats.ghashes = childstats.calculatefieldsum("ghashes")
     stats.avgmhps = childstats.calculatefieldsum("avgmhps")
     stats.jobsreceived = childstats.calculatefieldsum("jobsreceived")
@@ -104,11 +116,22 @@ class Blockchain(StatisticsProvider, Startable, Inflatable):
     
     
   def add_job(self, job):
-    if not job in self.jobs: self.jobs.append(job)
+    self.jobs[job] = True
   
 
   def remove_job(self, job):
-    while job in self.jobs: self.jobs.remove(job)
+    self.jobs.pop(job, None)
+
+
+  def announce_block(self, prevhash, timestamp):
+    # Called by the work sources when they hand out work for a new block for the first time.
+    # Returns how long after the first work source that announced it this happened.
+    with self.blocklock:
+      first = self.announcements.get(prevhash)
+      if first is not None: return timestamp - first
+      self.announcements[prevhash] = timestamp
+      while len(self.announcements) > 32: self.announcements.popitem(False)
+      return 0
 
 
   def add_work_source(self, worksource):
@@ -121,28 +144,42 @@ class Blockchain(StatisticsProvider, Startable, Inflatable):
       while worksource in self.children: self.children.remove(worksource)
 
 
+  def _cancel_done(self, latency):
+    with self.stats.lock:
+      self.stats.cancellatency = latency
+      self.stats.maxcancellatency = max(self.stats.maxcancellatency, latency)
+      self.stats.totalcancellatency += latency
+      self.stats.canceledblocks += 1
+
+
   def check_job(self, job):
     if self.currentprevhash == job.prevhash: return True
     cancel = []
     with self.blocklock:
       now = time.time()
-      timeout_expired = now > self.timeoutend
-      self.timeoutend = now + self.settings.timeout
-      if job.prevhash in self.knownprevhashes: return False
-      if timeout_expired: self.knownprevhashes = [self.currentprevhash]
-      else: self.knownprevhashes.append(self.currentprevhash)
+      known = self.knownprevhashes
+      while known and next(iter(known.values())) < now - self.settings.timeout: known.popitem(False)
+      if job.prevhash == self.previousprevhash: return False
+      if job.prevhash in known:
+        # Stale work, the block is remembered for as long as work for it keeps coming in
+        del known[job.prevhash]
+        known[job.prevhash] = now
+        return False
+      if self.previousprevhash is not None: known[self.previousprevhash] = now
+      while len(known) > 32: known.popitem(False)
+      self.previousprevhash = self.currentprevhash
       self.currentprevhash = job.prevhash
-      with self.core.workqueue.lock:
-        while self.jobs:
-          job = self.jobs.pop(0)
+      with self.core.workqueue.get_shard(self).lock:
+        jobs = list(self.jobs)
+        self.jobs = OrderedDict()
+        for job in jobs:
           if job.worker: cancel.append(job)
           else: job.destroy()
-      self.jobs = []
       with self.stats.lock:
         self.stats.blocks += 1
         self.stats.lastblock = now
     self.core.log(self, "New block detected\n", 300, "B")
-    self.core.workqueue.cancel_jobs(cancel)
+    self.core.workqueue.cancel_jobs(cancel, callback = self._cancel_done)
     return True
  
 
@@ -155,22 +192,27 @@ class DummyBlockchain(object):
     self.id = 0
     self.settings = Bunch(name = "Dummy blockchain")
     
-    # Initialize job list (protected by global job queue lock)
-    self.jobs = []
+    # Initialize job set (protected by our work queue shard lock)
+    self.jobs = OrderedDict()
     self.currentprevhash = None
-    self.knownprevhashes = []
-    self.timeoutend = 0
+    self.previousprevhash = None
+    self.knownprevhashes = OrderedDict()
     self.blocklock = RLock()
     
     
   def add_job(self, job):
-    if not job in self.jobs: self.jobs.append(job)
+    self.jobs[job] = True
   
 
   def remove_job(self, job):
-    while job in self.jobs: self.jobs.remove(job)
+    self.jobs.pop(job, None)
     
     
+  def announce_block(self, prevhash, timestamp):
+    # Work sources without a block chain can't be compared to anything
+    return None
+
+
   def add_work_source(self, worksource):
     pass
 
@@ -184,18 +226,24 @@ class DummyBlockchain(object):
     cancel = []
     with self.blocklock:
       now = time.time()
-      timeout_expired = now > self.timeoutend
-      self.timeoutend = now + 10
-      if job.prevhash in self.knownprevhashes: return False
-      if timeout_expired: self.knownprevhashes = [self.currentprevhash]
-      else: self.knownprevhashes.append(self.currentprevhash)
+      known = self.knownprevhashes
+      while known and next(iter(known.values())) < now - 10: known.popitem(False)
+      if job.prevhash == self.previousprevhash: return False
+      if job.prevhash in known:
+        # Stale work, the block is remembered for as long as work for it keeps coming in
+        del known[job.prevhash]
+        known[job.prevhash] = now
+        return False
+      if self.previousprevhash is not None: known[self.previousprevhash] = now
+      while len(known) > 32: known.popitem(False)
+      self.previousprevhash = self.currentprevhash
       self.currentprevhash = job.prevhash
-      with self.core.workqueue.lock:
-        while self.jobs:
-          job = self.jobs.pop(0)
+      with self.core.workqueue.get_shard(self).lock:
+        jobs = list(self.jobs)
+        self.jobs = OrderedDict()
+        for job in jobs:
           if job.worker: cancel.append(job)
           else: job.destroy()
-      self.jobs = []
     self.core.log(self, "New block detected\n", 300, "B")
     self.core.workqueue.cancel_jobs(cancel)
     return True
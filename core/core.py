@@ -33,7 +33,7 @@ import pickle
 import traceback
 from datetime import datetime
 from threading import RLock, Thread, current_thread
-from .statistics import StatisticsList
+from .statistics import Statistics, StatisticsList, StripedCounters
 from .inflatable import Inflatable
 from .startable import Startable
 from .util import Bunch
@@ -93,10 +93,10 @@ class Core(Startable):
 
     # Load modules
     self.log(self, "Loading modules...\n", 500, "B")
-    # Grrr. Python is just broken...
-    import __main__
-    basepath = os.path.dirname(__main__.__file__)
-    basepath = (basepath if basepath else ".") + "/modules"
+    # The modules directory lives next to the core package. Don't derive this from
+    # __main__, so that the core can also be driven by tools like the benchmarks.
+    basepath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    basepath = basepath + "/modules"
     for maintainer in os.listdir(basepath):
       maintainerpath = basepath + "/" + maintainer
       if os.path.isdir(maintainerpath) and os.path.isfile(maintainerpath + "/__init__.py"):
@@ -137,6 +137,10 @@ class Core(Startable):
     from .fetcher import Fetcher
     self.fetcher = Fetcher(self)
 
+    # Initialize HTTP connection pool
+    from .httppool import HTTPPool
+    self.httppool = HTTPPool(self)
+
     # Read saved instance state
     self.event(100, self, "loading_config", None, "Loading configuration")
     try:
@@ -154,6 +158,12 @@ class Core(Startable):
         for blockchain in state.blockchains:
           self.add_blockchain(Inflatable.inflate(self, blockchain))
       self.root_work_source = Inflatable.inflate(self, state.root_work_source)
+      if "fetcher" in state:
+        self.fetcher.settings.update(state.fetcher)
+        self.fetcher.apply_settings()
+      if "httppool" in state:
+        self.httppool.settings.update(state.httppool)
+        self.httppool.apply_settings()
       self.event(100, self, "loaded_config", None, "Successfully loaded configuration")
     except Exception as e:
       self.event(100, self, "loading_config_failed", None, "Loading configuration failed")
@@ -188,6 +198,8 @@ class Core(Startable):
         state.workers.append(worker.deflate())
       if not self.root_work_source: state.root_work_source = None
       else: state.root_work_source = self.root_work_source.deflate()
+      state.fetcher = self.fetcher.settings
+      state.httppool = self.httppool.settings
       data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
       if not os.path.exists("config"): os.mkdir("config")
       with open("config/%s.cfg" % self.instance, "wb") as f:
@@ -205,7 +217,7 @@ class Core(Startable):
     # Reset total calculated hashes and uptime
     self.stats = Bunch()
     self.stats.starttime = time.time()
-    self.stats.ghashes = 0
+    self.counters = StripedCounters()
 
 
   def _start(self):
@@ -314,6 +326,9 @@ class Core(Startable):
         self.root_work_source.stop()
       except Exception as e:
         self.log(self, "Could not stop root work source %s: %s\n" % (self.root_work_source.settings.name, traceback.format_exc()), 100, "rB")
+
+    # Close idle HTTP connections
+    self.httppool.close()
     
     # Shut down blockchains
     self.log(self, "Shutting down blockchains...\n", 700)
@@ -468,6 +483,12 @@ class Core(Startable):
     return self.workqueue.get_job(worker, expiry_min_ahead, async)
     
     
+  def get_core_statistics(self):
+    stats = Statistics(obj = self, starttime = self.stats.starttime, ghashes = self.counters.get("ghashes"))
+    stats.avgmhps = 1000. * stats.ghashes / (time.time() - stats.starttime)
+    return stats
+    
+    
   def get_blockchain_statistics(self):
     stats = StatisticsList()
     for blockchain in self.blockchains: stats.append(blockchain.get_statistics())
@@ -486,6 +507,14 @@ class Core(Startable):
     return stats
     
     
+  def get_fetcher_statistics(self):
+    return self.fetcher.get_statistics()
+
+
+  def get_httppool_statistics(self):
+    return self.httppool.get_statistics()
+    
+    
   def notify_speed_changed(self, worker):
     return self.fetcher.notify_speed_changed(worker)
     
@@ -501,7 +530,8 @@ class Core(Startable):
     del self.logbuf[thread]
 
     
-  def log_multi(self, source, loglevel, messages, timestamp = datetime.now()):
+  def log_multi(self, source, loglevel, messages, timestamp = None):
+    if not timestamp: timestamp = datetime.now()
     # Put message into the queue, will be pushed to listeners by a worker thread
     self.logqueue.put((source, timestamp, loglevel, messages))
     
@@ -535,7 +565,9 @@ class Core(Startable):
       self.logqueue.task_done()
 
 
-  def event(self, level, source, event, arg, message = None, worker = None, worksource = None, blockchain = None, job = None, timestamp = datetime.now()):
+  def event(self, level, source, event, arg, message = None, worker = None, worksource = None, blockchain = None, job = None, timestamp = None):
+    # The default timestamp must be taken here, a default argument would be evaluated only once
+    if not timestamp: timestamp = datetime.now()
     self.eventqueue.put((level, source, event, arg, message, worker, worksource, blockchain, job, timestamp))
 
 
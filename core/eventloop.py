@@ -0,0 +1,440 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+#############################################
+# Shared network event loop and HTTP client #
+#############################################
+
+
+
+import time
+import heapq
+import errno
+import socket
+import select
+import traceback
+from collections import deque
+from threading import Thread, RLock, current_thread
+from .util import Bunch
+
+
+
+# Error codes that just mean "try again later" on a non-blocking socket (10035 is WSAEWOULDBLOCK)
+_pending = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN, errno.EALREADY, 10035)
+
+
+
+def _socketpair():
+  try: return socket.socketpair()
+  except:
+    # Windows doesn't have socketpair() on older python versions, connect through the loopback interface
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, address = listener.accept()
+    listener.close()
+    return server, client
+
+
+
+class EventLoop(object):
+  # Multiplexes the socket I/O of all work sources that use it on a single thread.
+  # All callbacks are executed on the event loop thread and must not block.
+
+  instance = None
+  instancelock = RLock()
+
+
+  @classmethod
+  def acquire(cls, core):
+    # Get a reference to the shared event loop, starting it up if neccessary
+    with cls.instancelock:
+      if not cls.instance: cls.instance = cls(core)
+      cls.instance.users += 1
+      if cls.instance.users == 1: cls.instance.start()
+      return cls.instance
+
+
+  def release(self):
+    # Drop a reference to the shared event loop, shutting it down if it isn't used anymore
+    with self.instancelock:
+      self.users -= 1
+      if not self.users: self.stop()
+
+
+  def __init__(self, core):
+    self.core = core
+    self.settings = Bunch(name = "Event loop")
+    self.users = 0
+    self.lock = RLock()
+    self.thread = None
+    self.shutdown = False
+    self.readers = set()
+    self.writers = set()
+    self.timers = []
+    self.timerseq = 0
+    self.calls = deque()
+    self.wakeup_r, self.wakeup_w = _socketpair()
+    self.wakeup_r.setblocking(False)
+    self.wakeup_w.setblocking(False)
+
+
+  def start(self):
+    self.shutdown = False
+    self.thread = Thread(None, self.run, "event_loop")
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  def stop(self):
+    self.shutdown = True
+    self._wakeup()
+    if self.thread and self.thread != current_thread(): self.thread.join(5)
+    self.thread = None
+
+
+  def _wakeup(self):
+    try: self.wakeup_w.send(b"\0")
+    except: pass
+
+
+  def call_soon(self, callback, *args):
+    # May be called from any thread
+    self.calls.append((callback, args))
+    if current_thread() != self.thread: self._wakeup()
+
+
+  def call_later(self, delay, callback, *args):
+    # May be called from any thread, returns a handle that can be passed to cancel_timer
+    with self.lock:
+      self.timerseq += 1
+      timer = [time.time() + delay, self.timerseq, callback, args]
+      heapq.heappush(self.timers, timer)
+    if current_thread() != self.thread: self._wakeup()
+    return timer
+
+
+  def cancel_timer(self, timer):
+    # Timers are removed lazily when they reach the top of the heap
+    timer[2] = None
+
+
+  def set_interest(self, handler, read, write):
+    # Only call this from the event loop thread
+    if read: self.readers.add(handler)
+    else: self.readers.discard(handler)
+    if write: self.writers.add(handler)
+    else: self.writers.discard(handler)
+
+
+  def _dispatch(self, callback, *args):
+    try: callback(*args)
+    except: self.core.log(self, "Exception in event handler: %s\n" % traceback.format_exc(), 100, "r")
+
+
+  def run(self):
+    while not self.shutdown:
+      timeout = None
+      with self.lock:
+        while self.timers and not self.timers[0][2]: heapq.heappop(self.timers)
+        if self.timers: timeout = max(0, self.timers[0][0] - time.time())
+      if self.calls: timeout = 0
+      try: readable, writable, dummy = select.select([self.wakeup_r] + list(self.readers), list(self.writers), [], timeout)
+      except select.error as e:
+        if e.args[0] == errno.EINTR: continue
+        raise
+      if self.wakeup_r in readable:
+        try:
+          while self.wakeup_r.recv(4096): pass
+        except: pass
+      # A handler may unregister another one, so check that it is still interested
+      for handler in writable:
+        if handler in self.writers: self._dispatch(handler.handle_write)
+      for handler in readable:
+        if handler in self.readers: self._dispatch(handler.handle_read)
+      now = time.time()
+      while True:
+        with self.lock:
+          if not self.timers or self.timers[0][0] > now: break
+          timer = heapq.heappop(self.timers)
+        if timer[2]: self._dispatch(timer[2], *timer[3])
+      # Don't run calls that are queued by these calls in this iteration, socket events would starve
+      for i in range(len(self.calls)):
+        callback, args = self.calls.popleft()
+        self._dispatch(callback, *args)
+
+
+
+class HTTPResponse(object):
+  # Mimics the parts of http.client.HTTPResponse that the work sources use
+
+
+  def __init__(self, version, status, reason, headers):
+    self.version = version
+    self.status = status
+    self.reason = reason
+    self.headers = headers
+    self.data = b""
+
+
+  def getheaders(self):
+    return self.headers
+
+
+  def getheader(self, name, default = None):
+    name = name.lower()
+    for header in self.headers:
+      if header[0].lower() == name: return header[1]
+    return default
+
+
+
+class HTTPConnection(object):
+  # A non-blocking keep-alive HTTP/1.1 client connection that is driven by an EventLoop.
+  # Only one request can be in flight at a time. When it finishes, callback(response, error)
+  # will be called on the event loop thread with exactly one of the two being None.
+
+
+  def __init__(self, loop, host, port):
+    self.loop = loop
+    self.host = host
+    self.port = port
+    self.sock = None
+    self.fd = None
+    self.closed = False
+    self.callback = None
+    self.timer = None
+    self.reused = False
+    self.response = None
+    self.recvbuf = b""
+
+
+  def fileno(self):
+    return self.fd
+
+
+  def request(self, method, path, body, headers, callback, timeout, responsetimeout = None):
+    # May be called from any thread. The timeout applies to connecting and sending the request,
+    # responsetimeout (which defaults to the timeout) to receiving the response.
+    if body is None: body = b""
+    lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s:%d" % (self.host, self.port)]
+    for name, value in headers.items():
+      if name.lower() != "content-length": lines.append("%s: %s" % (name, value))
+    if body or method == "POST": lines.append("Content-Length: %d" % len(body))
+    request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin_1") + body
+    if responsetimeout is None: responsetimeout = timeout
+    self.loop.call_soon(self._begin, request, callback, timeout, responsetimeout)
+
+
+  def close(self):
+    # May be called from any thread. Abandons a running request without calling its callback.
+    self.closed = True
+    self.loop.call_soon(self._abort)
+
+
+  def _abort(self):
+    if self.timer: self.loop.cancel_timer(self.timer)
+    self.timer = None
+    self.callback = None
+    self._disconnect()
+
+
+  def _begin(self, request, callback, timeout, responsetimeout):
+    if self.closed: return
+    self.request_data = request
+    self.callback = callback
+    self.responsetimeout = responsetimeout
+    self._set_timer(timeout)
+    self.retried = False
+    self.reused = False
+    self.response = None
+    self.recvbuf = b""
+    if self.sock: self._send_request(True)
+    else: self._connect()
+
+
+  def _set_timer(self, timeout):
+    if self.timer: self.loop.cancel_timer(self.timer)
+    self.timer = self.loop.call_later(timeout, self._timed_out)
+
+
+  def _timed_out(self):
+    self.timer = None
+    self._fail(socket.timeout("HTTP request timed out"))
+
+
+  def _connect(self):
+    # Numeric addresses can be resolved right away, DNS lookups need to happen on a separate thread
+    try: addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM, 0, socket.AI_NUMERICHOST)
+    except socket.gaierror:
+      callback = self.callback
+      thread = Thread(None, self._resolve, "resolve_%s" % self.host, (callback,))
+      thread.daemon = True
+      thread.start()
+      return
+    self._resolved(self.callback, addresses, None)
+
+
+  def _resolve(self, callback):
+    try: self.loop.call_soon(self._resolved, callback, socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM), None)
+    except Exception as e: self.loop.call_soon(self._resolved, callback, None, e)
+
+
+  def _resolved(self, callback, addresses, error):
+    # Ignore the result if the request timed out or was aborted in the meantime
+    if callback is not self.callback or not callback: return
+    if error: return self._fail(error)
+    family, socktype, proto, canonname, address = addresses[0]
+    try:
+      self.sock = socket.socket(family, socktype, proto)
+      self.fd = self.sock.fileno()
+      self.sock.setblocking(False)
+      self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      error = self.sock.connect_ex(address)
+      if error and not error in _pending: raise socket.error(error, "Could not connect to %s:%d" % (self.host, self.port))
+    except Exception as e: return self._fail(e)
+    self.state = "connecting"
+    self.loop.set_interest(self, False, True)
+
+
+  def _send_request(self, reused):
+    self.reused = reused
+    self.state = "sending"
+    self.sendbuf = self.request_data
+    self.recvbuf = b""
+    self.response = None
+    self.handle_write()
+
+
+  def handle_write(self):
+    try:
+      if self.state == "connecting":
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error: raise socket.error(error, "Could not connect to %s:%d" % (self.host, self.port))
+        return self._send_request(False)
+      while self.sendbuf:
+        try: sent = self.sock.send(self.sendbuf)
+        except socket.error as e:
+          if e.args[0] in _pending:
+            self.loop.set_interest(self, False, True)
+            return
+          raise
+        self.sendbuf = self.sendbuf[sent:]
+      self.state = "receiving"
+      self._set_timer(self.responsetimeout)
+      self.loop.set_interest(self, True, False)
+    except Exception as e: self._fail(e, True)
+
+
+  def handle_read(self):
+    try:
+      try: data = self.sock.recv(65536)
+      except socket.error as e:
+        if e.args[0] in _pending: return
+        raise
+      if not data:
+        # Connection closed. This terminates the body if the server didn't announce its length.
+        if self.response and self.length is None: return self._finish(False)
+        raise socket.error(errno.ECONNRESET, "Connection closed by server")
+      self.recvbuf += data
+      self._parse()
+    except Exception as e: self._fail(e, True)
+
+
+  def _parse(self):
+    if not self.response:
+      end = self.recvbuf.find(b"\r\n\r\n")
+      if end < 0: return
+      lines = self.recvbuf[:end].decode("latin_1").split("\r\n")
+      self.recvbuf = self.recvbuf[end + 4:]
+      parts = lines[0].split(" ", 2)
+      if len(parts) < 2 or parts[0][:5] != "HTTP/": raise Exception("Invalid HTTP status line: %s" % lines[0])
+      headers = []
+      for line in lines[1:]:
+        name, value = line.split(":", 1)
+        headers.append((name.strip(), value.strip()))
+      self.response = HTTPResponse(parts[0], int(parts[1]), parts[2] if len(parts) > 2 else "", headers)
+      connection = self.response.getheader("connection", "").lower()
+      if parts[0] == "HTTP/1.0": self.keepalive = connection == "keep-alive"
+      else: self.keepalive = connection != "close"
+      self.chunked = self.response.getheader("transfer-encoding", "").lower() == "chunked"
+      self.length = self.response.getheader("content-length")
+      if self.length is not None: self.length = int(self.length)
+      elif self.chunked: self.chunks = []
+      else: self.keepalive = False
+    if self.chunked: self._parse_chunks()
+    elif self.length is not None and len(self.recvbuf) >= self.length:
+      self.response.data = self.recvbuf[:self.length]
+      self._finish(self.keepalive)
+
+
+  def _parse_chunks(self):
+    while True:
+      end = self.recvbuf.find(b"\r\n")
+      if end < 0: return
+      size = int(self.recvbuf[:end].split(b";", 1)[0], 16)
+      if not size:
+        # Wait for the (usually empty) trailer to arrive
+        if self.recvbuf.find(b"\r\n\r\n", end) < 0: return
+        self.response.data = b"".join(self.chunks)
+        return self._finish(self.keepalive)
+      if len(self.recvbuf) < end + size + 4: return
+      self.chunks.append(self.recvbuf[end + 2 : end + 2 + size])
+      self.recvbuf = self.recvbuf[end + size + 4:]
+
+
+  def _finish(self, keepalive):
+    if self.length is None and not self.chunked: self.response.data = self.recvbuf
+    if not keepalive: self._disconnect()
+    else:
+      self.state = "idle"
+      self.loop.set_interest(self, False, False)
+    self._complete(self.response, None)
+
+
+  def _fail(self, error, retry = False):
+    # A keep-alive connection may have been closed by the server while it was idle.
+    # Retry once on a fresh connection if nothing was received from the server yet.
+    retry = retry and self.reused and not self.retried and not self.response and not self.recvbuf and self.callback
+    self._disconnect()
+    if retry:
+      self.retried = True
+      return self._connect()
+    self._complete(None, error)
+
+
+  def _complete(self, response, error):
+    if self.timer: self.loop.cancel_timer(self.timer)
+    self.timer = None
+    callback = self.callback
+    self.callback = None
+    if callback: callback(response, error)
+
+
+  def _disconnect(self):
+    if not self.sock: return
+    self.loop.set_interest(self, False, False)
+    try: self.sock.close()
+    except: pass
+    self.sock = None
+    self.reused = False
@@ -26,17 +26,22 @@
 
 
 
+import math
 import time
 import traceback
 from threading import RLock, Condition, Thread, current_thread
 from .startable import Startable
+from .statistics import Statistics
 from .util import Bunch
 
 
 
 class Fetcher(Startable):
 
-  
+  # Selected by state.fetcher.controller in the saved configuration
+  controllers = ["legacy", "predictive"]
+
+
   def __init__(self, core):
     self.core = core
     self.id = -2
@@ -46,13 +51,30 @@ class Fetcher(Startable):
     self.lock = Condition()
     # Fetcher controller thread
     self.controllerthread = None
+    self.apply_settings()
     
     
+  def apply_settings(self):
+    if not "controller" in self.settings or not self.settings.controller in self.controllers:
+      self.settings.controller = "legacy"
+    if self.started: self.wakeup()
+
+
   def _reset(self):
     self.core.event(300, self, "reset", None, "Resetting fetcher state")
     super(Fetcher, self)._reset()
     self.speedchanged = True
     self.queuetarget = 5
+    # State of the predictive controller
+    self.jobspersecond = 0
+    self.paralleljobs = 0
+    self.observedrate = 0
+    self.lastsample = time.time()
+    self.lasttaken = 0
+    self.estimated_latency = 0.5
+    self.estimated_jobs = 1.
+    self.estimated_lifetime = 60.
+
     
 
   def _start(self):
@@ -80,33 +102,108 @@ class Fetcher(Startable):
       self.lock.notify()
 
     
+  def notify_jobs_received(self, worksource, jobs, lifetime, latency = None):
+    # Feed the predictive controller's model with what a fetch actually delivered
+    with self.lock:
+      self.estimated_jobs = self.estimated_jobs * 0.9 + jobs * 0.1
+      self.estimated_lifetime = self.estimated_lifetime * 0.9 + lifetime * 0.1
+      if latency is not None: self.estimated_latency = self.estimated_latency * 0.9 + latency * 0.1
+
+
+  def get_consumption_rate(self):
+    # Jobs per second that the workers are expected to take from the queue
+    return max(self.jobspersecond, self.observedrate)
+
+
+  def get_statistics(self):
+    stats = Statistics()
+    stats.obj = self
+    stats.id = self.id
+    stats.name = self.settings.name
+    stats.controller = self.settings.controller
+    stats.queuetarget = self.queuetarget
+    stats.queuecount = self.core.workqueue.count
+    stats.consumption_rate = self.get_consumption_rate()
+    stats.fetch_latency = self.estimated_latency
+    stats.jobs_per_fetch = self.estimated_jobs
+    stats.job_lifetime = self.estimated_lifetime
+    queuestats = self.core.workqueue.stats
+    with queuestats.lock:
+      stats.jobstaken = queuestats.jobstaken
+      stats.jobsdiscarded = queuestats.jobsdiscarded
+      stats.idletime = queuestats.idletime
+      stats.starvations = queuestats.starvations
+    return stats
+
+
   def controllerloop(self):
     with self.lock:
       while not self.shutdown:
-        if self.speedchanged:
-          self.speedchanged = False
-          jobspersecond = 0
-          paralleljobs = 0
-          with self.core.workerlock:
-            for worker in self.core.workers:
-              jobspersecond += worker.get_jobs_per_second()
-              paralleljobs += worker.get_parallel_jobs()
-          self.queuetarget = max(5, paralleljobs * 2, jobspersecond * 30)
-        
-        worksource = self.core.get_root_work_source()
-        queuecount = self.core.workqueue.count
-        fetchercount = worksource.get_running_fetcher_count()
-        startfetchers = min(5, (self.queuetarget - queuecount) // 2 - fetchercount)
-        if startfetchers <= 0:
-          self.lock.wait()
-          continue
         try:
-          started = worksource.start_fetchers(startfetchers if self.core.workqueue.count * 4 < self.queuetarget else 1)
-          if not started:
-            self.lock.wait(0.1)
-            continue
-          lockout = time.time() + min(5, 4 * self.core.workqueue.count / self.queuetarget - 1)
-          while time.time() < lockout and self.core.workqueue.count > self.queuetarget / 4: self.lock.wait(0.1)
+          if self.settings.controller == "predictive": self._predictive_step()
+          else: self._legacy_step()
         except:
           self.core.log(self, "Error while starting fetcher thread: %s\n" % traceback.format_exc(), 100, "rB")
           time.sleep(1)
+
+
+  def _update_worker_demand(self):
+    if not self.speedchanged: return False
+    self.speedchanged = False
+    jobspersecond = 0
+    paralleljobs = 0
+    with self.core.workerlock:
+      for worker in self.core.workers:
+        jobspersecond += worker.get_jobs_per_second()
+        paralleljobs += worker.get_parallel_jobs()
+    self.jobspersecond = jobspersecond
+    self.paralleljobs = paralleljobs
+    return True
+
+
+  def _legacy_step(self):
+    if self._update_worker_demand():
+      self.queuetarget = max(5, self.paralleljobs * 2, self.jobspersecond * 30)
+    worksource = self.core.get_root_work_source()
+    queuecount = self.core.workqueue.count
+    fetchercount = worksource.get_running_fetcher_count()
+    startfetchers = min(5, (self.queuetarget - queuecount) // 2 - fetchercount)
+    if startfetchers <= 0:
+      self.lock.wait()
+      return
+    started = worksource.start_fetchers(startfetchers if self.core.workqueue.count * 4 < self.queuetarget else 1)
+    if not started:
+      self.lock.wait(0.1)
+      return
+    lockout = time.time() + min(5, 4 * self.core.workqueue.count / self.queuetarget - 1)
+    while time.time() < lockout and self.core.workqueue.count > self.queuetarget / 4: self.lock.wait(0.1)
+
+
+  def _predictive_step(self):
+    self._update_worker_demand()
+    # Measure how fast the workers are actually consuming jobs
+    now = time.time()
+    elapsed = now - self.lastsample
+    if elapsed >= 1:
+      taken = self.core.workqueue.stats.jobstaken
+      self.observedrate = self.observedrate * 0.8 + 0.2 * (taken - self.lasttaken) / elapsed
+      self.lasttaken = taken
+      self.lastsample = now
+    rate = self.get_consumption_rate()
+    # Keep enough jobs queued to bridge two fetch round trips (plus a second of slack),
+    # and enough to replace all parallel jobs at once after a block change,
+    # but don't queue more than the workers can consume before the jobs expire.
+    target = max(self.paralleljobs, rate * (2 * self.estimated_latency + 1))
+    target = min(target, max(self.paralleljobs, rate * self.estimated_lifetime * 0.75))
+    self.queuetarget = max(1, target)
+    # Jobs that the currently running fetchers will deliver count as queued
+    worksource = self.core.get_root_work_source()
+    queuecount = self.core.workqueue.count
+    jobsperfetch = max(1., self.estimated_jobs)
+    missing = self.queuetarget - queuecount - worksource.get_running_fetcher_count() * jobsperfetch
+    startfetchers = min(10, int(math.ceil(missing / jobsperfetch)))
+    if startfetchers <= 0:
+      # Re-evaluate at least once per second to keep track of the consumption rate
+      self.lock.wait(1)
+      return
+    if not worksource.start_fetchers(startfetchers): self.lock.wait(0.1)
@@ -0,0 +1,247 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+########################
+# HTTP connection pool #
+########################
+
+
+
+import time
+import errno
+import socket
+import select
+from threading import RLock
+from .statistics import Statistics
+from .util import Bunch
+try: import http.client as http_client
+except ImportError: import httplib as http_client
+
+
+
+class PooledHTTPConnection(http_client.HTTPConnection):
+  # Connects to the addresses that the pool resolved, but still sends the host name in the Host header
+
+
+  def __init__(self, key, addresses, timeout):
+    http_client.HTTPConnection.__init__(self, key[0], key[1], timeout = timeout)
+    self.key = key
+    self.addresses = addresses
+    self.lastused = time.time()
+    self.reused = False
+
+
+  def connect(self):
+    error = socket.error("No addresses for %s" % self.key[0])
+    for family, socktype, proto, canonname, address in self.addresses:
+      sock = None
+      try:
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(self.timeout)
+        sock.connect(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        return
+      except socket.error as e:
+        error = e
+        if sock: sock.close()
+    raise error
+
+
+
+class HTTPPool(object):
+
+  settings = {
+    "maxidle": {"title": "Idle connections kept per server", "type": "int", "position": 100},
+    "idletimeout": {"title": "Idle connection timeout", "type": "float", "position": 200},
+    "dnsttl": {"title": "DNS cache lifetime", "type": "float", "position": 300},
+  }
+
+
+  def __init__(self, core):
+    self.core = core
+    self.id = -4
+    self.settings = Bunch(name = "HTTP connection pool")
+    # Initialize pool lock, protects everything below
+    self.lock = RLock()
+    # Idle connections by (host, port, auth), most recently used last
+    self.idle = {}
+    # Resolved addresses by (host, port)
+    self.dnscache = {}
+    self.stats = Bunch(created = 0, reused = 0, evicted = 0, unhealthy = 0, failed = 0, dnslookups = 0, dnshits = 0)
+    self.apply_settings()
+
+
+  def apply_settings(self):
+    if not "maxidle" in self.settings or not self.settings.maxidle: self.settings.maxidle = 8
+    if not "idletimeout" in self.settings or not self.settings.idletimeout: self.settings.idletimeout = 30
+    if not "dnsttl" in self.settings or not self.settings.dnsttl: self.settings.dnsttl = 300
+
+
+  def get_statistics(self):
+    stats = Statistics()
+    stats.obj = self
+    stats.id = self.id
+    stats.name = self.settings.name
+    with self.lock:
+      stats.update(self.stats)
+      stats.idle = sum(len(idle) for idle in self.idle.values())
+      stats.dnsentries = len(self.dnscache)
+    connections = stats.created + stats.reused
+    stats.reuseratio = float(stats.reused) / connections if connections else None
+    return stats
+
+
+  def close(self):
+    # Drops all idle connections, connections that are in use aren't affected
+    with self.lock:
+      idle = self.idle
+      self.idle = {}
+    for connections in idle.values():
+      for conn in connections: conn.close()
+
+
+  def get(self, host, port, auth = None, timeout = 10, fresh = False):
+    # Returns a connection to host:port, preferably one that was used before.
+    # Connections are only shared between users that authenticate the same way.
+    key = (host, port, auth)
+    now = time.time()
+    conn = None
+    if not fresh:
+      with self.lock:
+        idle = self.idle.get(key, [])
+        while idle and not conn:
+          conn = idle.pop()
+          if now - conn.lastused > self.settings.idletimeout:
+            self.stats.evicted += 1
+            conn.close()
+            conn = None
+          elif not HTTPPool._is_healthy(conn):
+            self.stats.unhealthy += 1
+            conn.close()
+            conn = None
+        if conn: self.stats.reused += 1
+    if conn:
+      conn.reused = True
+      conn.timeout = timeout
+      conn.sock.settimeout(timeout)
+      return conn
+    conn = PooledHTTPConnection(key, self._resolve(host, port), timeout)
+    with self.lock: self.stats.created += 1
+    return conn
+
+
+  def release(self, conn):
+    # Hands a connection back once its response was read completely
+    if not conn.sock: return
+    now = time.time()
+    conn.lastused = now
+    closed = []
+    with self.lock:
+      idle = self.idle.setdefault(conn.key, [])
+      idle.append(conn)
+      while len(idle) > self.settings.maxidle:
+        closed.append(idle.pop(0))
+        self.stats.evicted += 1
+      # Nothing else wakes up idle connections, so sweep all servers whenever one is released
+      for key, idle in list(self.idle.items()):
+        while idle and now - idle[0].lastused > self.settings.idletimeout:
+          closed.append(idle.pop(0))
+          self.stats.evicted += 1
+        if not idle: del self.idle[key]
+    for conn in closed: conn.close()
+
+
+  def discard(self, conn):
+    # Throws away a connection that failed. If it failed right away, the server's
+    # addresses might have changed, so they will be looked up again next time.
+    conn.close()
+    with self.lock:
+      self.stats.failed += 1
+      if not conn.reused: self.dnscache.pop(conn.key[:2], None)
+
+
+  def request(self, host, port, auth, method, path, body, headers, timeout, responsetimeout = None):
+    # Sends a request over a pooled connection and returns the response along with its body.
+    # If a reused connection turns out to have been closed by the server before it got the request,
+    # the request is sent again over a fresh one. Anything else might have reached the server
+    # (a share might have been accepted already), so that is left to the caller's retry logic.
+    conn = self.get(host, port, auth, timeout)
+    sent = False
+    try:
+      conn.request(method, path, body, headers)
+      sent = True
+      response = self._get_response(conn, responsetimeout)
+    except Exception as e:
+      self.discard(conn)
+      if not conn.reused or (sent and not HTTPPool._was_closed(e)): raise
+      self.core.log(self, "Keep-alive connection to %s:%d died\n" % (host, port), 500)
+      conn = self.get(host, port, auth, timeout, True)
+      try:
+        conn.request(method, path, body, headers)
+        response = self._get_response(conn, responsetimeout)
+      except:
+        self.discard(conn)
+        raise
+    try: data = response.read()
+    except:
+      self.discard(conn)
+      raise
+    self.release(conn)
+    return response, data
+
+
+  def _get_response(self, conn, responsetimeout):
+    if responsetimeout: conn.sock.settimeout(responsetimeout)
+    return conn.getresponse()
+
+
+  @staticmethod
+  def _was_closed(error):
+    # An idle connection that the server closed fails with an empty status line or a reset,
+    # as opposed to e.g. a timeout while the server is still working on the request.
+    if isinstance(error, http_client.BadStatusLine): return True
+    return isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+
+  def _resolve(self, host, port):
+    # getaddrinfo doesn't tell how long the answer may be cached, so a fixed lifetime is used
+    now = time.time()
+    with self.lock:
+      entry = self.dnscache.get((host, port))
+      if entry and entry.expiry > now:
+        self.stats.dnshits += 1
+        return entry.addresses
+    addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    with self.lock:
+      self.stats.dnslookups += 1
+      self.dnscache[(host, port)] = Bunch(addresses = addresses, expiry = now + self.settings.dnsttl)
+    return addresses
+
+
+  @staticmethod
+  def _is_healthy(conn):
+    # An idle keep-alive connection has nothing to read. If it is readable anyway,
+    # the server has closed it (or sent garbage), so it can't be used any more.
+    if not conn.sock: return False
+    try: return not select.select([conn.sock], [], [], 0)[0]
+    except: return False
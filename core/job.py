@@ -38,7 +38,7 @@ from hashlib import sha256
 class Job(object):
 
   
-  def __init__(self, core, worksource, expiry, data, target, midstate = None, identifier = None):
+  def __init__(self, core, worksource, expiry, data, target, midstate = None, identifier = None, difficulty = None):
     self.core = core
     self.worksource = worksource
     self.blockchain = worksource.blockchain
@@ -47,10 +47,14 @@ class Job(object):
     self.target = target
     self.identifier = identifier
     self.prevhash = data[4:36]
-    self.difficulty = 65535. * 2**48 / struct.unpack("<Q", self.target[-12:-4])[0]
-    with self.worksource.stats.lock: self.worksource.stats.difficulty = self.difficulty
+    if difficulty: self.difficulty = difficulty
+    else:
+      self.difficulty = 65535. * 2**48 / struct.unpack("<Q", self.target[-12:-4])[0]
+      with self.worksource.stats.lock: self.worksource.stats.difficulty = self.difficulty
     if midstate: self.midstate = midstate
     else: self.midstate = Job.calculate_midstate(data)
+    # Byte swapped header state for checking nonces, see prepare_header()
+    self.header = None
     self.canceled = False
     self.destroyed = False
     self.worker = None
@@ -73,15 +77,14 @@ class Job(object):
     self.core.workqueue.remove_job(self)
     self.worksource.add_pending_mhashes(self.hashes_remaining / 1000000.)
     self.core.event(700, self.worksource, "destroyjob", None, None, self.worker, self.worksource, self.blockchain, self)
-    if self.worker:
+    if not self.worker: self.core.workqueue.job_discarded(self)
+    else:
       hashes = 2**32 - self.hashes_remaining
       self.core.event(400, self.worker, "hashes_calculated", hashes, None, self.worker, self.worksource, self.blockchain, self)
       ghashes = hashes / 1000000000.
-      self.core.stats.ghashes += ghashes
-      with self.worksource.stats.lock:
-        self.worksource.stats.ghashes += ghashes
-      with self.worker.stats.lock:
-        self.worker.stats.ghashes += ghashes
+      self.core.counters.add("ghashes", ghashes)
+      self.worksource.counters.add("ghashes", ghashes)
+      self.worker.counters.add("ghashes", ghashes)
     
     
   def hashes_processed(self, hashes):
@@ -92,19 +95,18 @@ class Job(object):
     self.worker = worker
     self.core.log(worker, "Mining %s:%s\n" % (self.worksource.settings.name, hexlify(self.data[:76]).decode("ascii")), 400)
     self.core.event(450, self.worker, "acquirejob", None, None, self.worker, self.worksource, self.blockchain, self)
-    with self.worker.stats.lock: self.worker.stats.jobsaccepted += 1
-    with self.worksource.stats.lock: self.worksource.stats.jobsaccepted += 1
+    self.worker.counters.add("jobsaccepted", 1)
+    self.worksource.counters.add("jobsaccepted", 1)
     
     
   def nonce_found(self, nonce, ignore_invalid = False):
     nonceval = struct.unpack("<I", nonce)[0]
     self.core.event(400, self.worker, "noncefound", nonceval, None, self.worker, self.worksource, self.blockchain, self)
-    data = self.data[:76] + nonce + self.data[80:]
-    hash = Job.calculate_hash(data)
+    hash = Job.calculate_job_hashes(self, [nonce])[0]
     if hash[-4:] != b"\0\0\0\0":
       if ignore_invalid: return False
       self.core.log(self.worker, "Got K-not-zero share %s\n" % (hexlify(nonce).decode("ascii")), 200, "yB")
-      with self.worker.stats.lock: self.worker.stats.sharesinvalid += 1
+      self.worker.counters.add("sharesinvalid", 1)
       self.core.event(300, self.worker, "nonceinvalid", nonceval, None, self.worker, self.worksource, self.blockchain, self)
       return False
     self.core.log(self.worker, "Found share: %s:%s:%s\n" % (self.worksource.settings.name, hexlify(self.data[:76]).decode("ascii"), hexlify(nonce).decode("ascii")), 350, "g")
@@ -114,26 +116,52 @@ class Job(object):
       self.core.event(350, self.worksource, "noncefaileddiff", nonceval, str(self.difficulty), self.worker, self.worksource, self.blockchain, self)
       self.core.log(self.worker, "Share %s (difficulty %.5f) didn't meet difficulty %.5f\n" % (hexlify(nonce).decode("ascii"), noncediff, self.difficulty), 300, "g")
       return True
-    self.worksource.nonce_found(self, data, nonce, noncediff)
+    self.worksource.nonce_found(self, self.data[:76] + nonce + self.data[80:], nonce, noncediff)
     return True
     
     
+  def synthetic_nonce_found(self, nonce, noncediff):
+    # For simulated workers, which make up shares of a given difficulty instead of hashing.
+    # These aren't validated, and they are only accepted by pools that don't verify them either.
+    nonceval = struct.unpack("<I", nonce)[0]
+    self.core.event(400, self.worker, "noncefound", nonceval, "synthetic", self.worker, self.worksource, self.blockchain, self)
+    self.core.event(450, self.worker, "noncevalid", nonceval, str(noncediff), self.worker, self.worksource, self.blockchain, self)
+    if noncediff < self.difficulty:
+      self.core.event(350, self.worksource, "noncefaileddiff", nonceval, str(self.difficulty), self.worker, self.worksource, self.blockchain, self)
+      return
+    self.core.log(self.worker, "Found synthetic share: %s:%s:%s\n" % (self.worksource.settings.name, hexlify(self.data[:76]).decode("ascii"), hexlify(nonce).decode("ascii")), 400, "g")
+    self.worksource.nonce_found(self, self.data[:76] + nonce + self.data[80:], nonce, noncediff)
+    
+    
+  def verify_nonces(self, nonces):
+    # Returns a list of flags telling which of the nonces produce a hash with H == 0
+    return [hash[-4:] == b"\0\0\0\0" for hash in Job.calculate_job_hashes(self, nonces)]
+    
+    
   def nonce_handled_callback(self, nonce, noncediff, result):
     nonceval = struct.unpack("<I", nonce)[0]
     if result == True:
       self.core.log(self.worker, "%s accepted share %s (difficulty %.5f)\n" % (self.worksource.settings.name, hexlify(nonce).decode("ascii"), noncediff), 250, "gB")
-      with self.worker.stats.lock: self.worker.stats.sharesaccepted += self.difficulty
-      with self.worksource.stats.lock: self.worksource.stats.sharesaccepted += self.difficulty
+      self.worker.counters.add("sharesaccepted", self.difficulty)
+      self.worksource.counters.add("sharesaccepted", self.difficulty)
       self.core.event(350, self.worksource, "nonceaccepted", nonceval, None, self.worker, self.worksource, self.blockchain, self)
     else:
       if result == False or result == None or len(result) == 0: result = "Unknown reason"
       self.core.log(self.worker, "%s rejected share %s (difficulty %.5f): %s\n" % (self.worksource.settings.name, hexlify(nonce).decode("ascii"), noncediff, result), 200, "y")
-      with self.worker.stats.lock: self.worker.stats.sharesrejected += self.difficulty
-      with self.worksource.stats.lock: self.worksource.stats.sharesrejected += self.difficulty
+      self.worker.counters.add("sharesrejected", self.difficulty)
+      self.worksource.counters.add("sharesrejected", self.difficulty)
       self.core.event(300, self.worksource, "noncerejected", nonceval, result, self.worker, self.worksource, self.blockchain, self)
 
 
   def cancel(self, graceful = False):
+    self._cancel(graceful)
+    if self.worker:
+      try: self.worker.notify_canceled(self, graceful)
+      except: self.core.log(self.worker, "Exception while canceling job: %s" % (traceback.format_exc()), 100, "r")
+
+
+  def _cancel(self, graceful = False):
+    # Cancels the job without notifying the worker
     self.canceled = True
     if not graceful:
       self.worksource.remove_job(self)
@@ -141,10 +169,20 @@ class Job(object):
     self.core.workqueue.remove_job(self)
     if self.worker:
       self.core.event(450, self.worksource, "canceljob", None, None, self.worker, self.worksource, self.blockchain, self)
-      try: self.worker.notify_canceled(self, graceful)
-      except: self.core.log(self.worker, "Exception while canceling job: %s" % (traceback.format_exc()), 100, "r")
-      with self.worker.stats.lock: self.worker.stats.jobscanceled += 1
-      with self.worksource.stats.lock: self.worksource.stats.jobscanceled += 1
+      self.worker.counters.add("jobscanceled", 1)
+      self.worksource.counters.add("jobscanceled", 1)
+
+
+  @staticmethod
+  def cancel_batch(worker, jobs, graceful = False):
+    # Cancels a bunch of jobs that were all handed out to the same worker,
+    # and notifies that worker about all of them at once.
+    for job in jobs:
+      try: job._cancel(graceful)
+      except: job.core.log(job.core, "Error while canceling job: %s\n" % traceback.format_exc(), 100, "r")
+    if worker:
+      try: worker.notify_canceled_batch(jobs, graceful)
+      except: worker.core.log(worker, "Exception while canceling jobs: %s" % (traceback.format_exc()), 100, "r")
       
       
   @staticmethod
@@ -155,7 +193,113 @@ class Job(object):
   @staticmethod
   def calculate_hash(data):
     return sha256(sha256(struct.pack("<20I", *struct.unpack(">20I", data[:80]))).digest()).digest()
+      
+      
+  @staticmethod
+  def prepare_header(data):
+    # Byte swaps the header once. Returns the hash state after its first block, and the
+    # rest of it up to the nonce. The state is only ever copied, so it can be shared.
+    header = struct.pack("<19I", *struct.unpack(">19I", data[:76]))
+    return sha256(header[:64]), header[64:]
+      
+      
+  @staticmethod
+  def calculate_hashes(data, nonces):
+    # Hashes the header with each of the nonces. The first block of the
+    # header is only absorbed once, every nonce starts from a copy of that state.
+    return Job.hash_nonces(Job.prepare_header(data), nonces)
+      
+      
+  @staticmethod
+  def calculate_job_hashes(job, nonces):
+    # Like calculate_hashes, but keeps the prepared header around for the job's next share
+    if not job.header: job.header = Job.prepare_header(job.data)
+    return Job.hash_nonces(job.header, nonces)
+      
+      
+  @staticmethod
+  def hash_nonces(header, nonces):
+    midstate, tail = header
+    hashes = []
+    for nonce in nonces:
+      hash = midstate.copy()
+      hash.update(tail + nonce[::-1])
+      hashes.append(sha256(hash.digest()).digest())
+    return hashes
+
+    
+    
+class JobTemplate(object):
+  # Stands for a batch of jobs that only differ in their ntime, as handed out by pools that allow
+  # rolling it. The work queue holds it as a single entry, and the jobs are only created once
+  # workers actually take them. Unused ones never become objects at all.
 
+  
+  def __init__(self, core, worksource, expiry, data, target, count, midstate = None, identifier = None):
+    self.core = core
+    self.worksource = worksource
+    self.blockchain = worksource.blockchain
+    self.expiry = expiry
+    self.target = target
+    self.identifier = identifier
+    # The data of the first job, so that the template can be logged like a job by the event handlers
+    self.data = data
+    self.prevhash = data[4:36]
+    self.difficulty = 65535. * 2**48 / struct.unpack("<Q", self.target[-12:-4])[0]
+    with self.worksource.stats.lock: self.worksource.stats.difficulty = self.difficulty
+    # The ntime word isn't part of the first SHA256 block, so all jobs share the midstate,
+    # and the hash state of the byte swapped header. Only ntime is patched per job.
+    if midstate: self.midstate = midstate
+    else: self.midstate = Job.calculate_midstate(data)
+    self.headerstate, tail = Job.prepare_header(data)
+    self.tail = bytearray(tail)
+    self.buffer = bytearray(data)
+    self.timebase = struct.unpack(">I", data[68:72])[0]
+    self.count = count
+    self.remaining = count
+    self.destroyed = False
+    self.worker = None
+    
+    
+  @staticmethod
+  def count_jobs(jobs):
+    # Number of jobs in a list that may contain templates
+    return sum(job.remaining if isinstance(job, JobTemplate) else 1 for job in jobs)
+    
+    
+  def register(self):
+    self.worksource.add_job(self)
+    self.blockchain.add_job(self)
+    self.worksource.add_pending_mhashes(-self.remaining * 2**32 / 1000000.)
+    self.core.event(500, self.worksource, "registerjob", self.remaining, None, None, self.worksource, self.blockchain, self)
+    
+    
+  def mint(self):
+    # Needs to be called with the work queue shard lock held. The job takes over
+    # its share of the pending hashes that were accounted for by register().
+    ntime = self.timebase + self.count - self.remaining
+    struct.pack_into(">I", self.buffer, 68, ntime)
+    struct.pack_into("<I", self.tail, 4, ntime)
+    self.remaining -= 1
+    job = Job(self.core, self.worksource, self.expiry, bytes(self.buffer), self.target, self.midstate, self.identifier, self.difficulty)
+    job.header = (self.headerstate, bytes(self.tail))
+    self.worksource.add_job(job)
+    self.blockchain.add_job(job)
+    if not self.remaining:
+      self.worksource.remove_job(self)
+      self.blockchain.remove_job(self)
+    return job
+    
+    
+  def destroy(self):
+    if self.destroyed: return
+    self.destroyed = True
+    self.worksource.remove_job(self)
+    self.blockchain.remove_job(self)
+    self.core.workqueue.remove_job(self)
+    self.worksource.add_pending_mhashes(self.remaining * 2**32 / 1000000.)
+    self.core.event(700, self.worksource, "destroyjob", self.remaining, None, None, self.worksource, self.blockchain, self)
+    self.core.workqueue.job_discarded(self)
     
     
 class ValidationJob(object):
@@ -167,6 +311,7 @@ class ValidationJob(object):
     if midstate: self.midstate = midstate
     else: self.midstate = Job.calculate_midstate(data)
     self.nonce = self.data[76:80]
+    self.header = None
     self.worker = None
     self.starttime = None
     
@@ -176,7 +321,11 @@ class ValidationJob(object):
     
     
   def nonce_found(self, nonce, ignore_invalid = False):
-    return Job.calculate_hash(self.data[:76] + nonce)[-4:] == b"\0\0\0\0"
+    return Job.calculate_job_hashes(self, [nonce])[0][-4:] == b"\0\0\0\0"
+    
+    
+  def verify_nonces(self, nonces):
+    return [hash[-4:] == b"\0\0\0\0" for hash in Job.calculate_job_hashes(self, nonces)]
    
    
   def destroy(self):
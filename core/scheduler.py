@@ -0,0 +1,338 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+#########################
+# Work source scheduler #
+#########################
+
+
+
+import math
+import time
+import heapq
+from threading import RLock
+
+
+
+class ScheduledWorkSource(object):
+  # Scheduling state of one leaf work source
+
+
+  def __init__(self, worksource, vtime, due):
+    self.worksource = worksource
+    self.weight = 0
+    self.rate = 0
+    # Virtual time of the share account, advances by mhashes / weight
+    self.vtime = vtime
+    # When the guaranteed rate account is owed the next hashes
+    self.due = due
+    # Charged for fetches that were started, but didn't deliver jobs yet
+    self.reserved = 0
+    # Charged for stale work, paid back bit by bit as the rounds go by
+    self.deferred = 0
+    self.version = 0
+    self.removed = False
+    # Latency aware leaves are served in rounds of this much virtual time
+    self.latencyaware = False
+    self.quantum = 0
+    self.score = None
+    self.lockouts = 0
+    self.lockoutscore = 0
+
+
+
+class WorkSourceScheduler(object):
+  # Decides which work source a group fetches work from next. The tree below the group is
+  # flattened into its enabled leaves, each with its share of the priorities along the way
+  # and the hash rate that it is guaranteed. Leaves that are owed hashes under their rate
+  # go first, the rest is handed out by weighted fair queueing on the shares. Both are
+  # heaps, so a pick is O(log n) no matter how deep the tree is, and the weights are only
+  # recomputed after the settings or the tree changed.
+  # Below groups that prefer fast and reliable work sources, leaves are served in rounds
+  # instead, in which each of them gets distribution_granularity jobs on average. Within a
+  # round, the ones that deliver usable work the fastest go first. Every leaf still gets
+  # its share of every round, so the priorities hold over anything longer than that.
+
+  jobmhashes = 2**32 / 1000000.
+  scoreinterval = 5
+
+
+  def __init__(self, group):
+    self.group = group
+    self.lock = RLock()
+    self.dirty = True
+    self.entries = {}
+    self.shareheap = []
+    self.rateheap = []
+    # Leaves that have neither a share nor a guaranteed rate, only used if nothing else works
+    self.spare = []
+    # The share account of the leaf that was picked last, new leaves start from here
+    self.vtime = 0
+    self.sequence = 0
+    self.backlog = 0
+    self.nextscore = 0
+    # Leaves that are owed a stale work penalty back, and the slots handed out since the last payment
+    self.deferred = set()
+    self.roundslots = 0
+
+
+  def invalidate(self):
+    self.dirty = True
+
+
+  def get_weights(self):
+    with self.lock:
+      if self.dirty: self._rebuild(time.time())
+      return dict((worksource, (entry.weight, entry.rate)) for worksource, entry in self.entries.items())
+
+
+  def get_scores(self):
+    with self.lock:
+      return dict((worksource, entry.score) for worksource, entry in self.entries.items() if entry.latencyaware)
+
+
+  def charge(self, entry, mhashes):
+    # Accounts for hashes handed out to a leaf, or given back if negative.
+    # Fetches were charged for one job when they were started, jobs are only charged beyond that.
+    with self.lock:
+      if entry.removed: return
+      if mhashes > 0 and entry.reserved:
+        covered = min(entry.reserved, mhashes)
+        entry.reserved -= covered
+        mhashes -= covered
+        if not mhashes: return
+      self._account(entry, mhashes, time.time())
+      self._push(entry)
+
+
+  def defer(self, entry, mhashes):
+    # Charges a leaf for stale work. The hashes are paid back by 10% of what is left every
+    # distribution_granularity fetches, so the penalty fades instead of lasting forever.
+    with self.lock:
+      if entry.removed: return
+      self._account(entry, mhashes, time.time())
+      entry.deferred += mhashes
+      self.deferred.add(entry)
+      self._push(entry)
+
+
+  def start_fetchers(self, count):
+    # Hands out all fetch slots in one pass, and then asks every leaf to start its share of them
+    # at once, returns like BaseWorkSource.start_fetchers. Slots that a leaf couldn't use are
+    # handed out again among the others. The lock isn't held while the leaves start fetchers.
+    # The legacy fetcher controller may ask for a fractional count, which used to be rounded up
+    count = int(math.ceil(count))
+    now = time.time()
+    failed = set()
+    started = 0
+    best = False
+    try:
+      while started < count:
+        with self.lock:
+          if self.dirty: self._rebuild(now)
+          if now >= self.nextscore: self._score(now)
+          slots = self._allocate(count - started, now, failed)
+        if not slots: break
+        for entry, slotcount in slots:
+          result = entry.worksource.start_fetchers(slotcount)
+          used = min(slotcount, int(result)) if result else 0
+          started += used
+          if used == slotcount: continue
+          failed.add(entry)
+          if result is not False and not used: best = result
+          with self.lock:
+            mhashes = (slotcount - used) * self.jobmhashes
+            self._account(entry, -mhashes, now)
+            entry.reserved = max(0, entry.reserved - mhashes)
+            if not entry.removed: self._push(entry)
+    finally:
+      with self.lock:
+        for entry in failed:
+          if not entry.removed: self._push(entry)
+    if started: return started
+    return best
+
+
+  def _allocate(self, count, now, failed):
+    # Called with the lock held. Charges the slots one by one to the leaves that are owed the most,
+    # returns how many each of them got, in the order they were first picked.
+    slots = []
+    index = {}
+    for i in range(count):
+      self.roundslots += 1
+      if self.deferred and self.roundslots * self.jobmhashes >= self.backlog: self._repay(now)
+      entry = self._next_candidate(now, failed)
+      if not entry: break
+      self._account(entry, self.jobmhashes, now)
+      entry.reserved = min(entry.reserved + self.jobmhashes, self.backlog)
+      self._push(entry)
+      if entry in index: slots[index[entry]][1] += 1
+      else:
+        index[entry] = len(slots)
+        slots.append([entry, 1])
+    return slots
+
+
+  def _next_candidate(self, now, exclude):
+    # Called with the lock held. Pops the next leaf to try from the heaps, skipping the excluded ones.
+    heap = self.rateheap
+    while heap and heap[0][0] <= now:
+      entry = self._pop(heap, exclude)
+      if entry: return entry
+    while self.shareheap:
+      entry = self._pop(self.shareheap, exclude)
+      if not entry: continue
+      # A leaf that wasn't available for a while doesn't get to catch up on all of it at once
+      entry.vtime = max(entry.vtime, self.vtime - self.backlog / entry.weight)
+      self.vtime = max(self.vtime, self._key(entry)[0])
+      return entry
+    while self.rateheap:
+      entry = self._pop(self.rateheap, exclude)
+      if entry: return entry
+    for entry in self.spare:
+      if not entry in exclude: return entry
+    return None
+
+
+  def _repay(self, now):
+    # Called with the lock held. Pays back a tenth of the stale work penalties.
+    self.roundslots = 0
+    for entry in list(self.deferred):
+      mhashes = entry.deferred * 0.1
+      entry.deferred -= mhashes
+      if entry.removed or entry.deferred < self.jobmhashes / 100: self.deferred.discard(entry)
+      if entry.removed: continue
+      self._account(entry, -mhashes, now)
+      self._push(entry)
+
+
+  def _pop(self, heap, exclude):
+    # Called with the lock held. Returns None for items that are outdated.
+    version, entry = heapq.heappop(heap)[-2:]
+    if version != entry.version or entry.removed or entry in exclude: return None
+    return entry
+
+
+  def _account(self, entry, mhashes, now):
+    # Called with the lock held. The guaranteed rate is used up first.
+    if entry.rate and (not entry.weight or entry.due <= now):
+      entry.due = max(entry.due, now - self.backlog / entry.rate) + mhashes / entry.rate
+    elif entry.weight: entry.vtime += mhashes / entry.weight
+
+
+  def _push(self, entry):
+    # Called with the lock held. Older heap items of the entry become outdated.
+    self.sequence += 1
+    entry.version = self.sequence
+    if entry.weight: heapq.heappush(self.shareheap, self._key(entry) + (entry.version, entry))
+    if entry.rate: heapq.heappush(self.rateheap, (entry.due, entry.version, entry))
+    if len(self.shareheap) + len(self.rateheap) > 4 * len(self.entries) + 64: self._rebuild_heaps()
+
+
+  def _key(self, entry):
+    # Position in the share heap, latency aware leaves in the same round are ordered by score
+    if not entry.quantum: return entry.vtime, 0
+    return entry.vtime - entry.vtime % entry.quantum, -(entry.score or 0)
+
+
+  def _rebuild_heaps(self):
+    # Called with the lock held
+    entries = list(self.entries.values())
+    for entry in entries:
+      self.sequence += 1
+      entry.version = self.sequence
+    self.shareheap = [self._key(entry) + (entry.version, entry) for entry in entries if entry.weight]
+    self.rateheap = [(entry.due, entry.version, entry) for entry in entries if entry.rate]
+    self.spare = [entry for entry in entries if not entry.weight and not entry.rate]
+    heapq.heapify(self.shareheap)
+    heapq.heapify(self.rateheap)
+
+
+  def _rebuild(self, now):
+    # Called with the lock held. Leaves keep their accounts if they are still there.
+    self.dirty = False
+    self.backlog = self.group.settings.distribution_granularity * self.jobmhashes
+    self.nextscore = 0
+    leaves = {}
+    self._collect(self.group, 1., 0., False, leaves)
+    for worksource, entry in list(self.entries.items()):
+      if not worksource in leaves:
+        entry.removed = True
+        worksource.schedulers.pop(self, None)
+        del self.entries[worksource]
+    for worksource, (weight, rate, latencyaware) in leaves.items():
+      entry = self.entries.get(worksource)
+      if not entry:
+        entry = ScheduledWorkSource(worksource, self.vtime, now)
+        self.entries[worksource] = entry
+        worksource.schedulers[self] = entry
+      entry.weight = weight
+      entry.rate = rate
+      entry.latencyaware = latencyaware
+      if not latencyaware or not weight:
+        entry.quantum = 0
+        entry.score = None
+    self._rebuild_heaps()
+
+
+  def _collect(self, group, weight, rate, latencyaware, leaves):
+    # A group's share is split among its children by priority. So is its guaranteed rate,
+    # on top of what the children are guaranteed themselves.
+    latencyaware = latencyaware or group.settings.selection == "latency"
+    children = [child for child in list(group.children) if child.settings.enabled]
+    priority = sum(child.settings.priority for child in children)
+    for child in children:
+      if priority: share = float(child.settings.priority) / priority
+      else: share = 1. / len(children)
+      childweight = weight * child.settings.priority / priority if priority else 0
+      childrate = rate * share + child.settings.hashrate
+      if child.is_group: self._collect(child, childweight, childrate, latencyaware, leaves)
+      else: leaves[child] = (childweight, childrate, latencyaware)
+
+
+  def _score(self, now):
+    # Called with the lock held. Rates how fast the latency aware leaves deliver usable work,
+    # compared to the best of them. An average leaf gets distribution_granularity jobs per round.
+    self.nextscore = now + self.scoreinterval
+    entries = [entry for entry in self.entries.values() if entry.latencyaware and entry.weight]
+    if not entries: return
+    latencies = [entry.worksource.estimated_latency for entry in entries if getattr(entry.worksource, "estimated_latency", None) is not None]
+    default = sum(latencies) / len(latencies) if latencies else 1
+    for entry in entries:
+      worksource = entry.worksource
+      latency = getattr(worksource, "estimated_latency", None)
+      if latency is None: latency = default
+      accepted = worksource.counters.get("sharesaccepted")
+      rejected = worksource.counters.get("sharesrejected")
+      usable = (accepted + 1.) / (accepted + rejected + 1.)
+      # Recent lockouts count the most, older ones fade away within a minute or two
+      lockouts = worksource.stats.get("lockouts", 0)
+      entry.lockoutscore = entry.lockoutscore * 0.9 + max(0, lockouts - entry.lockouts)
+      entry.lockouts = lockouts
+      # Latencies below a few tens of milliseconds don't make a difference in practice
+      entry.score = usable / (1 + entry.lockoutscore) / (latency + 0.05)
+    best = max(entry.score for entry in entries)
+    quantum = self.backlog * len(entries) / sum(entry.weight for entry in entries)
+    for entry in entries:
+      entry.score /= best
+      entry.quantum = quantum
+    self._rebuild_heaps()
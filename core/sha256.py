@@ -30,53 +30,88 @@ import struct
 
 
 
+_k = (0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+      0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+      0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+      0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+      0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+      0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+      0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+      0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2)
+_iv = (0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
+_blockstruct = struct.Struct("!16L")
+_statestruct = struct.Struct("!8L")
+
+
+def _compress(state, data, offset = 0, k = _k, unpack = _blockstruct.unpack_from):
+  # Rotations are inlined and their high bits are only masked off once the
+  # intermediate sums are complete. Eight rounds are unrolled per iteration
+  # so that the working variables never have to be shuffled around.
+  w = list(unpack(data, offset))
+  append = w.append
+  for i in range(16, 64):
+    x = w[i - 15]
+    y = w[i - 2]
+    append((w[i - 16] + w[i - 7] + ((x >> 7 | x << 25) ^ (x >> 18 | x << 14) ^ (x >> 3))
+              + ((y >> 17 | y << 15) ^ (y >> 19 | y << 13) ^ (y >> 10))) & 0xffffffff)
+  kw = [x + y for x, y in zip(k, w)]
+
+  a, b, c, d, e, f, g, h = state
+  for i in range(0, 64, 8):
+    t1 = h + ((e >> 6 | e << 26) ^ (e >> 11 | e << 21) ^ (e >> 25 | e << 7)) + (g ^ (e & (f ^ g))) + kw[i]
+    d = (d + t1) & 0xffffffff
+    h = (t1 + ((a >> 2 | a << 30) ^ (a >> 13 | a << 19) ^ (a >> 22 | a << 10)) + ((a & b) | (c & (a | b)))) & 0xffffffff
+    t1 = g + ((d >> 6 | d << 26) ^ (d >> 11 | d << 21) ^ (d >> 25 | d << 7)) + (f ^ (d & (e ^ f))) + kw[i + 1]
+    c = (c + t1) & 0xffffffff
+    g = (t1 + ((h >> 2 | h << 30) ^ (h >> 13 | h << 19) ^ (h >> 22 | h << 10)) + ((h & a) | (b & (h | a)))) & 0xffffffff
+    t1 = f + ((c >> 6 | c << 26) ^ (c >> 11 | c << 21) ^ (c >> 25 | c << 7)) + (e ^ (c & (d ^ e))) + kw[i + 2]
+    b = (b + t1) & 0xffffffff
+    f = (t1 + ((g >> 2 | g << 30) ^ (g >> 13 | g << 19) ^ (g >> 22 | g << 10)) + ((g & h) | (a & (g | h)))) & 0xffffffff
+    t1 = e + ((b >> 6 | b << 26) ^ (b >> 11 | b << 21) ^ (b >> 25 | b << 7)) + (d ^ (b & (c ^ d))) + kw[i + 3]
+    a = (a + t1) & 0xffffffff
+    e = (t1 + ((f >> 2 | f << 30) ^ (f >> 13 | f << 19) ^ (f >> 22 | f << 10)) + ((f & g) | (h & (f | g)))) & 0xffffffff
+    t1 = d + ((a >> 6 | a << 26) ^ (a >> 11 | a << 21) ^ (a >> 25 | a << 7)) + (c ^ (a & (b ^ c))) + kw[i + 4]
+    h = (h + t1) & 0xffffffff
+    d = (t1 + ((e >> 2 | e << 30) ^ (e >> 13 | e << 19) ^ (e >> 22 | e << 10)) + ((e & f) | (g & (e | f)))) & 0xffffffff
+    t1 = c + ((h >> 6 | h << 26) ^ (h >> 11 | h << 21) ^ (h >> 25 | h << 7)) + (b ^ (h & (a ^ b))) + kw[i + 5]
+    g = (g + t1) & 0xffffffff
+    c = (t1 + ((d >> 2 | d << 30) ^ (d >> 13 | d << 19) ^ (d >> 22 | d << 10)) + ((d & e) | (f & (d | e)))) & 0xffffffff
+    t1 = b + ((g >> 6 | g << 26) ^ (g >> 11 | g << 21) ^ (g >> 25 | g << 7)) + (a ^ (g & (h ^ a))) + kw[i + 6]
+    f = (f + t1) & 0xffffffff
+    b = (t1 + ((c >> 2 | c << 30) ^ (c >> 13 | c << 19) ^ (c >> 22 | c << 10)) + ((c & d) | (e & (c | d)))) & 0xffffffff
+    t1 = a + ((f >> 6 | f << 26) ^ (f >> 11 | f << 21) ^ (f >> 25 | f << 7)) + (h ^ (f & (g ^ h))) + kw[i + 7]
+    e = (e + t1) & 0xffffffff
+    a = (t1 + ((b >> 2 | b << 30) ^ (b >> 13 | b << 19) ^ (b >> 22 | b << 10)) + ((b & c) | (d & (b | c)))) & 0xffffffff
+
+  return ((state[0] + a) & 0xffffffff, (state[1] + b) & 0xffffffff, (state[2] + c) & 0xffffffff, (state[3] + d) & 0xffffffff,
+          (state[4] + e) & 0xffffffff, (state[5] + f) & 0xffffffff, (state[6] + g) & 0xffffffff, (state[7] + h) & 0xffffffff)
+
+
+
 class SHA256(object):
 
-  _k = (0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
-        0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
-        0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
-        0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
-        0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
-        0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
-        0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
-        0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2)
+  _k = _k
 
         
   def __init__(self):        
     self._buffer = b""
     self._length = 0
-    self.state = (0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
+    self.state = _iv
         
         
-  def _rotr(self, x, y):
-      return ((x >> y) | (x << (32 - y))) & 0xffffffff
-
-      
   def _round(self, data):
-    w = [0] * 64
-    w[0:15] = struct.unpack("!16L", data)
-    
-    for i in range(16, 64):
-      s0 = self._rotr(w[i - 15], 7) ^ self._rotr(w[i - 15], 18) ^ (w[i - 15] >> 3)
-      s1 = self._rotr(w[i - 2], 17) ^ self._rotr(w[i - 2], 19) ^ (w[i - 2] >> 10)
-      w[i] = (w[i - 16] + s0 + w[i - 7] + s1) & 0xffffffff
-    
-    a, b, c, d, e, f, g, h = self.state
-    
-    for i in range(64):
-      t1 = h + (self._rotr(e, 6) ^ self._rotr(e, 11) ^ self._rotr(e, 25)) + ((e & f) ^ ((~e) & g)) + self._k[i] + w[i]
-      t2 = (self._rotr(a, 2) ^ self._rotr(a, 13) ^ self._rotr(a, 22)) + ((a & b) ^ (a & c) ^ (b & c))
-      h, g, f, e, d, c, b, a = g, f, e, (d + t1) & 0xffffffff, c, b, a, (t1 + t2) & 0xffffffff
-        
-    self.state = tuple((x + y) & 0xffffffff for x, y in zip(self.state, (a, b, c, d, e, f, g, h)))
+    self.state = _compress(self.state, data)
 
     
   def update(self, data):
-    self._buffer += data
     self._length += len(data)
-    while len(self._buffer) >= 64:
-      self._round(self._buffer[:64])
-      self._buffer = self._buffer[64:]
+    if self._buffer:
+      data = self._buffer + data
+    end = len(data) & ~0x3f
+    state = self.state
+    for offset in range(0, end, 64): state = _compress(state, data, offset)
+    self.state = state
+    self._buffer = data[end:]
       
       
   def finalize(self):
@@ -87,7 +122,7 @@ class SHA256(object):
 
       
   def get_bytes(self):
-    return struct.pack("!8L", *self.state)
+    return _statestruct.pack(*self.state)
 
     
   @classmethod
@@ -96,4 +131,3 @@ class SHA256(object):
     hash.update(data)
     if finalize: hash.finalize()
     return hash.get_bytes()
-    
\ No newline at end of file
@@ -0,0 +1,188 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+##################################
+# Persistent on-disk share spool #
+##################################
+
+
+
+import os
+import mmap
+import zlib
+import struct
+from threading import RLock
+from .util import Bunch
+
+
+
+class ShareSpool(object):
+
+  # Record layout: state, CRC32 of the payload, payload (submit time, expiry time,
+  # share difficulty, job difficulty, block header). A torn append fails the CRC check.
+  record = struct.Struct("<BxxxI")
+  payload = struct.Struct("<dddd128s")
+  recordsize = record.size + payload.size
+  EMPTY = 0
+  PENDING = 1
+  DONE = 2
+
+
+  def __init__(self, filename, chunksize = 256):
+    self.filename = filename
+    self.chunksize = chunksize
+    self.lock = RLock()
+    self.map = None
+    # Jobs of the pending records by slot, only kept in memory for crediting the shares to them
+    self.jobs = {}
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory): os.makedirs(directory)
+    self.file = open(filename, "r+b" if os.path.exists(filename) else "w+b")
+    self.file.seek(0, os.SEEK_END)
+    self.capacity = self.file.tell() // self.recordsize
+    if self.capacity: self.map = mmap.mmap(self.file.fileno(), self.capacity * self.recordsize)
+    else: self._resize(chunksize)
+    self._recover()
+
+
+  def _resize(self, capacity):
+    if self.map: self.map.close()
+    self.file.truncate(capacity * self.recordsize)
+    self.file.flush()
+    self.capacity = capacity
+    self.map = mmap.mmap(self.file.fileno(), capacity * self.recordsize)
+
+
+  def _recover(self):
+    # Records are appended in order, so the first empty slot marks the end of the spool.
+    # An append that was torn by a crash either still has an empty state byte or fails the CRC check.
+    self.head = None
+    self.tail = 0
+    self.pending = 0
+    while self.tail < self.capacity:
+      state = self._get_state(self.tail)
+      if state == ShareSpool.EMPTY: break
+      if state == ShareSpool.PENDING:
+        if self.read(self.tail):
+          self.pending += 1
+          if self.head is None: self.head = self.tail
+        else: self._set_state(self.tail, ShareSpool.DONE)
+      self.tail += 1
+    if self.head is None: self.head = self.tail
+    self.cursor = self.head
+    # Anything behind the end is garbage from a torn write, clear it so that it can't be mistaken for a record
+    self.map[self.tail * self.recordsize:] = b"\0" * ((self.capacity - self.tail) * self.recordsize)
+    if not self.pending and self.tail: self._truncate()
+
+
+  def _get_state(self, slot):
+    return ShareSpool.record.unpack_from(self.map, slot * self.recordsize)[0]
+
+
+  def _set_state(self, slot, state):
+    offset = slot * self.recordsize
+    self.map[offset:offset + 1] = struct.pack("B", state)
+
+
+  def _flush(self, slot):
+    # Flush whole pages only, mmap.flush() insists on page aligned offsets
+    offset = slot * self.recordsize
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    self.map.flush(start, offset + self.recordsize - start)
+
+
+  def _truncate(self):
+    # Nothing is pending anymore, so start over at the beginning of a small file
+    self.head = self.tail = self.cursor = 0
+    self.jobs = {}
+    if self.capacity != self.chunksize: self._resize(self.chunksize)
+    self.map[:] = b"\0" * (self.capacity * self.recordsize)
+
+
+  def close(self):
+    with self.lock:
+      if not self.map: return
+      self.map.flush()
+      self.map.close()
+      self.map = None
+      self.file.close()
+
+
+  def append(self, timestamp, expiry, noncediff, difficulty, data, job = None):
+    with self.lock:
+      if not self.map: return None
+      if self.tail >= self.capacity: self._resize(self.capacity + self.chunksize)
+      slot = self.tail
+      offset = slot * self.recordsize
+      payload = ShareSpool.payload.pack(timestamp, expiry, noncediff, difficulty, data)
+      crc = zlib.crc32(payload) & 0xffffffff
+      self.map[offset:offset + self.recordsize] = ShareSpool.record.pack(ShareSpool.PENDING, crc) + payload
+      self._flush(slot)
+      if job is not None: self.jobs[slot] = job
+      self.tail += 1
+      self.pending += 1
+      return slot
+
+
+  def read(self, slot):
+    # Returns the record in the given slot, or None if it is corrupted
+    with self.lock:
+      if not self.map or slot >= self.capacity: return None
+      offset = slot * self.recordsize
+      state, crc = ShareSpool.record.unpack_from(self.map, offset)
+      payload = self.map[offset + ShareSpool.record.size:offset + self.recordsize]
+      if zlib.crc32(payload) & 0xffffffff != crc: return None
+      timestamp, expiry, noncediff, difficulty, data = ShareSpool.payload.unpack(payload)
+      return Bunch(spool = self, slot = slot, state = state, timestamp = timestamp, expiry = expiry,
+                   noncediff = noncediff, difficulty = difficulty, data = data, job = self.jobs.get(slot))
+
+
+  def take(self, end = None):
+    # Returns the next pending record that wasn't taken yet, in the order they were appended
+    with self.lock:
+      if not self.map: return None
+      if end is None: end = self.tail
+      while self.cursor < min(end, self.tail):
+        slot = self.cursor
+        self.cursor += 1
+        if self._get_state(slot) != ShareSpool.PENDING: continue
+        record = self.read(slot)
+        if record: return record
+        self.complete(slot)
+      return None
+
+
+  def rewind(self):
+    # Hand out all pending records again, used after restarting the consumer
+    with self.lock: self.cursor = self.head
+
+
+  def complete(self, slot):
+    with self.lock:
+      if not self.map or slot >= self.tail or self._get_state(slot) != ShareSpool.PENDING: return
+      self._set_state(slot, ShareSpool.DONE)
+      self._flush(slot)
+      self.jobs.pop(slot, None)
+      self.pending -= 1
+      while self.head < self.tail and self._get_state(self.head) != ShareSpool.PENDING: self.head += 1
+      # Starting over costs clearing the whole file, so only do that once a chunk is used up
+      if not self.pending and self.tail >= self.chunksize: self._truncate()
@@ -28,6 +28,8 @@
 
 from threading import RLock
 from .util import Bunch
+try: from threading import get_ident
+except ImportError: from thread import get_ident
 
 
 
@@ -39,6 +41,33 @@ class Statistics(Bunch):
     
 
     
+class StripedCounters(object):
+  # Counters that are bumped from many threads on hot paths without taking a lock.
+  # Every thread adds to its own stripe, which nobody else writes to, and the stripes
+  # are only summed up when statistics are requested. Thread ids are reused by the
+  # time new threads come up, so the number of stripes stays bounded.
+
+
+  def __init__(self):
+    self.stripes = {}
+
+
+  def reset(self):
+    self.stripes = {}
+
+
+  def add(self, name, value):
+    ident = get_ident()
+    stripe = self.stripes.get(ident)
+    if stripe is None: stripe = self.stripes[ident] = {}
+    stripe[name] = stripe.get(name, 0) + value
+
+
+  def get(self, name):
+    return sum(stripe.get(name, 0) for stripe in list(self.stripes.values()))
+
+
+
 class StatisticsList(list):
 
 
@@ -62,6 +91,7 @@ class StatisticsProvider(object):
   def __init__(self):
     self.stats = Bunch()
     self.stats.lock = RLock()
+    self.counters = StripedCounters()
     self.children = []
     
     
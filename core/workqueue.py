@@ -27,125 +27,300 @@
 
 
 import time
+import traceback
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
 from threading import Condition, RLock, Thread
 from .startable import Startable
+from .job import Job, JobTemplate
 from .util import Bunch
 try: from queue import Queue
 except: from Queue import Queue
 
 
 
+class WorkQueueShard(object):
+
+
+  def __init__(self, queue, blockchain):
+    self.queue = queue
+    self.blockchain = blockchain
+    # Initialize shard lock, protects everything below
+    self.lock = RLock()
+    # Initialize job list container and count.
+    # Jobs are bucketed by (integer) expiry, self.expiries is the sorted list of bucket keys.
+    self.lists = {}
+    self.expiries = []
+    self.count = 0
+    self.expirycutoff = 0
+    # Initialize taken job list container
+    self.takenlists = {}
+    self.takenexpiries = []
+
+
+  def _insert(self, lists, expiries, expiry, job):
+    bucket = lists.get(expiry)
+    if bucket is None:
+      bucket = OrderedDict()
+      lists[expiry] = bucket
+      insort(expiries, expiry)
+    bucket[job] = True
+
+
+  def _discard(self, lists, expiries, expiry, job):
+    bucket = lists.get(expiry)
+    if not bucket or not job in bucket: return False
+    del bucket[job]
+    if not bucket:
+      del lists[expiry]
+      del expiries[bisect_left(expiries, expiry)]
+    return True
+
+
+  def _pop_buckets(self, lists, expiries, limit):
+    # Detach all buckets with an expiry of at most limit, and return their jobs
+    index = bisect_right(expiries, limit)
+    jobs = []
+    for expiry in expiries[:index]: jobs.extend(lists.pop(expiry))
+    del expiries[:index]
+    return jobs
+
+
+  def add_job(self, job):
+    # Needs to be called with the shard lock held
+    expiry = int(job.expiry)
+    self._insert(self.lists, self.expiries, expiry, job)
+    if expiry > self.expirycutoff:
+      self.count += JobTemplate.count_jobs([job])
+      self.queue._schedule_cleanup(expiry - 10)
+    else: self.queue._schedule_cleanup(expiry)
+    job.register()
+
+
+  def remove_job(self, job):
+    with self.lock:
+      expiry = int(job.expiry)
+      if self._discard(self.lists, self.expiries, expiry, job):
+        if expiry > self.expirycutoff: self.count -= JobTemplate.count_jobs([job])
+      self._discard(self.takenlists, self.takenexpiries, expiry, job)
+
+
+  def peek(self, min_expiry):
+    # Find the expiry bucket that take() would pick, without taking the lock.
+    # This is only a hint, the result has to be revalidated by take().
+    expiries = self.expiries
+    try:
+      index = bisect_right(expiries, min_expiry)
+      if index == len(expiries): index -= 1
+      return expiries[index]
+    except IndexError: return None
+
+
+  def take(self, worker, min_expiry):
+    with self.lock:
+      expiries = self.expiries
+      if not expiries: return None
+      # Look for a job that meets min_expiry as closely as possible.
+      # If there is none, take the job with the latest expiry.
+      index = bisect_right(expiries, min_expiry)
+      if index == len(expiries): index -= 1
+      expiry = expiries[index]
+      bucket = self.lists[expiry]
+      job = next(iter(bucket))
+      if isinstance(job, JobTemplate):
+        # Templates stay queued until the last of their jobs was taken
+        template = job
+        job = template.mint()
+        if not template.remaining: del bucket[template]
+      else: del bucket[job]
+      if not bucket:
+        del self.lists[expiry]
+        del expiries[index]
+      if expiry > self.expirycutoff: self.count -= 1
+      job.set_worker(worker)
+      self._insert(self.takenlists, self.takenexpiries, expiry, job)
+      self.queue._schedule_cleanup(expiry)
+      return job
+
+
+  def cleanup(self, now):
+    # Returns the taken jobs that need to be canceled, whether the queue changed,
+    # and the time at which this shard needs to be looked at again.
+    with self.lock:
+      # Jobs expiring within the next 10 seconds don't count as queued any more.
+      # Only the buckets that crossed that boundary since the last run need to be looked at.
+      cutoff = now + 10
+      first = bisect_right(self.expiries, self.expirycutoff)
+      last = bisect_right(self.expiries, cutoff)
+      count = self.count
+      for expiry in self.expiries[first:last]: self.count -= JobTemplate.count_jobs(self.lists[expiry])
+      self.expirycutoff = cutoff
+      expired = self._pop_buckets(self.lists, self.expiries, now)
+      for job in expired: job.destroy()
+      cancel = self._pop_buckets(self.takenlists, self.takenexpiries, now)
+      changed = expired or cancel or self.count != count
+      # Figure out when the next job will expire or cross the cutoff boundary
+      deadline = float("inf")
+      if self.expiries: deadline = self.expiries[0]
+      index = bisect_right(self.expiries, cutoff)
+      if index < len(self.expiries): deadline = min(deadline, self.expiries[index] - 10)
+      if self.takenexpiries: deadline = min(deadline, self.takenexpiries[0])
+      return cancel, changed, deadline
+
+
+
 class WorkQueue(Startable):
 
+  cancelthreadcount = 4
   
   def __init__(self, core):
     self.core = core
     self.id = -3
     self.settings = Bunch(name = "Work queue")
+    # Initialize shard container lock
+    self.shardlock = RLock()
     super(WorkQueue, self).__init__()
-    # Initialize global work queue lock and wakeup condition
+    # Initialize global wakeup condition. Jobs are protected by their shard's lock,
+    # this one is only used to wake up workers that are waiting for jobs to arrive.
     self.lock = Condition()
+    # Initialize cleanup thread wakeup condition
+    self.cleanupwakeup = Condition()
+    # Initialize cancel queues: Batches of jobs are split up by worker,
+    # and the per-worker groups are handed to a pool of cancel threads.
     self.cancelqueue = Queue()
+    self.cancelgroupqueue = Queue()
+    self.cancellock = RLock()
     
     
   def _reset(self):
     self.core.event(300, self, "reset", None, "Resetting work queue state")
     super(WorkQueue, self)._reset()
-    # Initialize job list container and count
-    self.lists = {}
-    self.count = 0
-    self.expirycutoff = 0
-    # Initialize taken job list container
-    self.takenlists = {}
+    # Initialize shard container, one shard per block chain
+    with self.shardlock: self.shards = {}
+    # Initialize statistics, used by the fetcher controller
+    self.stats = Bunch(lock = RLock())
+    self.stats.jobstaken = 0
+    self.stats.jobsdiscarded = 0
+    self.stats.idletime = 0
+    self.stats.starvations = 0
+    # Nothing to clean up until the first job arrives
+    self.nextcleanup = float("inf")
+
+
+  def get_shard(self, blockchain):
+    shard = self.shards.get(blockchain)
+    if shard: return shard
+    with self.shardlock:
+      shard = self.shards.get(blockchain)
+      if not shard:
+        shard = WorkQueueShard(self, blockchain)
+        self.shards[blockchain] = shard
+      return shard
+
+
+  @property
+  def count(self):
+    return sum(shard.count for shard in list(self.shards.values()))
     
     
   def add_job(self, job):
-    with self.lock:
-      if not job.blockchain.check_job(job):
-        mhashes = job.hashes_remaining / 1000000.
-        job.worksource.add_pending_mhashes(-mhashes)
-        job.worksource.add_deferred_mhashes(mhashes)
-        return
-      expiry = int(job.expiry)
-      if not expiry in self.lists: self.lists[expiry] = [job]
-      else: self.lists[expiry].append(job)
-      if expiry > self.expirycutoff: self.count += 1
-      job.register()
-      self.lock.notify_all()
+    self.add_jobs([job])
     
     
   def add_jobs(self, jobs):
-    with self.lock:
-      seen = {}
-      for job in jobs:
-        if not job.blockchain.check_job(job):
-          if not job.worksource in seen:
-            mhashes = 2**32 / 1000000.
-            job.worksource.add_pending_mhashes(-mhashes)
-            job.worksource.add_deferred_mhashes(mhashes)
-            seen[job.worksource] = True
-        else:
-          expiry = int(job.expiry)
-          if not expiry in self.lists: self.lists[expiry] = [job]
-          else: self.lists[expiry].append(job)
-          if expiry > self.expirycutoff: self.count += 1
-          job.register()
-      self.lock.notify_all()
+    groups = {}
+    for job in jobs:
+      if not job.blockchain in groups: groups[job.blockchain] = [job]
+      else: groups[job.blockchain].append(job)
+    for blockchain, jobs in groups.items():
+      shard = self.get_shard(blockchain)
+      with shard.lock:
+        seen = {}
+        for job in jobs:
+          if not blockchain.check_job(job):
+            self.job_discarded(job)
+            if not job.worksource in seen:
+              # Ask work sources that deliver stale work a bit less often
+              job.worksource.add_deferred_mhashes(2**32 / 1000000.)
+              seen[job.worksource] = True
+          else: shard.add_job(job)
+    with self.lock: self.lock.notify_all()
     
     
-  def cancel_jobs(self, jobs, graceful = False):
+  def cancel_jobs(self, jobs, graceful = False, callback = None):
+    # The callback (if any) will be called with the total cancellation latency
+    # once all affected workers have been notified.
     if not jobs: return
-    self.cancelqueue.put((jobs, graceful))
+    self.cancelqueue.put((jobs, graceful, callback, time.time()))
     
     
   def remove_job(self, job):
-    with self.lock:
-      try:
-        expiry = int(job.expiry)
-        try:
-          self.lists[expiry].remove(job)
-          if expiry > self.expirycutoff: self.count -= 1
-        except: pass
-        try: self.takenlists[expiry].remove(job)
-        except: pass
-      except: pass
+    shard = self.shards.get(job.blockchain)
+    if shard: shard.remove_job(job)
+
+
+  def job_discarded(self, job):
+    # Called for jobs (or templates) that were thrown away without ever being handed out to a worker
+    with self.stats.lock: self.stats.jobsdiscarded += JobTemplate.count_jobs([job])
       
       
   def get_job(self, worker, expiry_min_ahead, async = False):
-    with self.lock:
-      job = self._get_job_internal(expiry_min_ahead, async)
-      if job:
-        self.core.fetcher.wakeup()
-        job.set_worker(worker)
-        expiry = int(job.expiry)
-        if int(job.expiry) <= self.expirycutoff: self.count += 1
-        if not expiry in self.takenlists: self.takenlists[expiry] = [job]
-        else: self.takenlists[expiry].append(job)
-      return job
+    job = self._get_job_internal(worker, expiry_min_ahead, async)
+    if job: self.core.fetcher.wakeup()
+    return job
 
 
-  def _get_job_internal(self, expiry_min_ahead, async = False):
-    self.count -= 1
+  def _get_job_internal(self, worker, expiry_min_ahead, async = False):
+    waitstart = None
     while True:
-      keys = sorted(self.lists.keys())
-      min_expiry = time.time() + expiry_min_ahead
-      # Look for a job that meets min_expiry as closely as possible
-      for expiry in keys:
-        if expiry <= min_expiry: continue
-        list = self.lists[expiry]
-        if not list: continue
-        return list.pop(0)
-      # If there was none, look for the job with the latest expiry
-      keys.reverse()
-      for expiry in keys:
-        if expiry > min_expiry: continue
-        list = self.lists[expiry]
-        if not list: continue
-        return list.pop(0)
+      job = self._take_job(worker, time.time() + expiry_min_ahead)
+      if job: break
       # There were no jobs at all => Wait for some to arrive
       self.core.fetcher.wakeup()
-      if async: return None
-      self.lock.wait()
+      if async:
+        with self.stats.lock: self.stats.starvations += 1
+        return None
+      if waitstart is None: waitstart = time.time()
+      with self.lock:
+        # Check again while holding the wakeup lock, so that we can't miss a notification
+        job = self._take_job(worker, time.time() + expiry_min_ahead)
+        if job: break
+        self.lock.wait()
+    with self.stats.lock:
+      self.stats.jobstaken += 1
+      if waitstart is not None:
+        self.stats.starvations += 1
+        self.stats.idletime += time.time() - waitstart
+    return job
+
+
+  def _schedule_cleanup(self, deadline):
+    # Make sure that the cleanup thread wakes up at deadline (or earlier)
+    if deadline >= self.nextcleanup: return
+    with self.cleanupwakeup:
+      if deadline < self.nextcleanup:
+        self.nextcleanup = deadline
+        self.cleanupwakeup.notify()
+
+
+  def _take_job(self, worker, min_expiry):
+    while True:
+      # Pick the shard whose best job meets min_expiry most closely,
+      # or, if no shard can meet it, the one with the latest expiry.
+      best = None
+      bestexpiry = None
+      for shard in list(self.shards.values()):
+        expiry = shard.peek(min_expiry)
+        if expiry is None: continue
+        if best is None: better = True
+        elif expiry > min_expiry: better = bestexpiry <= min_expiry or expiry < bestexpiry
+        else: better = bestexpiry <= min_expiry and expiry > bestexpiry
+        if better:
+          best = shard
+          bestexpiry = expiry
+      if not best: return None
+      job = best.take(worker, min_expiry)
+      if job: return job
 
         
   def _start(self):
@@ -154,49 +329,77 @@ class WorkQueue(Startable):
     self.cleanupthread = Thread(None, self._cleanuploop, "workqueue_cleanup")
     self.cleanupthread.daemon = True
     self.cleanupthread.start()
-    self.cancelthread = Thread(None, self._cancelloop, "workqueue_cancelworker")
+    self.cancelthread = Thread(None, self._cancelloop, "workqueue_canceldispatcher")
     self.cancelthread.daemon = True
     self.cancelthread.start()
+    self.cancelgroupthreads = []
+    for i in range(self.cancelthreadcount):
+      thread = Thread(None, self._cancelgrouploop, "workqueue_cancelworker_%d" % i)
+      thread.daemon = True
+      thread.start()
+      self.cancelgroupthreads.append(thread)
   
   
   def _stop(self):
     self.shutdown = True
+    with self.cleanupwakeup: self.cleanupwakeup.notify()
     self.cleanupthread.join(5)
     self.cancelqueue.put(None)
     self.cancelthread.join(5)
+    for thread in self.cancelgroupthreads: self.cancelgroupqueue.put(None)
+    for thread in self.cancelgroupthreads: thread.join(5)
     self._reset()
     super(WorkQueue, self)._stop()
 
     
   def _cleanuploop(self):
     while not self.shutdown:
+      # Sleep until the next job expires or crosses the cutoff boundary
+      with self.cleanupwakeup:
+        now = time.time()
+        if now < self.nextcleanup:
+          if self.nextcleanup == float("inf"): self.cleanupwakeup.wait()
+          else: self.cleanupwakeup.wait(self.nextcleanup - now)
+          continue
+        self.nextcleanup = float("inf")
       now = time.time()
       cancel = []
-      with self.lock:
-        keys = sorted(self.lists.keys())
-        cutoff = now + 10
-        for expiry in keys:
-          if expiry > cutoff: break
-          if expiry > self.expirycutoff and expiry <= cutoff: self.count -= len(self.lists[expiry])
-          if expiry <= now:
-            while self.lists[expiry]: self.lists[expiry].pop(0).destroy()
-            del self.lists[expiry]
-        self.expirycutoff = cutoff
-        keys = sorted(self.takenlists.keys())
-        for expiry in keys:
-          if expiry <= now:
-            while self.takenlists[expiry]: cancel.append(self.takenlists[expiry].pop(0))
-            del self.takenlists[expiry]
-      self.core.fetcher.wakeup()
+      changed = False
+      deadline = float("inf")
+      for shard in list(self.shards.values()):
+        shardcancel, shardchanged, sharddeadline = shard.cleanup(now)
+        cancel.extend(shardcancel)
+        if shardchanged: changed = True
+        deadline = min(deadline, sharddeadline)
+      self._schedule_cleanup(deadline)
+      if changed: self.core.fetcher.wakeup()
       self.cancel_jobs(cancel)
-      time.sleep(1)
 
   
   def _cancelloop(self):
     while True:
       data = self.cancelqueue.get()
       if not data: return
-      jobs, graceful = data
+      jobs, graceful, callback, starttime = data
+      # Group the jobs by worker, so that every worker only needs to be notified once
+      groups = {}
       for job in jobs:
-        try: job.cancel(graceful)
-        except: self.core.log(self.core, "Error while canceling job: %s\n" % traceback.format_exc(), 100, "r")
+        if not job.worker in groups: groups[job.worker] = [job]
+        else: groups[job.worker].append(job)
+      batch = Bunch(remaining = len(groups), callback = callback, starttime = starttime)
+      for worker, jobs in groups.items(): self.cancelgroupqueue.put((batch, worker, jobs, graceful))
+
+
+  def _cancelgrouploop(self):
+    while True:
+      data = self.cancelgroupqueue.get()
+      if not data: return
+      batch, worker, jobs, graceful = data
+      try: Job.cancel_batch(worker, jobs, graceful)
+      except: self.core.log(self.core, "Error while canceling jobs: %s\n" % traceback.format_exc(), 100, "r")
+      with self.cancellock:
+        batch.remaining -= 1
+        if batch.remaining: continue
+      if batch.callback:
+        try: batch.callback(time.time() - batch.starttime)
+        except: self.core.log(self.core, "Error in job cancellation callback: %s\n" % traceback.format_exc(), 100, "r")
@@ -26,10 +26,10 @@
 
 
 
-import time
 import traceback
 from threading import RLock
 from .baseworksource import BaseWorkSource
+from .scheduler import WorkSourceScheduler
 
 
 
@@ -40,10 +40,20 @@ class WorkSourceGroup(BaseWorkSource):
   is_group = True,
   settings = dict(BaseWorkSource.settings, **{
     "distribution_granularity": {"title": "Distribution granularity", "type": "float", "position": 20000},
+    "selection": {
+      "title": "Work source selection",
+      "type": "enum",
+      "values": [
+        {"value": "priority", "title": "By priority and hashrate"},
+        {"value": "latency", "title": "Prefer fast and reliable work sources"},
+      ],
+      "position": 20100
+    },
   })
 
 
   def __init__(self, core, state = None):
+    self.scheduler = WorkSourceScheduler(self)
     super(WorkSourceGroup, self).__init__(core, state)
     
     # Populate state dict if this is a new instance
@@ -57,16 +67,19 @@ class WorkSourceGroup(BaseWorkSource):
       self.add_work_source(BaseWorkSource.inflate(core, childstate))
       
 
-  def _reset(self):
-    super(WorkSourceGroup, self)._reset()
-    self.last_index = 0
-    self.last_time = time.time()
-
-      
   def apply_settings(self):
     super(WorkSourceGroup, self).apply_settings()
     if not "distribution_granularity" in self.settings or not self.settings.distribution_granularity:
       self.settings.distribution_granularity = 16
+    if not "selection" in self.settings or not self.settings.selection in ("priority", "latency"):
+      self.settings.selection = "priority"
+    self.invalidate_schedule()
+    
+    
+  def invalidate_schedule(self):
+    # The tree below or the settings of something in it changed, the weights need to be recomputed
+    self.scheduler.invalidate()
+    if self.parent: self.parent.invalidate_schedule()
 
       
   def deflate(self):
@@ -96,6 +109,7 @@ class WorkSourceGroup(BaseWorkSource):
             except Exception as e:
               self.core.log(self, "Could not start work source %s: %s\n" % (worksource.settings.name, traceback.format_exc()), 100, "yB")
           self.children.append(worksource)
+          self.invalidate_schedule()
 
     
   def remove_work_source(self, worksource):
@@ -110,6 +124,7 @@ class WorkSourceGroup(BaseWorkSource):
             except Exception as e:
               self.core.log(self, "Could not stop work source %s: %s\n" % (worksource.settings.name, traceback.format_exc()), 100, "yB")
           self.children.remove(worksource)
+          self.invalidate_schedule()
         
         
   def _start(self):
@@ -134,82 +149,10 @@ class WorkSourceGroup(BaseWorkSource):
     super(WorkSourceGroup, self)._stop()
       
       
-  def _distribute_mhashes(self):
-    with self.statelock:
-      now = time.time()
-      timestep = now - self.last_time
-      self.last_time = now
-      mhashes_remaining = 2**32 / 1000000. * self.settings.distribution_granularity
-      total_priority = 0
-      for child in self.children:
-        if child.settings.enabled:
-          with child.statelock:
-            total_priority += child.settings.priority
-            mhashes = timestep * child.settings.hashrate
-            child.mhashes_pending += mhashes + child.mhashes_deferred * 0.1
-            mhashes_remaining -= mhashes
-            child.mhashes_deferred *= 0.9
-      if mhashes_remaining > 0 and total_priority > 0:
-        unit = mhashes_remaining / total_priority
-        for child in self.children:
-          if child.settings.enabled:
-            with child.statelock:
-              mhashes = unit * child.settings.priority
-              child.mhashes_pending += mhashes
-              mhashes_remaining -= mhashes
-
-
-  def _get_start_index(self):
-    with self.statelock:
-      self.last_index += 1
-      if self.last_index >= len(self.children): self.last_index = 0
-      return self.last_index
-      
-      
-  def _start_fetcher(self, force = False):
-    with self.childlock:
-      children = [child for child in self.children]
-      startindex = self._get_start_index()
-    best = False
-    found = False
-    iteration = 0
-    while not found:
-      index = startindex
-      first = True
-      while index != startindex or first:
-        worksource = children[index]
-        mhashes = 0
-        if not worksource.is_group: mhashes = 2**32 / 1000000.
-        if force or worksource.mhashes_pending >= mhashes:
-          found = True
-          if mhashes: worksource.add_pending_mhashes(-mhashes)
-          result = worksource.start_fetchers(1)
-          if result is not False:
-            if mhashes: worksource.add_pending_mhashes(mhashes)
-            if result: return result
-            best = result
-        index += 1
-        if index >= len(children): index = 0
-        first = False
-      if not found: self._distribute_mhashes()
-      iteration += 1
-      if iteration > 150: break
-      if iteration > 100: force = True
-    return best
-    
-    
   def get_running_fetcher_count(self):
     return sum(child.get_running_fetcher_count() for child in self.children)
 
     
   def start_fetchers(self, count):
     if not self.started or not self.settings.enabled or not self.children or not count: return False
-    started = 0
-    result = False
-    while started < count:
-      result = self._start_fetcher()
-      if not result: result = self._start_fetcher(True)
-      if not result: break
-      started += result
-    if started: return started
-    return result
+    return self.scheduler.start_fetchers(count)
@@ -27,18 +27,21 @@
 
 
 import time
+import math
+import heapq
 import json
-import struct
 import base64
 import traceback
 from binascii import hexlify, unhexlify
+from collections import deque
 from threading import Thread, RLock, Condition
 from core.actualworksource import ActualWorkSource
-from core.job import Job
-try: from queue import Queue
-except: from Queue import Queue
-try: import http.client as http_client
-except ImportError: import httplib as http_client
+from core.eventloop import EventLoop, HTTPConnection
+from core.job import JobTemplate
+from .longpollsupervisor import LongPollSupervisor
+from core.util import Bunch
+try: from queue import Queue, Empty
+except: from Queue import Queue, Empty
 
 
 
@@ -57,8 +60,19 @@ class BCJSONRPCWorkSource(ActualWorkSource):
     "username": {"title": "User name", "type": "string", "position": 1100},
     "password": {"title": "Password", "type": "password", "position": 1120},
     "useragent": {"title": "User agent string", "type": "string", "position": 1200},
+    "transport": {
+      "title": "Transport",
+      "type": "enum",
+      "values": [
+        {"value": "threads", "title": "One thread per connection"},
+        {"value": "eventloop", "title": "Shared event loop"},
+      ],
+      "position": 1250
+    },
     "getworkconnections": {"title": "Job fetching connnections", "type": "int", "position": 1300},
+    "getworkbatchsize": {"title": "Maximum getwork requests per round trip", "type": "int", "position": 1350},
     "uploadconnections": {"title": "Share upload connnections", "type": "int", "position": 1400},
+    "uploadbatchsize": {"title": "Maximum shares per upload request", "type": "int", "position": 1450},
     "longpollconnections": {"title": "Long poll connnections", "type": "int", "position": 1500},
     "expirymargin": {"title": "Job expiry safety margin", "type": "int", "position": 1600},
   })
@@ -71,9 +85,12 @@ class BCJSONRPCWorkSource(ActualWorkSource):
     self.fetcherspending = 0
     self.uploadqueue = Queue()
     self.uploaderthreads = []
+    self.retrylock = Condition()
+    self.retrythread = None
+    self.eventloop = None
     super(BCJSONRPCWorkSource, self).__init__(core, state)
     self.extensions = "longpoll midstate rollntime"
-    self.runcycle = 0
+    self.longpoll = None
     
     
   def apply_settings(self):
@@ -101,10 +118,17 @@ class BCJSONRPCWorkSource(ActualWorkSource):
     if not "useragent" in self.settings: self.settings.useragent = ""
     if self.settings.useragent: self.useragent = self.settings.useragent
     else: self.useragent = "%s (%s)" % (self.core.__class__.version, self.__class__.version)
+    if not "transport" in self.settings or not self.settings.transport in ("threads", "eventloop"):
+      self.settings.transport = "threads"
+    if self.started and self.settings.transport != self.transport: self.async_restart()
     if not "getworkconnections" in self.settings: self.settings.getworkconnections = 1
     if self.started and self.settings.getworkconnections != self.getworkconnections: self.async_restart()
+    if not "getworkbatchsize" in self.settings or not self.settings.getworkbatchsize:
+      self.settings.getworkbatchsize = 4
     if not "uploadconnections" in self.settings: self.settings.uploadconnections = 1
     if self.started and self.settings.uploadconnections != self.uploadconnections: self.async_restart()
+    if not "uploadbatchsize" in self.settings or not self.settings.uploadbatchsize:
+      self.settings.uploadbatchsize = 16
     if not "longpollconnections" in self.settings: self.settings.longpollconnections = 1
     if self.started and self.settings.longpollconnections != self.longpollconnections: self.async_restart()
     if not "expirymargin" in self.settings: self.settings.expirymargin = 5
@@ -113,13 +137,25 @@ class BCJSONRPCWorkSource(ActualWorkSource):
   def _reset(self):
     super(BCJSONRPCWorkSource, self)._reset()
     self.stats.supports_rollntime = None
+    self.stats.supports_batch = None
+    self.stats.roundtripssaved = 0
+    self.jobspergetwork = 1
     self.longpollurl = None
     self.fetchersrunning = 0
     self.fetcherspending = 0
     self.fetcherthreads = []
     self.uploadqueue = Queue()
     self.uploaderthreads = []
+    self.retryqueue = []
+    self.retryseq = 0
+    self.sharelatencies = deque(maxlen = 1000)
+    self.sharesinflight = 0
     self.lastidentifier = None
+    # State of the event loop transport
+    self.connections = []
+    self.idlefetchconns = []
+    self.idleuploadconns = []
+    self.uploadbacklog = deque()
     
     
   def _start(self):
@@ -129,8 +165,17 @@ class BCJSONRPCWorkSource(ActualWorkSource):
     self.getworkconnections = self.settings.getworkconnections
     self.uploadconnections = self.settings.uploadconnections
     self.longpollconnections = self.settings.longpollconnections
+    self.transport = self.settings.transport
     if not self.settings.host or not self.settings.port: return
     self.shutdown = False
+    self.longpoll = LongPollSupervisor(self)
+    if self.transport == "eventloop":
+      # Multiplex all connections of this work source on the shared event loop instead of using threads
+      self.eventloop = EventLoop.acquire(self.core)
+      self.idlefetchconns = [self._create_connection(self.host, self.port) for i in range(self.getworkconnections)]
+      self.idleuploadconns = [self._create_connection(self.host, self.port) for i in range(self.uploadconnections)]
+      self._feed_uploads()
+      return
     for i in range(self.getworkconnections):
       thread = Thread(None, self.fetcher, "%s_fetcher_%d" % (self.settings.name, i))
       thread.daemon = True
@@ -141,21 +186,42 @@ class BCJSONRPCWorkSource(ActualWorkSource):
       thread.daemon = True
       thread.start()
       self.uploaderthreads.append(thread)
+    self.retrythread = Thread(None, self.retrier, "%s_retrier" % self.settings.name)
+    self.retrythread.daemon = True
+    self.retrythread.start()
+    self._feed_uploads()
     
     
   def _stop(self):
-    self.runcycle += 1
     self.shutdown = True
+    if self.longpoll: self.longpoll.stop()
     with self.fetcherlock: self.fetcherlock.notify_all()
     for thread in self.fetcherthreads: thread.join(1)
     for i in self.uploaderthreads: self.uploadqueue.put(None)
     for thread in self.uploaderthreads: thread.join(1)
+    with self.retrylock: self.retrylock.notify_all()
+    if self.retrythread: self.retrythread.join(1)
+    self.retrythread = None
+    if self.eventloop:
+      for conn in self.connections: conn.close()
+      self.eventloop.release()
+      self.eventloop = None
     super(BCJSONRPCWorkSource, self)._stop()
     
     
   def _get_statistics(self, stats, childstats):
     super(BCJSONRPCWorkSource, self)._get_statistics(stats, childstats)
     stats.supports_rollntime = self.stats.supports_rollntime
+    stats.supports_batch = self.stats.supports_batch
+    stats.pipeline_depth = self._get_pipeline_depth()
+    with self.stats.lock:
+      stats.roundtripssaved = self.stats.roundtripssaved
+      latencies = sorted(self.sharelatencies)
+    # Submit latency percentiles over the most recent shares
+    for percentile in (50, 90, 99):
+      if latencies: value = latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)]
+      else: value = None
+      stats["sharelatency_p%d" % percentile] = value
     
   
   def _get_running_fetcher_count(self):
@@ -163,192 +229,408 @@ class BCJSONRPCWorkSource(ActualWorkSource):
   
   
   def _start_fetcher(self):
-    count = len(self.fetcherthreads)
+    if self.eventloop: count = self.getworkconnections
+    else: count = len(self.fetcherthreads)
     if not count: return False
     with self.fetcherlock:
-      if self.fetchersrunning >= count: return 0
+      # Each connection can carry several requests per round trip if the server supports batching
+      if self.fetchersrunning >= count * self._get_pipeline_depth(): return 0
       self.fetchersrunning += 1
       self.fetcherspending += 1
       self.fetcherlock.notify()
+    if self.eventloop: self.eventloop.call_soon(self._async_fetch)
     return 1
 
 
+  def _get_pipeline_depth(self):
+    # Fold as many getwork requests into one round trip as jobs will be consumed during it
+    if self.stats.supports_batch == False or self.settings.getworkbatchsize <= 1: return 1
+    latency = self.estimated_latency
+    if not latency: return 1
+    depth = int(math.ceil(latency * self.core.fetcher.get_consumption_rate() / self.jobspergetwork))
+    return max(1, min(self.settings.getworkbatchsize, depth))
+
+
+  def _take_pending_fetches(self):
+    # Must be called with the fetcher lock held
+    count = min(self.fetcherspending, self._get_pipeline_depth())
+    self.fetcherspending -= count
+    return count
+
+
+  def _build_getwork_request(self, params = [], count = 1):
+    if count > 1: req = json.dumps([{"method": "getwork", "params": params, "id": i} for i in range(count)]).encode("utf_8")
+    else: req = json.dumps({"method": "getwork", "params": params, "id": 0}).encode("utf_8")
+    headers = {"User-Agent": self.useragent, "X-Mining-Extensions": self.extensions,
+               "Content-Type": "application/json", "Content-Length": len(req), "Connection": "Keep-Alive"}
+    if self.auth != None: headers["Authorization"] = self.auth
+    return req, headers
+
+
+  def _create_connection(self, host, port):
+    conn = HTTPConnection(self.eventloop, host, port)
+    self.connections.append(conn)
+    return conn
+
+
+  def _close_connection(self, conn):
+    try: self.connections.remove(conn)
+    except ValueError: pass
+    conn.close()
+
+
   def fetcher(self):
-    conn = None
     while not self.shutdown:
       with self.fetcherlock:
         while not self.fetcherspending:
           self.fetcherlock.wait()
           if self.shutdown: return
-        self.fetcherspending -= 1
-      jobs = None
+        count = self._take_pending_fetches()
+      batches = []
       try:
-        req = json.dumps({"method": "getwork", "params": [], "id": 0}).encode("utf_8")
-        headers = {"User-Agent": self.useragent, "X-Mining-Extensions": self.extensions,
-                   "Content-Type": "application/json", "Content-Length": len(req), "Connection": "Keep-Alive"}
-        if self.auth != None: headers["Authorization"] = self.auth
-        try:
-          if conn:
-            try:
-              now = time.time()
-              conn.request("POST", self.settings.path, req, headers)
-              conn.sock.settimeout(self.settings.getworktimeout)
-              response = conn.getresponse()
-            except:
-              conn = None
-              self.core.log(self, "Keep-alive job fetching connection died\n", 500)
-          if not conn:
-            conn = http_client.HTTPConnection(self.settings.host, self.settings.port, True, self.settings.getworktimeout)
-            now = time.time()
-            conn.request("POST", self.settings.path, req, headers)
-            conn.sock.settimeout(self.settings.getworktimeout)
-            response = conn.getresponse()
-          data = response.read()
-        except:
-          conn = None
-          raise
-        with self.statelock:
-          if not self.settings.longpollconnections: self.signals_new_block = False
-          else:
-            lpfound = False
-            headers = response.getheaders()
-            for h in headers:
-              if h[0].lower() == "x-long-polling":
-                lpfound = True
-                url = h[1]
-                if url == self.longpollurl: break
-                self.longpollurl = url
-                try:
-                  if url[0] == "/": url = "http://" + self.settings.host + ":" + str(self.settings.port) + url
-                  if url[:7] != "http://": raise Exception("Long poll URL isn't HTTP!")
-                  parts = url[7:].split("/", 1)
-                  if len(parts) == 2: path = "/" + parts[1]
-                  else: path = "/"
-                  parts = parts[0].split(":")
-                  if len(parts) != 2: raise Exception("Long poll URL contains host but no port!")
-                  host = parts[0]
-                  port = int(parts[1])
-                  self.core.log(self, "Found long polling URL: %s\n" % (url), 500, "g")
-                  self.signals_new_block = True
-                  self.runcycle += 1
-                  for i in range(self.settings.longpollconnections):
-                    thread = Thread(None, self._longpollingworker, "%s_longpolling_%d" % (self.settings.name, i), (host, port, path))
-                    thread.daemon = True
-                    thread.start()
-                except Exception as e:
-                  self.core.log(self, "Invalid long polling URL: %s (%s)\n" % (url, str(e)), 200, "y")
-                break
-            if self.signals_new_block and not lpfound:
-              self.runcycle += 1
-              self.signals_new_block = False
-        jobs = self._build_jobs(response, data, now)
+        req, headers = self._build_getwork_request(count = count)
+        now = time.time()
+        response, data = self.core.httppool.request(self.settings.host, self.settings.port, self.auth, "POST",
+                                                    self.settings.path, req, headers, self.settings.getworktimeout)
+        latency = time.time() - now
+        batches = self._handle_getwork_response(response, data, now, count)
       except:
         self.core.log(self, "Error while fetching job: %s\n" % (traceback.format_exc()), 200, "y")
         self._handle_error()
       finally:
-        with self.fetcherlock: self.fetchersrunning -= 1
-      if jobs:
-        self._push_jobs(jobs)
-        self.core.log(self, "Got %d jobs from getwork response\n" % (len(jobs)), 500)
+        with self.fetcherlock: self.fetchersrunning -= count
+      for jobs in batches: self._push_jobs(jobs, latency)
+
+
+  def _async_fetch(self):
+    # Runs on the event loop thread
+    with self.fetcherlock:
+      while self.fetcherspending and self.idlefetchconns:
+        conn = self.idlefetchconns.pop()
+        count = self._take_pending_fetches()
+        req, headers = self._build_getwork_request(count = count)
+        conn.request("POST", self.settings.path, req, headers, self._async_fetch_done(conn, count, time.time()),
+                     self.settings.getworktimeout)
+
+
+  def _async_fetch_done(self, conn, count, now):
+    def callback(response, error):
+      # The work source was stopped in the meantime
+      if conn.closed: return
+      batches = []
+      try:
+        if error: raise error
+        latency = time.time() - now
+        batches = self._handle_getwork_response(response, response.data, now, count)
+      except:
+        self.core.log(self, "Error while fetching job: %s\n" % (traceback.format_exc()), 200, "y")
+        self._handle_error()
+      finally:
+        with self.fetcherlock:
+          self.fetchersrunning -= count
+          self.idlefetchconns.append(conn)
+      for jobs in batches: self._push_jobs(jobs, latency)
+      self._async_fetch()
+    return callback
+
+
+  def _handle_getwork_response(self, response, data, now, count):
+    # Returns one list of jobs per getwork request that was answered
+    self._check_longpoll_header(response)
+    if count == 1:
+      jobs = self._build_jobs(response, data, now)
+      self.core.log(self, "Got %d jobs from getwork response\n" % (JobTemplate.count_jobs(jobs)), 500)
+      return [jobs]
+    roll_ntime, expiry = self._parse_job_headers(response)
+    reply = json.loads(data.decode("utf_8"))
+    if not isinstance(reply, list):
+      # The requests are lost, but the fetcher controller will just ask again
+      self.stats.supports_batch = False
+      self.core.log(self, "Server doesn't support batched getwork requests, falling back to single requests\n", 400, "y")
+      return []
+    batches = []
+    replies = dict((item.get("id"), item) for item in reply if isinstance(item, dict))
+    # Requests that the server couldn't make sense of are answered with a null id
+    error = replies[None].get("error") if None in replies else None
+    for i in range(count):
+      item = replies.get(i)
+      if not item: error = error or "No reply to request %d" % i
+      elif item.get("error") is None and item.get("result"): batches.append(self._build_jobs_from_result(item["result"], now, roll_ntime, expiry))
+      else: error = item.get("error")
+    if not batches: raise Exception("All %d batched getwork requests failed: %s" % (count, error))
+    self.stats.supports_batch = True
+    with self.stats.lock: self.stats.roundtripssaved += len(batches) - 1
+    self.core.log(self, "Got %d jobs from batched getwork response (%d requests)\n" % (sum(JobTemplate.count_jobs(jobs) for jobs in batches), count), 500)
+    return batches
+
+
+  def _check_longpoll_header(self, response):
+    with self.statelock:
+      if not self.settings.longpollconnections: self.signals_new_block = False
+      else:
+        lpfound = False
+        headers = response.getheaders()
+        for h in headers:
+          if h[0].lower() == "x-long-polling":
+            lpfound = True
+            url = h[1]
+            if url == self.longpollurl: break
+            self.longpollurl = url
+            try:
+              if url[0] == "/": url = "http://" + self.settings.host + ":" + str(self.settings.port) + url
+              if url[:7] != "http://": raise Exception("Long poll URL isn't HTTP!")
+              parts = url[7:].split("/", 1)
+              if len(parts) == 2: path = "/" + parts[1]
+              else: path = "/"
+              parts = parts[0].split(":")
+              if len(parts) != 2: raise Exception("Long poll URL contains host but no port!")
+              host = parts[0]
+              port = int(parts[1])
+              self.core.log(self, "Found long polling URL: %s\n" % (url), 500, "g")
+              self.signals_new_block = True
+              # Requests to the previous URL (if any) are aborted by the supervisor
+              self.longpoll.set_target((host, port, path), self.settings.longpollconnections)
+            except Exception as e:
+              self.core.log(self, "Invalid long polling URL: %s (%s)\n" % (url, str(e)), 200, "y")
+            break
+        if self.signals_new_block and not lpfound:
+          self.longpoll.set_target(None, 0)
+          self.longpollurl = None
+          self.signals_new_block = False
         
         
   def nonce_found(self, job, data, nonce, noncediff):
-    self.uploadqueue.put((job, data, nonce, noncediff))
+    # Spooled shares enter the upload pipeline from the spool, so that memory use stays bounded during outages
+    if self._spool_share(job, data, noncediff) is not None: return self._feed_uploads()
+    # Shares carry their submission timestamp and retry count through the upload pipeline
+    self._queue_shares([Bunch(job = job, data = data, nonce = nonce, noncediff = noncediff,
+                              submitted = time.time(), tries = 0, record = None)])
+
+
+  def _replay_spool(self):
+    # The spool is fed into the upload pipeline once the transport is up, see _start
+    pass
+
+
+  def _feed_uploads(self):
+    spool = self.spool
+    if not spool: return
+    shares = []
+    with spool.lock:
+      while self.sharesinflight < self.settings.uploadbatchsize * self.uploadconnections * 2:
+        record = spool.take()
+        if not record: break
+        share = Bunch(job = record.job, data = record.data, nonce = record.data[76:80],
+                      noncediff = record.noncediff, submitted = record.timestamp, tries = 0, record = record)
+        reason = self._is_share_stale(share.data, record.expiry)
+        if reason:
+          self._expire_share(record, share.nonce, share.noncediff, reason)
+          continue
+        self.sharesinflight += 1
+        shares.append(share)
+    if shares: self._queue_shares(shares)
+
+
+  def _queue_shares(self, shares):
+    if self.eventloop: self.eventloop.call_soon(self._async_queue_shares, shares)
+    else:
+      for share in shares: self.uploadqueue.put(share)
+
+
+  def _share_done(self, share):
+    if not share.record: return
+    spool = share.record.spool
+    with spool.lock:
+      spool.complete(share.record.slot)
+      # Shares from before a restart don't count against the current window
+      if spool is self.spool: self.sharesinflight -= 1
+    self._feed_uploads()
+
+
+  def _check_share_expiry(self, share):
+    # Returns True if the share was dropped because it can't be accepted anymore
+    if not share.record: return False
+    reason = self._is_share_stale(share.data, share.record.expiry)
+    if not reason: return False
+    self._expire_share(None, share.nonce, share.noncediff, reason)
+    self._share_done(share)
+    return True
+
+
+  def _get_upload_batch_size(self):
+    if self.stats.supports_batch == False: return 1
+    return max(1, self.settings.uploadbatchsize)
+
+
+  def _build_upload_request(self, shares):
+    params = [[hexlify(share.data).decode("ascii")] for share in shares]
+    if len(params) > 1:
+      req = json.dumps([{"method": "getwork", "params": p, "id": i} for i, p in enumerate(params)]).encode("utf_8")
+    else: req = json.dumps({"method": "getwork", "params": params[0], "id": 0}).encode("utf_8")
+    headers = {"User-Agent": self.useragent, "X-Mining-Extensions": self.extensions,
+               "Content-Type": "application/json", "Content-Length": len(req), "Connection": "Keep-Alive"}
+    if self.auth != None: headers["Authorization"] = self.auth
+    return req, headers
+
+
+  def _handle_upload_response(self, response, rdata, shares):
+    # Returns the shares that need to be sent again
+    if len(shares) == 1:
+      result = self._get_upload_result(response, json.loads(rdata.decode("utf_8")))
+      self._handle_success()
+      self._share_uploaded(shares[0], result)
+      return []
+    reply = json.loads(rdata.decode("utf_8"))
+    if not isinstance(reply, list):
+      # The server didn't understand the batch, send the shares one by one from now on
+      self.stats.supports_batch = False
+      self.core.log(self, "Server doesn't support batched requests, submitting shares individually\n", 400)
+      return shares
+    self._handle_success()
+    self.stats.supports_batch = True
+    replies = dict((item.get("id"), item) for item in reply if isinstance(item, dict))
+    retry = []
+    for i, share in enumerate(shares):
+      if i in replies: self._share_uploaded(share, self._get_upload_result(None, replies[i]))
+      else: retry.append(share)
+    with self.stats.lock: self.stats.roundtripssaved += max(0, len(shares) - len(retry) - 1)
+    return retry
+
+
+  def _share_uploaded(self, share, result):
+    with self.stats.lock: self.sharelatencies.append(time.time() - share.submitted)
+    if share.job: share.job.nonce_handled_callback(share.nonce, share.noncediff, result)
+    else: self._spooled_share_handled(share.nonce, share.noncediff, share.record.difficulty, result)
+    self._share_done(share)
+
+
+  def _share_upload_failed(self, shares):
+    for share in shares:
+      self.core.log(self, "Error while sending share %s (difficulty %.5f): %s\n" % (hexlify(share.nonce).decode("ascii"), share.noncediff, traceback.format_exc()), 200, "y")
+    self._handle_error(True)
+
+
+  def _retry_shares(self, shares):
+    # Failed shares wait on a side queue, so that they don't hold back healthy shares
+    with self.retrylock:
+      for share in shares:
+        share.tries += 1
+        self.retryseq += 1
+        heapq.heappush(self.retryqueue, (time.time() + min(30, share.tries), self.retryseq, share))
+      self.retrylock.notify()
+
+
+  def retrier(self):
+    with self.retrylock:
+      while not self.shutdown:
+        now = time.time()
+        while self.retryqueue and self.retryqueue[0][0] <= now:
+          share = heapq.heappop(self.retryqueue)[2]
+          if not self._check_share_expiry(share): self.uploadqueue.put(share)
+        if self.retryqueue: self.retrylock.wait(self.retryqueue[0][0] - now)
+        else: self.retrylock.wait()
+
+
+  def _async_queue_shares(self, shares):
+    self.uploadbacklog.extend(shares)
+    self._async_upload()
+
+
+  def _async_upload(self):
+    # Runs on the event loop thread, so there is no need for locking
+    while self.uploadbacklog and self.idleuploadconns and self.eventloop:
+      shares = []
+      while self.uploadbacklog and len(shares) < self._get_upload_batch_size():
+        shares.append(self.uploadbacklog.popleft())
+      conn = self.idleuploadconns.pop()
+      req, headers = self._build_upload_request(shares)
+      conn.request("POST", self.settings.path, req, headers, self._async_upload_done(conn, shares),
+                   self.settings.sendsharetimeout)
+
+
+  def _async_upload_done(self, conn, shares):
+    def callback(response, error):
+      if conn.closed: return
+      self.idleuploadconns.append(conn)
+      try:
+        if error: raise error
+        retry = self._handle_upload_response(response, response.data, shares)
+        self.uploadbacklog.extendleft(reversed(retry))
+      except:
+        self._share_upload_failed(shares)
+        # Retry later, but don't hold back other shares in the meantime
+        for share in shares:
+          share.tries += 1
+          conn.loop.call_later(min(30, share.tries), self._async_retry_upload, self.uploadbacklog, share)
+      self._async_upload()
+    return callback
+
+
+  def _async_retry_upload(self, backlog, share):
+    # Shares are dropped if the work source was restarted in the meantime, like with the threaded transport
+    if self._check_share_expiry(share): return
+    backlog.appendleft(share)
+    self._async_upload()
       
       
   def uploader(self):
-    conn = None
     while not self.shutdown:
       share = self.uploadqueue.get()
       if not share: continue
-      job, data, nonce, noncediff = share
-      tries = 0
-      while True:
-        try:
-          req = json.dumps({"method": "getwork", "params": [hexlify(data).decode("ascii")], "id": 0}).encode("utf_8")
-          headers = {"User-Agent": self.useragent, "X-Mining-Extensions": self.extensions,
-                     "Content-Type": "application/json", "Content-Length": len(req)}
-          if self.auth != None: headers["Authorization"] = self.auth
-          try:
-            if conn:
-              try:
-                conn.request("POST", self.settings.path, req, headers)
-                response = conn.getresponse()
-              except:
-                conn = None
-                self.core.log(self, "Keep-alive share upload connection died\n", 500)
-            if not conn:
-              conn = http_client.HTTPConnection(self.settings.host, self.settings.port, True, self.settings.sendsharetimeout)
-              conn.request("POST", self.settings.path, req, headers)
-              response = conn.getresponse()
-            rdata = response.read()
-          except:
-            conn = None
-            raise
-          rdata = json.loads(rdata.decode("utf_8"))
-          result = False
-          if rdata["result"] == True: result = True
-          elif rdata["error"] != None: result =  rdata["error"]
-          else:
-            headers = response.getheaders()
-            for h in headers:
-              if h[0].lower() == "x-reject-reason":
-                result = h[1]
-                break
-          self._handle_success()
-          job.nonce_handled_callback(nonce, noncediff, result)
+      # Coalesce whatever else is already queued into the same request
+      shares = [share]
+      while len(shares) < self._get_upload_batch_size():
+        try: share = self.uploadqueue.get_nowait()
+        except Empty: break
+        if not share:
+          # Leave the shutdown wakeup for whoever it was meant for
+          self.uploadqueue.put(None)
           break
-        except:
-          self.core.log(self, "Error while sending share %s (difficulty %.5f): %s\n" % (hexlify(nonce).decode("ascii"), noncediff, traceback.format_exc()), 200, "y")
-          tries += 1
-          self._handle_error(True)
-          time.sleep(min(30, tries))
-
-
-  def _longpollingworker(self, host, port, path):
-    runcycle = self.runcycle
-    tries = 0
-    starttime = time.time()
-    conn = None
-    while True:
-      if self.runcycle > runcycle: return
+        shares.append(share)
       try:
-        headers = {"User-Agent": self.useragent, "X-Mining-Extensions": self.extensions, "Connection": "Keep-Alive"}
-        if self.auth != None: headers["Authorization"] = self.auth
-        if conn:
-          try:
-            if conn.sock: conn.sock.settimeout(self.settings.longpolltimeout)
-            conn.request("GET", path, None, headers)
-            conn.sock.settimeout(self.settings.longpollresponsetimeout)
-            response = conn.getresponse()
-          except:
-            conn = None
-            self.core.log(self, "Keep-alive long poll connection died\n", 500)
-        if not conn:
-          conn = http_client.HTTPConnection(host, port, True, self.settings.longpolltimeout)
-          conn.request("GET", path, None, headers)
-          conn.sock.settimeout(self.settings.longpollresponsetimeout)
-          response = conn.getresponse()
-        if self.runcycle > runcycle: return
-        data = response.read()
-        jobs = self._build_jobs(response, data, time.time() - 1, True)
-        if not jobs:
-          self.core.log(self, "Got empty long poll response\n", 500)
-          continue
-        self._cancel_jobs(True)
-        self._push_jobs(jobs)
-        self.core.log(self, "Got %d jobs from long poll response\n" % (len(jobs)), 500)
+        req, headers = self._build_upload_request(shares)
+        response, rdata = self.core.httppool.request(self.settings.host, self.settings.port, self.auth, "POST",
+                                                     self.settings.path, req, headers, self.settings.sendsharetimeout)
+        retry = self._handle_upload_response(response, rdata, shares)
+        for share in retry: self.uploadqueue.put(share)
       except:
-        conn = None
-        self.core.log(self, "Long poll failed: %s\n" % (traceback.format_exc()), 200, "y")
-        tries += 1
-        if time.time() - starttime >= 60: tries = 0
-        if tries > 5: time.sleep(30)
-        else: time.sleep(1)
-        starttime = time.time()
+        self._share_upload_failed(shares)
+        self._retry_shares(shares)
+
+
+  def _get_upload_result(self, response, reply):
+    result = False
+    if reply["result"] == True: result = True
+    elif reply["error"] != None: result = reply["error"]
+    elif reply.get("reject-reason"): result = reply["reject-reason"]
+    elif response:
+      headers = response.getheaders()
+      for h in headers:
+        if h[0].lower() == "x-reject-reason":
+          result = h[1]
+          break
+    return result
+
+
+  def _handle_longpoll_response(self, response, data):
+    jobs = self._build_jobs(response, data, time.time() - 1, True)
+    if not jobs:
+      self.core.log(self, "Got empty long poll response\n", 500)
+      return
+    self._cancel_jobs(True)
+    self._push_jobs(jobs)
+    self.core.log(self, "Got %d jobs from long poll response\n" % (JobTemplate.count_jobs(jobs)), 500)
         
         
   def _build_jobs(self, response, data, now, ignoreempty = False):
+    roll_ntime, expiry = self._parse_job_headers(response)
+    response = data.decode("utf_8")
+    if len(response) == 0 and ignoreempty: return
+    response = json.loads(response)
+    return self._build_jobs_from_result(response["result"], now, roll_ntime, expiry)
+
+
+  def _parse_job_headers(self, response):
     roll_ntime = 1
     expiry = 60
     isp2pool = False
@@ -364,19 +646,18 @@ class BCJSONRPCWorkSource(ActualWorkSource):
         expiry = roll_ntime
     if isp2pool: expiry = 60
     self.stats.supports_rollntime = roll_ntime > 1
-    response = data.decode("utf_8")
-    if len(response) == 0 and ignoreempty: return
-    response = json.loads(response)
-    data = unhexlify(response["result"]["data"].encode("ascii"))
-    target = unhexlify(response["result"]["target"].encode("ascii"))
-    try: identifier = int(response["result"]["identifier"])
+    self.jobspergetwork = roll_ntime
+    return roll_ntime, expiry
+
+
+  def _build_jobs_from_result(self, result, now, roll_ntime, expiry):
+    data = unhexlify(result["data"].encode("ascii"))
+    target = unhexlify(result["target"].encode("ascii"))
+    try: identifier = int(result["identifier"])
     except: identifier = None
     if identifier != self.lastidentifier:
       self._cancel_jobs()
       self.lastidentifier = identifier
-    midstate = Job.calculate_midstate(data)
-    prefix = data[:68]
-    timebase = struct.unpack(">I", data[68:72])[0]
-    suffix = data[72:]
-    return [Job(self.core, self, now + expiry - self.settings.expirymargin, prefix + struct.pack(">I", timebase + i) + suffix, target, midstate, identifier) for i in range(roll_ntime)]
+    # The jobs for all ntime values are only created once workers take them from the queue
+    return [JobTemplate(self.core, self, now + expiry - self.settings.expirymargin, data, target, roll_ntime, None, identifier)]
   
\ No newline at end of file
@@ -0,0 +1,180 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+################################
+# Bitcoin long poll supervisor #
+################################
+
+
+
+import time
+import socket
+import traceback
+from threading import Condition, Thread
+
+
+
+class LongPollSupervisor(object):
+  # Owns the long poll connections of a BCJSONRPC work source. Whenever the long poll URL
+  # changes or goes away, the requests to the old one are aborted right away, instead of
+  # lingering until their responses time out. There is one slot per configured connection,
+  # and each slot has at most one request in flight.
+
+
+  def __init__(self, worksource):
+    self.worksource = worksource
+    self.core = worksource.core
+    self.lock = Condition()
+    self.shutdown = False
+    self.target = None
+    self.count = 0
+    self.generation = 0
+    self.threads = []
+    # Connections that are in use, by slot
+    self.active = {}
+
+
+  def set_target(self, target, count):
+    # target is a (host, port, path) tuple, or None to stop long polling
+    with self.lock:
+      if not target or self.shutdown: target, count = None, 0
+      if target == self.target and count == self.count: return
+      self.target = target
+      self.count = count
+      self.generation += 1
+      generation = self.generation
+      active = list(self.active.values())
+      self.active = {}
+      self.lock.notify_all()
+      if not self.worksource.eventloop:
+        while len(self.threads) < count:
+          thread = Thread(None, self.worker, "%s_longpolling_%d" % (self.worksource.settings.name, len(self.threads)), (len(self.threads),))
+          thread.daemon = True
+          thread.start()
+          self.threads.append(thread)
+    for conn in active: self._abort(conn)
+    if self.worksource.eventloop:
+      for slot in range(count): self._async_longpoll(slot, generation, target, 0, time.time())
+
+
+  def stop(self):
+    with self.lock:
+      self.shutdown = True
+      self.lock.notify_all()
+    self.set_target(None, 0)
+    for thread in self.threads: thread.join(1)
+    self.threads = []
+
+
+  def _abort(self, conn):
+    if self.worksource.eventloop: return self.worksource._close_connection(conn)
+    # Shutting the socket down makes the thread that is blocked reading from it return immediately
+    sock = conn.sock
+    if not sock: return
+    try: sock.shutdown(socket.SHUT_RDWR)
+    except: pass
+
+
+  def _is_current(self, slot, generation):
+    return generation == self.generation and slot < self.count and not self.shutdown
+
+
+  def worker(self, slot):
+    tries = 0
+    starttime = time.time()
+    while True:
+      with self.lock:
+        while not self.shutdown and slot >= self.count: self.lock.wait()
+        if self.shutdown: return
+        generation = self.generation
+        host, port, path = self.target
+      ws = self.worksource
+      conn = None
+      try:
+        headers = {"User-Agent": ws.useragent, "X-Mining-Extensions": ws.extensions, "Connection": "Keep-Alive"}
+        if ws.auth != None: headers["Authorization"] = ws.auth
+        conn = self.core.httppool.get(host, port, ws.auth, ws.settings.longpolltimeout)
+        with self.lock:
+          if not self._is_current(slot, generation):
+            self.core.httppool.release(conn)
+            continue
+          self.active[slot] = conn
+        try:
+          conn.request("GET", path, None, headers)
+          conn.sock.settimeout(ws.settings.longpollresponsetimeout)
+          response = conn.getresponse()
+          data = response.read()
+        finally:
+          with self.lock:
+            if self.active.get(slot) is conn: del self.active[slot]
+        if not self._is_current(slot, generation):
+          conn.close()
+          continue
+        self.core.httppool.release(conn)
+        ws._handle_longpoll_response(response, data)
+      except:
+        # Aborted because the URL changed, not an error
+        if not self._is_current(slot, generation):
+          if conn: conn.close()
+          continue
+        if conn: self.core.httppool.discard(conn)
+        self.core.log(ws, "Long poll failed: %s\n" % (traceback.format_exc()), 200, "y")
+        tries += 1
+        if time.time() - starttime >= 60: tries = 0
+        with self.lock:
+          if self._is_current(slot, generation): self.lock.wait(30 if tries > 5 else 1)
+        starttime = time.time()
+
+
+  def _async_longpoll(self, slot, generation, target, tries, starttime, conn = None):
+    # The slot keeps its connection until the URL changes, the requests are aborted by closing it
+    ws = self.worksource
+    with self.lock:
+      if not self._is_current(slot, generation): return
+      if not conn:
+        conn = ws._create_connection(target[0], target[1])
+        self.active[slot] = conn
+    headers = {"User-Agent": ws.useragent, "X-Mining-Extensions": ws.extensions, "Connection": "Keep-Alive"}
+    if ws.auth != None: headers["Authorization"] = ws.auth
+    conn.request("GET", target[2], None, headers, self._async_longpoll_done(conn, slot, generation, target, tries, starttime),
+                 ws.settings.longpolltimeout, ws.settings.longpollresponsetimeout)
+
+
+  def _async_longpoll_done(self, conn, slot, generation, target, tries, starttime):
+    def callback(response, error):
+      ws = self.worksource
+      if not self._is_current(slot, generation): return
+      delay = 0
+      retries = tries
+      retrystart = starttime
+      try:
+        if error: raise error
+        ws._handle_longpoll_response(response, response.data)
+      except:
+        self.core.log(ws, "Long poll failed: %s\n" % (traceback.format_exc()), 200, "y")
+        retries += 1
+        if time.time() - retrystart >= 60: retries = 0
+        if retries > 5: delay = 30
+        else: delay = 1
+        retrystart = time.time()
+      conn.loop.call_later(delay, self._async_longpoll, slot, generation, target, retries, retrystart, conn)
+    return callback
@@ -0,0 +1,3 @@
+from .cpuworker import CPUWorker
+
+workerclasses = [CPUWorker]
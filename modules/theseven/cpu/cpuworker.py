@@ -0,0 +1,262 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+###############################
+# CPU worker interface module #
+###############################
+
+
+
+import time
+import signal
+import struct
+import traceback
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from threading import Condition, Thread
+from core.baseworker import BaseWorker
+from .hasher import scan
+
+
+
+# Worker main class, referenced from __init__.py
+class CPUWorker(BaseWorker):
+  
+  version = "theseven.cpu worker v0.1.0beta"
+  default_name = "Untitled CPU worker"
+  settings = dict(BaseWorker.settings, **{
+    "processes": {"title": "Number of processes", "type": "int", "position": 1000},
+    "batchsize": {"title": "Nonces per batch", "type": "int", "position": 1100},
+    "jobinterval": {"title": "Job interval", "type": "float", "position": 1200},
+  })
+  
+  
+  # Constructor, gets passed a reference to the miner core and the saved worker state, if present
+  def __init__(self, core, state = None):
+    # Let our superclass do some basic initialization and restore the state if neccessary
+    super(CPUWorker, self).__init__(core, state)
+
+    # Initialize wakeup flag for the main thread.
+    # This serves as a lock at the same time.
+    self.wakeup = Condition()
+
+    
+  # Validate settings, filling them with default values if neccessary.
+  # Called from the constructor and after every settings change.
+  def apply_settings(self):
+    # Let our superclass handle everything that isn't specific to this worker module
+    super(CPUWorker, self).apply_settings()
+    if not "processes" in self.settings or not self.settings.processes: self.settings.processes = cpu_count()
+    if not "batchsize" in self.settings or not self.settings.batchsize: self.settings.batchsize = 16384
+    if not "jobinterval" in self.settings or not self.settings.jobinterval: self.settings.jobinterval = 30
+    # We can't resize the process pool on the fly, so trigger a restart if the number of processes changed.
+    # self.processes is a cached copy of self.settings.processes
+    if self.started and self.settings.processes != self.processes: self.async_restart()
+    
+
+  # Reset our state. Called both from the constructor and from self.start().
+  def _reset(self):
+    # Let our superclass handle everything that isn't specific to this worker module
+    super(CPUWorker, self)._reset()
+    # This needs to be set here in order to make the equality check in apply_settings() happy,
+    # when it is run before starting the module for the first time. (It is called from the constructor.)
+    self.processes = None
+    # Finished batches, pushed by the pool's result handler thread
+    self.results = deque()
+    # Sequence number of the current job, to tell late batches of previous jobs apart
+    self.jobnumber = 0
+
+
+  # Start up the worker module. This is protected against multiple calls and concurrency by a wrapper.
+  def _start(self):
+    # Let our superclass handle everything that isn't specific to this worker module
+    super(CPUWorker, self)._start()
+    # Cache the number of processes, as we don't like it to change on the fly
+    self.processes = self.settings.processes
+    # Assume a default job interval to make the core start fetching work for us.
+    # The actual hash rate will be measured (and this adjusted to the correct value) later.
+    self.jobs_per_second = 1. / self.settings.jobinterval
+    # All processes of the pool work on the same job
+    self.parallel_jobs = 1
+    # Reset the shutdown flag for our threads
+    self.shutdown = False
+    # Start up the main thread, which fetches jobs and feeds the process pool.
+    self.mainthread = Thread(None, self.main, self.settings.name + "_main")
+    self.mainthread.daemon = True
+    self.mainthread.start()
+  
+  
+  # Shut down the worker module. This is protected against multiple calls and concurrency by a wrapper.
+  def _stop(self):
+    # Let our superclass handle everything that isn't specific to this worker module
+    super(CPUWorker, self)._stop()
+    # Set the shutdown flag for our threads, making them terminate ASAP.
+    self.shutdown = True
+    # Trigger the main thread's wakeup flag, to make it actually look at the shutdown flag.
+    with self.wakeup: self.wakeup.notify()
+    # Wait for the main thread to terminate, it will shut down the process pool.
+    self.mainthread.join(10)
+
+      
+  # This function should interrupt processing of the specified job if possible.
+  # This is neccesary to avoid producing stale shares after a new block was found,
+  # or if a job expires for some other reason. If we don't know about the job, just ignore it.
+  # Never attempts to fetch a new job in here, always do that asynchronously!
+  # This needs to be very lightweight and fast.
+  def notify_canceled(self, job, graceful):
+    with self.wakeup:
+      if self.job == job: self.wakeup.notify()
+
+
+  # Called by the process pool's result handler thread whenever a batch has been hashed
+  def _batch_done(self, result):
+    with self.wakeup:
+      self.results.append(result)
+      self.wakeup.notify()
+        
+        
+  # Main thread entry point
+  # This thread is responsible for fetching work and distributing it across the process pool.
+  def main(self):
+    # If we're currently shutting down, just die. If not, loop forever,
+    # to recover from possible errors caught by the huge try statement inside this loop.
+    # Count how often the except for that try was hit recently. This will be reset if
+    # there was no exception for at least 5 minutes since the last one.
+    tries = 0
+    while not self.shutdown:
+      pool = None
+      try:
+        # Record our starting timestamp, in order to back off if we repeatedly die
+        starttime = time.time()
+        self.stats.mhps = 0
+        self.job = None
+        # Hash rate measurement window
+        self.speedstart = time.time()
+        self.speedhashes = 0
+
+        pool = Pool(self.processes, _init_process)
+
+        # We keep control of the wakeup lock at all times unless we're sleeping
+        self.wakeup.acquire()
+        try:
+          while not self.shutdown:
+            # Fetch a job, add 2 seconds safety margin to the requested minimum expiration time.
+            # Blocks until one is available. Because of this we need to release the
+            # wakeup lock temporarily in order to avoid possible deadlocks.
+            self.wakeup.release()
+            try: job = self.core.get_job(self, self.settings.jobinterval + 2)
+            finally: self.wakeup.acquire()
+            # If a new block was found while we were fetching that job, just discard it and get a new one.
+            if job.canceled:
+              job.destroy()
+              continue
+            self.job = job
+            job.starttime = time.time()
+            self._mine(pool, job)
+            self.job = None
+            job.destroy()
+        finally: self.wakeup.release()
+
+      # If something went wrong...
+      except Exception as e:
+        # ...complain about it!
+        self.core.log(self, "%s\n" % traceback.format_exc(), 100, "rB")
+      finally:
+        # We're not doing productive work any more, update stats and destroy current job
+        if self.job: self.job.destroy()
+        self.job = None
+        self.stats.mhps = 0
+        # Kill the process pool, it might still be working on batches of the last job
+        if pool:
+          try: pool.terminate()
+          except: pass
+        # If we aren't shutting down, figure out if there have been many errors recently,
+        # and if yes, wait a bit longer until restarting the worker.
+        if not self.shutdown:
+          tries += 1
+          if time.time() - starttime >= 300: tries = 0
+          with self.wakeup:
+            if tries > 5: self.wakeup.wait(30)
+            else: self.wakeup.wait(1)
+        # Restart (handled by "while not self.shutdown:" loop above)
+
+
+  # Splits the nonce range of a job into batches and feeds them to the process pool,
+  # until the job interval is over, the keyspace is exhausted or the job is canceled.
+  # Called with the wakeup lock held.
+  def _mine(self, pool, job):
+    self.jobnumber += 1
+    jobnumber = self.jobnumber
+    midstate = struct.unpack("<8I", job.midstate)
+    data = struct.unpack("<3I", job.data[64:76])
+    deadline = job.starttime + self.settings.jobinterval
+    nextnonce = 0
+    inflight = {}
+    while True:
+      # Keep two batches per process queued, so that no process runs dry while we collect results
+      while not self.shutdown and not job.canceled and nextnonce < 2**32 \
+        and len(inflight) < 2 * self.processes and time.time() < deadline:
+        count = min(self.settings.batchsize, 2**32 - nextnonce)
+        inflight[nextnonce] = pool.apply_async(_scan, (jobnumber, midstate, data, nextnonce, count), callback = self._batch_done)
+        nextnonce += count
+      # Batches that are still in flight after a cancellation or shutdown are simply dropped
+      if self.shutdown or job.canceled or not inflight: return
+      if not self.results:
+        self.wakeup.wait(1)
+        # Exceptions in the pool processes don't trigger the callback, so check for them here
+        for result in inflight.values():
+          if result.ready() and not result.successful(): result.get()
+      while self.results:
+        number, start, count, nonces = self.results.popleft()
+        if number != jobnumber: continue
+        del inflight[start]
+        job.hashes_processed(count)
+        for nonce in nonces: job.nonce_found(struct.pack("<I", nonce))
+        self._account_hashes(count)
+
+
+  # Updates the hash rate measurement. Called with the wakeup lock held.
+  def _account_hashes(self, hashes):
+    self.speedhashes += hashes
+    now = time.time()
+    if now - self.speedstart < 5: return
+    self.stats.mhps = self.speedhashes / 1000000. / (now - self.speedstart)
+    self.core.event(350, self, "speed", self.stats.mhps * 1000, "%f MH/s" % self.stats.mhps, worker = self)
+    self.speedstart = now
+    self.speedhashes = 0
+    # Fast machines might exhaust the keyspace of a job before the job interval is over
+    jobs_per_second = max(1. / self.settings.jobinterval, self.stats.mhps * 1000000. / 2**32)
+    if abs(jobs_per_second - self.jobs_per_second) > self.jobs_per_second * 0.1:
+      self.jobs_per_second = jobs_per_second
+      self.core.notify_speed_changed(self)
+
+
+
+# Runs in the pool processes on startup. Ctrl+C is handled by the main process,
+# which will terminate the pool (SIGTERM must stay enabled for that to work).
+def _init_process():
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# Runs in the pool processes. Tags the results with the job number.
+def _scan(jobnumber, midstate, data, start, count):
+  return jobnumber, start, count, scan(midstate, data, start, count)
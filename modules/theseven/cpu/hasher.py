@@ -0,0 +1,100 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+########################################
+# CPU worker NumPy SHA256 hashing core #
+########################################
+
+
+
+# This module is imported by the pool processes as well, so keep it free of anything
+# that would drag the rest of the miner into them.
+
+
+
+import numpy
+
+
+
+_k = (0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+      0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+      0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+      0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+      0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+      0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+      0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+      0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2)
+_iv = (0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
+
+
+# Both of these work on python ints (which need to be < 2**32) as well as on uint32 arrays.
+
+
+def _schedule(w, length):
+  # Extends the message schedule w to the specified number of words
+  for i in range(len(w), length):
+    x = w[i - 15]
+    y = w[i - 2]
+    # Some of the words might be integers while others are arrays,
+    # so the partial terms need to be truncated to 32 bits as well.
+    w.append((w[i - 16] + w[i - 7] + (((x >> 7 | x << 25) ^ (x >> 18 | x << 14) ^ (x >> 3)) & 0xffffffff)
+              + (((y >> 17 | y << 15) ^ (y >> 19 | y << 13) ^ (y >> 10)) & 0xffffffff)) & 0xffffffff)
+
+
+def _rounds(state, w, first, last):
+  # Runs SHA256 rounds first...last-1 on the working variables in state
+  a, b, c, d, e, f, g, h = state
+  for i in range(first, last):
+    if i == len(w): _schedule(w, i + 1)
+    t1 = h + ((e >> 6 | e << 26) ^ (e >> 11 | e << 21) ^ (e >> 25 | e << 7)) + (g ^ (e & (f ^ g))) + _k[i] + w[i]
+    t2 = ((a >> 2 | a << 30) ^ (a >> 13 | a << 19) ^ (a >> 22 | a << 10)) + ((a & b) | (c & (a | b)))
+    h = g
+    g = f
+    f = e
+    e = (d + t1) & 0xffffffff
+    d = c
+    c = b
+    b = a
+    a = (t1 + t2) & 0xffffffff
+  return [a, b, c, d, e, f, g, h]
+
+
+def scan(midstate, data, start, count):
+  # Hashes the nonces start...start+count-1 of a job and returns the ones that yield
+  # a hash with H == 0. midstate and data are the job's midstate and the first three
+  # words of the second block of the header, as tuples of integers.
+  nonces = numpy.arange(start, start + count, dtype = numpy.uint64).astype(numpy.uint32)
+  # The first three rounds and two schedule words don't depend on the nonce yet,
+  # so calculate them only once using plain integers.
+  w = list(data) + [0, 0x80000000, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 640]
+  state = _rounds(midstate, w, 0, 3)
+  _schedule(w, 18)
+  w[3] = nonces
+  state = [numpy.full(count, x, dtype = numpy.uint32) for x in state]
+  state = _rounds(state, w, 3, 64)
+  state = [x + y for x, y in zip(state, midstate)]
+  # The second hash. H of the final result only depends on the first 61 rounds:
+  # it's the value of e after round 60 plus the initial value of h.
+  w = state + [0x80000000, 0, 0, 0, 0, 0, 0, 256]
+  state = _rounds([numpy.full(count, x, dtype = numpy.uint32) for x in _iv], w, 0, 61)
+  found = numpy.nonzero(state[4] + _iv[7] == 0)[0]
+  return [int(nonces[index]) for index in found]
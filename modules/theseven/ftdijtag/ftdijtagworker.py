@@ -349,6 +349,13 @@ class FTDIJTAGFPGA(BaseWorker):
       # wake up the main thread so that it can request and upload a new job immediately.
       if self.job == job: self.wakeup.notify()
 
+      
+  # Batch version of notify_canceled, called once for all of our jobs that were canceled
+  # at the same time (e.g. after a new block was found). Only grab the lock once.
+  def notify_canceled_batch(self, jobs, graceful):
+    with self.wakeup:
+      if self.job in jobs: self.wakeup.notify()
+
         
   # Report custom statistics.
   def _get_statistics(self, stats, childstats):
@@ -0,0 +1,3 @@
+from .gbtworksource import GBTWorkSource
+
+worksourceclasses = [GBTWorkSource]
@@ -0,0 +1,386 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+###############################################
+# Bitcoin getblocktemplate work source module #
+###############################################
+
+
+
+import time
+import json
+import struct
+import base64
+import traceback
+from hashlib import sha256
+from binascii import hexlify, unhexlify
+from threading import Thread, Condition, Event
+from core.actualworksource import ActualWorkSource
+from core.job import Job
+from core.util import Bunch
+
+
+
+def dsha256(data):
+  return sha256(sha256(data).digest()).digest()
+
+
+def varint(value):
+  if value < 0xfd: return struct.pack("<B", value)
+  if value <= 0xffff: return b"\xfd" + struct.pack("<H", value)
+  if value <= 0xffffffff: return b"\xfe" + struct.pack("<I", value)
+  return b"\xff" + struct.pack("<Q", value)
+
+
+def swap32(data):
+  # Converts between the block header byte order and the word swapped one of the job data
+  return struct.pack("<%dI" % (len(data) // 4), *struct.unpack(">%dI" % (len(data) // 4), data))
+
+
+
+class MerkleCache(object):
+  # Computes the merkle branch of the coinbase transaction. The inner nodes of the previous
+  # tree are remembered, so that a template which only gained or lost a few transactions
+  # only rehashes the paths that actually changed.
+
+
+  def __init__(self):
+    self.nodes = {}
+    self.hashed = 0
+    self.reused = 0
+
+
+  def get_branch(self, hashes):
+    nodes = {}
+    branch = []
+    level = [None] + hashes
+    while len(level) > 1:
+      branch.append(level[1])
+      if len(level) % 2: level.append(level[-1])
+      next = [None]
+      for i in range(2, len(level), 2):
+        key = level[i] + level[i + 1]
+        hash = self.nodes.get(key)
+        if hash is None:
+          hash = dsha256(key)
+          self.hashed += 1
+        else: self.reused += 1
+        nodes[key] = hash
+        next.append(hash)
+      level = next
+    self.nodes = nodes
+    return branch
+
+
+
+class GBTWorkSource(ActualWorkSource):
+
+  version = "theseven.gbt work source v0.1.0beta"
+  default_name = "Untitled getblocktemplate work source"
+  settings = dict(ActualWorkSource.settings, **{
+    "gettemplatetimeout": {"title": "Getblocktemplate timeout", "type": "float", "position": 19000},
+    "sendsharetimeout": {"title": "Submitblock timeout", "type": "float", "position": 19100},
+    "longpolltimeout": {"title": "Long poll timeout", "type": "float", "position": 19200},
+    "host": {"title": "Host", "type": "string", "position": 1000},
+    "port": {"title": "Port", "type": "int", "position": 1010},
+    "path": {"title": "Path", "type": "string", "position": 1020},
+    "username": {"title": "User name", "type": "string", "position": 1100},
+    "password": {"title": "Password", "type": "password", "position": 1120},
+    "useragent": {"title": "User agent string", "type": "string", "position": 1200},
+    "payoutaddress": {"title": "Payout address", "type": "string", "position": 1250},
+    "coinbasetag": {"title": "Coinbase tag", "type": "string", "position": 1260},
+    "jobsperfetch": {"title": "Jobs generated per fetch", "type": "int", "position": 1300},
+    "longpoll": {"title": "Use long polling", "type": "boolean", "position": 1500},
+    "templateinterval": {"title": "Template refresh interval without long polling", "type": "float", "position": 1510},
+    "jobexpiry": {"title": "Job expiry", "type": "int", "position": 1600},
+  })
+  # SHA256 padding of an 80 byte block header, in the same word swapped byte order as the job data
+  padding = struct.pack("<12I", 0x80000000, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 640)
+
+
+  def __init__(self, core, state = None):
+    self.fetcherlock = Condition()
+    self.wakeup = Event()
+    super(GBTWorkSource, self).__init__(core, state)
+
+
+  def apply_settings(self):
+    super(GBTWorkSource, self).apply_settings()
+    if not "gettemplatetimeout" in self.settings or not self.settings.gettemplatetimeout:
+      self.settings.gettemplatetimeout = 10
+    if not "sendsharetimeout" in self.settings or not self.settings.sendsharetimeout:
+      self.settings.sendsharetimeout = 30
+    if not "longpolltimeout" in self.settings or not self.settings.longpolltimeout:
+      self.settings.longpolltimeout = 1800
+    if not "host" in self.settings: self.settings.host = ""
+    if self.started and self.settings.host != self.host: self.async_restart()
+    if not "port" in self.settings or not self.settings.port: self.settings.port = 8332
+    if self.started and self.settings.port != self.port: self.async_restart()
+    if not "path" in self.settings or not self.settings.path: self.settings.path = "/"
+    if not "username" in self.settings: self.settings.username = ""
+    if not "password" in self.settings: self.settings.password = ""
+    if not self.settings.username and not self.settings.password: self.auth = None
+    else:
+      credentials = self.settings.username + ":" + self.settings.password
+      self.auth = "Basic " + base64.b64encode(credentials.encode("utf_8")).decode("ascii")
+    if not "useragent" in self.settings: self.settings.useragent = ""
+    if self.settings.useragent: self.useragent = self.settings.useragent
+    else: self.useragent = "%s (%s)" % (self.core.__class__.version, self.__class__.version)
+    if not "payoutaddress" in self.settings: self.settings.payoutaddress = ""
+    if self.started and self.settings.payoutaddress != self.payoutaddress: self.async_restart()
+    if not "coinbasetag" in self.settings: self.settings.coinbasetag = "/MPBM/"
+    if not "jobsperfetch" in self.settings or not self.settings.jobsperfetch: self.settings.jobsperfetch = 16
+    if not "longpoll" in self.settings: self.settings.longpoll = True
+    if not "templateinterval" in self.settings or not self.settings.templateinterval:
+      self.settings.templateinterval = 30
+    if not "jobexpiry" in self.settings or not self.settings.jobexpiry: self.settings.jobexpiry = 60
+
+
+  def _reset(self):
+    super(GBTWorkSource, self)._reset()
+    self.fetchersrunning = 0
+    self.fetcherspending = 0
+    self.templatethread = None
+    self.minterthread = None
+    self.template = None
+    self.extranonce = 0
+    self.merklecache = MerkleCache()
+    self.stats.templates = 0
+    self.stats.jobsminted = 0
+
+
+  def _start(self):
+    super(GBTWorkSource, self)._start()
+    self.host = self.settings.host
+    self.port = self.settings.port
+    self.payoutaddress = self.settings.payoutaddress
+    if not self.settings.host or not self.settings.port: return
+    try: self.payoutscript = GBTWorkSource.address_to_script(self.payoutaddress)
+    except Exception as e:
+      self.core.log(self, "Invalid payout address %s: %s\n" % (self.payoutaddress, str(e)), 100, "rB")
+      return
+    self.shutdown = False
+    self.wakeup.clear()
+    self.templatethread = Thread(None, self.templateloop, "%s_template" % self.settings.name)
+    self.templatethread.daemon = True
+    self.templatethread.start()
+    self.minterthread = Thread(None, self.minter, "%s_minter" % self.settings.name)
+    self.minterthread.daemon = True
+    self.minterthread.start()
+
+
+  def _stop(self):
+    self.shutdown = True
+    self.wakeup.set()
+    with self.fetcherlock: self.fetcherlock.notify_all()
+    if self.templatethread: self.templatethread.join(1)
+    if self.minterthread: self.minterthread.join(1)
+    super(GBTWorkSource, self)._stop()
+
+
+  def _get_statistics(self, stats, childstats):
+    super(GBTWorkSource, self)._get_statistics(stats, childstats)
+    template = self.template
+    stats.height = template.height if template else None
+    stats.transactions = len(template.transactions) if template else None
+    stats.merklenodeshashed = self.merklecache.hashed
+    stats.merklenodesreused = self.merklecache.reused
+    with self.stats.lock:
+      stats.templates = self.stats.templates
+      stats.jobsminted = self.stats.jobsminted
+
+
+  @staticmethod
+  def address_to_script(address):
+    # Only base58 (P2PKH and P2SH) addresses are supported
+    alphabet = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+    value = 0
+    for char in address:
+      if not char in alphabet: raise ValueError("Invalid character in address")
+      value = value * 58 + alphabet.index(char)
+    data = unhexlify(("%050x" % value).encode("ascii"))
+    if len(data) != 25 or dsha256(data[:21])[:4] != data[21:]: raise ValueError("Bad address checksum")
+    version = struct.unpack("B", data[:1])[0]
+    if version in (0, 111): return b"\x76\xa9\x14" + data[1:21] + b"\x88\xac"
+    if version in (5, 196): return b"\xa9\x14" + data[1:21] + b"\x87"
+    raise ValueError("Unknown address version %d" % version)
+
+
+  def _get_running_fetcher_count(self):
+    return self.fetchersrunning
+
+
+  def _start_fetcher(self):
+    # Jobs are generated locally, so there is nothing to do until the node has sent a template
+    if not self.template: return False
+    with self.fetcherlock:
+      if self.fetchersrunning >= 8: return 0
+      self.fetchersrunning += 1
+      self.fetcherspending += 1
+      self.fetcherlock.notify()
+    return 1
+
+
+  def _rpc(self, method, params, timeout):
+    req = json.dumps({"method": method, "params": params, "id": 0}).encode("utf_8")
+    headers = {"User-Agent": self.useragent, "Content-Type": "application/json", "Content-Length": len(req),
+               "Connection": "Keep-Alive"}
+    if self.auth != None: headers["Authorization"] = self.auth
+    response, data = self.core.httppool.request(self.settings.host, self.settings.port, self.auth, "POST", self.settings.path,
+                                                req, headers, self.settings.gettemplatetimeout, timeout)
+    reply = json.loads(data.decode("utf_8"))
+    if reply.get("error"): raise Exception("%s failed: %s" % (method, reply["error"]))
+    return reply["result"]
+
+
+  def templateloop(self):
+    longpollid = None
+    tries = 0
+    while not self.shutdown:
+      try:
+        request = {"capabilities": ["coinbasetxn", "workid", "coinbase/append", "longpoll"], "rules": ["segwit"]}
+        timeout = self.settings.gettemplatetimeout
+        if longpollid and self.settings.longpoll:
+          request["longpollid"] = longpollid
+          timeout = self.settings.longpolltimeout
+        result = self._rpc("getblocktemplate", [request], timeout)
+        if self.shutdown: return
+        self._set_template(result)
+        self._handle_success()
+        tries = 0
+        longpollid = result.get("longpollid")
+        if not longpollid or not self.settings.longpoll: self.wakeup.wait(self.settings.templateinterval)
+      except:
+        self.core.log(self, "Error while fetching block template: %s\n" % (traceback.format_exc()), 200, "y")
+        self._handle_error()
+        longpollid = None
+        tries += 1
+        self.wakeup.wait(min(30, tries))
+
+
+  def _set_template(self, result):
+    transactions = result.get("transactions", [])
+    hashes = [unhexlify((tx.get("txid") or tx["hash"]).encode("ascii"))[::-1] for tx in transactions]
+    branch = self.merklecache.get_branch(hashes)
+    coinbase1, coinbase2, witness = self._build_coinbase(result)
+    prevhash = swap32(unhexlify(result["previousblockhash"].encode("ascii"))[::-1])
+    template = Bunch(height = result["height"], prevhash = prevhash, merklebranch = branch, coinbase1 = coinbase1,
+                     coinbase2 = coinbase2, witness = witness, workid = result.get("workid"),
+                     transactions = [unhexlify(tx["data"].encode("ascii")) for tx in transactions],
+                     target = unhexlify(result["target"].encode("ascii"))[::-1],
+                     prefix = struct.pack(">I", result["version"]) + prevhash,
+                     suffix = struct.pack(">I", result["curtime"]) + unhexlify(result["bits"].encode("ascii")) + b"\0\0\0\0" + self.padding)
+    with self.statelock:
+      old = self.template
+      self.template = template
+      self.signals_new_block = bool(result.get("longpollid")) and self.settings.longpoll
+    with self.stats.lock: self.stats.templates += 1
+    self.core.log(self, "Got block template for height %d with %d transactions\n" % (template.height, len(transactions)), 500)
+    # Jobs for the previous block are worthless now, the ones for an older template of the same block are still fine
+    if old and old.prevhash != template.prevhash: self._cancel_jobs()
+    self.core.fetcher.wakeup()
+
+
+  def _build_coinbase(self, result):
+    # The coinbase transaction is split around the 8 byte extranonce, like stratum does it
+    # BIP34 wants the height like a script number would be pushed, which is a single opcode up to 16
+    height = result["height"]
+    if height <= 16: heightpush = struct.pack("B", 0x50 + height if height else 0)
+    else:
+      heightdata = b""
+      while height:
+        heightdata += struct.pack("B", height & 0xff)
+        height >>= 8
+      if struct.unpack("B", heightdata[-1:])[0] & 0x80: heightdata += b"\0"
+      heightpush = struct.pack("B", len(heightdata)) + heightdata
+    tag = self.settings.coinbasetag.encode("utf_8")[:64]
+    scriptsig = heightpush + b"\x08" + b"\0" * 8 + struct.pack("B", len(tag)) + tag
+    outputs = [struct.pack("<Q", result["coinbasevalue"]) + varint(len(self.payoutscript)) + self.payoutscript]
+    witness = "default_witness_commitment" in result
+    if witness:
+      commitment = unhexlify(result["default_witness_commitment"].encode("ascii"))
+      outputs.append(struct.pack("<Q", 0) + varint(len(commitment)) + commitment)
+    coinbase1 = struct.pack("<I", 1) + b"\1" + b"\0" * 32 + b"\xff\xff\xff\xff" + varint(len(scriptsig)) \
+              + heightpush + b"\x08"
+    coinbase2 = struct.pack("B", len(tag)) + tag + b"\xff\xff\xff\xff" + varint(len(outputs)) + b"".join(outputs) + struct.pack("<I", 0)
+    return coinbase1, coinbase2, witness
+
+
+  def minter(self):
+    while not self.shutdown:
+      with self.fetcherlock:
+        while not self.fetcherspending:
+          self.fetcherlock.wait()
+          if self.shutdown: return
+        count = self.fetcherspending
+        self.fetcherspending = 0
+      batches = []
+      try:
+        now = time.time()
+        for i in range(count): batches.append(self._mint_jobs(self.settings.jobsperfetch, now))
+        latency = time.time() - now
+      except:
+        self.core.log(self, "Error while generating jobs: %s\n" % (traceback.format_exc()), 200, "y")
+        self._handle_error()
+      finally:
+        with self.fetcherlock: self.fetchersrunning -= count
+      # Each batch goes to the work queue in one add_jobs call
+      for jobs in batches: self._push_jobs(jobs, latency)
+
+
+  def _mint_jobs(self, count, now):
+    # Only the coinbase side of the merkle tree changes from job to job
+    with self.statelock:
+      template = self.template
+      if not template: raise Exception("No block template yet")
+      first = self.extranonce
+      self.extranonce += count
+    jobs = []
+    for extranonce in range(first, first + count):
+      extranonce = struct.pack("<Q", extranonce & 0xffffffffffffffff)
+      root = dsha256(template.coinbase1 + extranonce + template.coinbase2)
+      for branch in template.merklebranch: root = dsha256(root + branch)
+      data = template.prefix + swap32(root) + template.suffix
+      job = Job(self.core, self, now + self.settings.jobexpiry, data, template.target, None, template.height)
+      job.template = template
+      job.extranonce = extranonce
+      jobs.append(job)
+    with self.stats.lock: self.stats.jobsminted += count
+    return jobs
+
+
+  def _nonce_found(self, job, data, nonce, noncediff):
+    # Every share that meets the job's target is a block, submit all of it to the node
+    if not job: return "Stale (block template from an earlier session)"
+    template = job.template
+    coinbase = template.coinbase1 + job.extranonce + template.coinbase2
+    if template.witness:
+      # Segwit coinbase: marker, flag, and a witness reserved value of all zeros
+      coinbase = coinbase[:4] + b"\0\1" + coinbase[4:-4] + b"\1\x20" + b"\0" * 32 + coinbase[-4:]
+    block = swap32(data[:80]) + varint(1 + len(template.transactions)) + coinbase + b"".join(template.transactions)
+    params = [hexlify(block).decode("ascii")]
+    if template.workid is not None: params.append({"workid": template.workid})
+    result = self._rpc("submitblock", params, self.settings.sendsharetimeout)
+    if result is None:
+      self.core.log(self, "Submitted block at height %d\n" % template.height, 100, "gB")
+      return True
+    return str(result)
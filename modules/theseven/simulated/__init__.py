@@ -0,0 +1,3 @@
+from .simulatedworker import SimulatedWorker
+
+workerclasses = [SimulatedWorker]
@@ -0,0 +1,264 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+#####################################
+# Simulated worker interface module #
+#####################################
+
+
+
+# This worker doesn't calculate any hashes. It emits shares at the rate that
+# a real device with the configured hash rate would find them, which allows
+# benchmarking the rest of the miner with lots of workers on a single machine.
+# The shares are made up, they are handed out as synthetic shares that skip
+# hash verification (see Job.synthetic_nonce_found). They are not actually
+# valid, so only point it at a pool (emulator) that doesn't verify them.
+
+
+
+import time
+import random
+import struct
+import traceback
+from threading import Condition, Thread
+from core.baseworker import BaseWorker
+
+
+
+# Worker main class, referenced from __init__.py
+class SimulatedWorker(BaseWorker):
+  
+  version = "theseven.simulated worker v0.1.0beta"
+  default_name = "Untitled simulated worker"
+  settings = dict(BaseWorker.settings, **{
+    "hashrate": {"title": "Simulated hash rate (MH/s)", "type": "float", "position": 1000},
+    "paralleljobs": {"title": "Parallel jobs", "type": "int", "position": 1100},
+    "jobinterval": {"title": "Job interval", "type": "float", "position": 1200},
+    "seed": {"title": "Random seed", "type": "string", "position": 1300},
+  })
+  
+  
+  # Constructor, gets passed a reference to the miner core and the saved worker state, if present
+  def __init__(self, core, state = None):
+    # Let our superclass do some basic initialization and restore the state if neccessary
+    super(SimulatedWorker, self).__init__(core, state)
+
+    # Initialize wakeup flag for the main thread.
+    # This serves as a lock at the same time.
+    self.wakeup = Condition()
+
+    
+  # Validate settings, filling them with default values if neccessary.
+  # Called from the constructor and after every settings change.
+  def apply_settings(self):
+    # Let our superclass handle everything that isn't specific to this worker module
+    super(SimulatedWorker, self).apply_settings()
+    if not "hashrate" in self.settings or not self.settings.hashrate: self.settings.hashrate = 1000
+    if not "paralleljobs" in self.settings or not self.settings.paralleljobs: self.settings.paralleljobs = 1
+    if not "jobinterval" in self.settings or not self.settings.jobinterval: self.settings.jobinterval = 60
+    if not "seed" in self.settings: self.settings.seed = ""
+    # The number of job slots can't be changed on the fly, so trigger a restart if it changed.
+    # self.paralleljobs is a cached copy of self.settings.paralleljobs
+    if self.started and self.settings.paralleljobs != self.paralleljobs: self.async_restart()
+    # The hash rate can be changed on the fly, the main thread will pick it up
+    elif self.started:
+      with self.wakeup:
+        self._update_speed()
+        self.wakeup.notify()
+    
+
+  # Reset our state. Called both from the constructor and from self.start().
+  def _reset(self):
+    # Let our superclass handle everything that isn't specific to this worker module
+    super(SimulatedWorker, self)._reset()
+    # This needs to be set here in order to make the equality check in apply_settings() happy,
+    # when it is run before starting the module for the first time. (It is called from the constructor.)
+    self.paralleljobs = None
+    self.jobs = []
+    self.stats.sharesemitted = 0
+
+
+  # Start up the worker module. This is protected against multiple calls and concurrency by a wrapper.
+  def _start(self):
+    # Let our superclass handle everything that isn't specific to this worker module
+    super(SimulatedWorker, self)._start()
+    # Cache the number of job slots, as we don't like it to change on the fly
+    self.paralleljobs = self.settings.paralleljobs
+    # The oracle that generates the shares. Seeding it with the worker name by default
+    # makes every worker produce the same sequence of nonces in every run.
+    self.random = random.Random(self.settings.seed or self.settings.name)
+    # Reset the shutdown flag for our threads
+    self.shutdown = False
+    # Start up the main thread, which handles fetching work and emitting shares.
+    self.mainthread = Thread(None, self.main, self.settings.name + "_main")
+    self.mainthread.daemon = True
+    self.mainthread.start()
+  
+  
+  # Shut down the worker module. This is protected against multiple calls and concurrency by a wrapper.
+  def _stop(self):
+    # Let our superclass handle everything that isn't specific to this worker module
+    super(SimulatedWorker, self)._stop()
+    # Set the shutdown flag for our threads, making them terminate ASAP.
+    self.shutdown = True
+    # Trigger the main thread's wakeup flag, to make it actually look at the shutdown flag.
+    with self.wakeup: self.wakeup.notify()
+    # Wait for the main thread to terminate.
+    self.mainthread.join(10)
+
+      
+  # This function should interrupt processing of the specified job if possible.
+  # This is neccesary to avoid producing stale shares after a new block was found,
+  # or if a job expires for some other reason. If we don't know about the job, just ignore it.
+  # Never attempts to fetch a new job in here, always do that asynchronously!
+  # This needs to be very lightweight and fast.
+  def notify_canceled(self, job, graceful):
+    with self.wakeup:
+      if job in self.jobs: self.wakeup.notify()
+
+
+  def notify_canceled_batch(self, jobs, graceful):
+    with self.wakeup:
+      for job in jobs:
+        if job in self.jobs:
+          self.wakeup.notify()
+          break
+
+
+  # Report custom statistics.
+  def _get_statistics(self, stats, childstats):
+    # Let our superclass handle everything that isn't specific to this worker module
+    super(SimulatedWorker, self)._get_statistics(stats, childstats)
+    stats.sharesemitted = self.stats.sharesemitted
+
+
+  # Recalculates the job timing from the hash rate setting. Called with the wakeup lock held.
+  def _update_speed(self):
+    self.stats.mhps = self.settings.hashrate
+    # Hash rate that every job slot gets
+    self.slotrate = self.settings.hashrate * 1000000. / self.paralleljobs
+    # A job is done after the job interval, or when its keyspace is exhausted, whichever happens first
+    self.jobduration = min(self.settings.jobinterval, 2**32 / self.slotrate)
+    # Difficulty 1 shares per second across all slots
+    self.sharerate = self.settings.hashrate * 1000000. / 2**32
+    self.jobs_per_second = self.paralleljobs / self.jobduration
+    self.parallel_jobs = self.paralleljobs
+    self.core.event(350, self, "speed", self.stats.mhps * 1000, "%f MH/s" % self.stats.mhps, worker = self)
+    self.core.notify_speed_changed(self)
+        
+        
+  # Main thread entry point
+  # This thread is responsible for fetching work and emitting shares for it.
+  def main(self):
+    # There is no hardware that could fail, but keep the usual restart logic
+    # for robustness against work source problems.
+    tries = 0
+    while not self.shutdown:
+      try:
+        # Record our starting timestamp, in order to back off if we repeatedly die
+        starttime = time.time()
+        # We keep control of the wakeup lock at all times unless we're sleeping
+        with self.wakeup:
+          self.jobs = [None] * self.paralleljobs
+          self.endtimes = [0] * self.paralleljobs
+          self._update_speed()
+          nextshare = time.time() + self.random.expovariate(self.sharerate)
+
+          # Main loop, continues until something goes wrong or we're shutting down.
+          while not self.shutdown:
+            now = time.time()
+            # Retire jobs that were canceled or are done
+            for slot, job in enumerate(self.jobs):
+              if job and (job.canceled or now >= self.endtimes[slot]): self._jobend(slot, now)
+
+            # Refill empty slots. Fetching a job blocks until one is available,
+            # so we need to release the wakeup lock in order to avoid possible deadlocks.
+            for slot, job in enumerate(self.jobs):
+              if self.shutdown: break
+              if job: continue
+              self.wakeup.release()
+              try: job = self.core.get_job(self, self.jobduration + 2)
+              finally: self.wakeup.acquire()
+              # If a new block was found while we were fetching that job, just discard it.
+              # The slot stays empty and will be refilled in the next iteration.
+              if job.canceled:
+                job.destroy()
+                continue
+              job.starttime = time.time()
+              self.jobs[slot] = job
+              self.endtimes[slot] = job.starttime + self.jobduration
+              # No hashing happens while the device is starved for work
+              nextshare = max(nextshare, job.starttime)
+            self.job = self.jobs[0]
+
+            # Emit the shares that are due by now
+            now = time.time()
+            jobs = [job for job in self.jobs if job and not job.canceled]
+            while jobs and nextshare <= now:
+              self._share_found(self.random.choice(jobs))
+              nextshare += self.random.expovariate(self.sharerate)
+
+            # Sleep until the next share is due or a job ends, or until we get woken up.
+            # A shutdown request may have arrived while we were waiting for a job, don't miss it.
+            timeout = min([nextshare] + [endtime for job, endtime in zip(self.jobs, self.endtimes) if job]) - time.time()
+            if timeout > 0 and not self.shutdown: self.wakeup.wait(timeout)
+
+      # If something went wrong...
+      except Exception as e:
+        # ...complain about it!
+        self.core.log(self, "%s\n" % traceback.format_exc(), 100, "rB")
+      finally:
+        # We're not doing productive work any more, update stats and destroy current jobs
+        with self.wakeup:
+          now = time.time()
+          for slot, job in enumerate(self.jobs):
+            if job: self._jobend(slot, now)
+          self.job = None
+        self.stats.mhps = 0
+        # If we aren't shutting down, figure out if there have been many errors recently,
+        # and if yes, wait a bit longer until restarting the worker.
+        if not self.shutdown:
+          tries += 1
+          if time.time() - starttime >= 300: tries = 0
+          with self.wakeup:
+            if tries > 5: self.wakeup.wait(30)
+            else: self.wakeup.wait(1)
+        # Restart (handled by "while not self.shutdown:" loop above)
+
+
+  # Pretends that the job in a slot was processed until now and destroys it.
+  # Called with the wakeup lock held.
+  def _jobend(self, slot, now):
+    job = self.jobs[slot]
+    self.jobs[slot] = None
+    job.hashes_processed(min(job.hashes_remaining, (now - job.starttime) * self.slotrate))
+    job.destroy()
+
+
+  # Makes up a share for a job and hands it to the job as a synthetic one, which skips hash verification.
+  # Called with the wakeup lock held.
+  def _share_found(self, job):
+    nonce = struct.pack("<I", self.random.getrandbits(32))
+    # The difficulty of a share that is at least difficulty 1 follows P(D >= d) = 1 / d
+    noncediff = 1. / (1. - self.random.random())
+    with self.stats.lock: self.stats.sharesemitted += 1
+    job.synthetic_nonce_found(nonce, noncediff)
@@ -32,7 +32,6 @@ import numbers
 import sqlite3
 from threading import RLock, Condition, Thread
 from core.basefrontend import BaseFrontend
-from core.statistics import Statistics
 
 
 
@@ -139,8 +138,7 @@ class SQLiteStats(BaseFrontend):
         if self.settings.statinterval <= 0: self.statwakeup.wait()
         else:
           now = time.time()
-          stats = Statistics(obj = self.core, ghashes = self.core.stats.ghashes, starttime = self.core.stats.starttime)
-          stats.avgmhps =  1000. * stats.ghashes / (now - stats.starttime)
+          stats = self.core.get_core_statistics()
           stats.children = self.core.get_worker_statistics() \
                          + self.core.get_work_source_statistics() \
                          + self.core.get_blockchain_statistics()
@@ -0,0 +1,3 @@
+from .stratumworksource import StratumWorkSource
+
+worksourceclasses = [StratumWorkSource]
@@ -0,0 +1,352 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+##############################
+# Stratum work source module #
+##############################
+
+
+
+import time
+import json
+import socket
+import struct
+import traceback
+from hashlib import sha256
+from binascii import hexlify, unhexlify
+from threading import Thread, RLock, Condition, Event
+from core.actualworksource import ActualWorkSource
+from core.job import Job
+from core.util import Bunch
+
+
+
+class StratumWorkSource(ActualWorkSource):
+
+  version = "theseven.stratum work source v0.1.0beta"
+  default_name = "Untitled stratum work source"
+  settings = dict(ActualWorkSource.settings, **{
+    "connecttimeout": {"title": "Connect timeout", "type": "float", "position": 19000},
+    "sendsharetimeout": {"title": "Sendshare timeout", "type": "float", "position": 19100},
+    "host": {"title": "Host", "type": "string", "position": 1000},
+    "port": {"title": "Port", "type": "int", "position": 1010},
+    "username": {"title": "User name", "type": "string", "position": 1100},
+    "password": {"title": "Password", "type": "password", "position": 1120},
+    "useragent": {"title": "User agent string", "type": "string", "position": 1200},
+    "jobsperfetch": {"title": "Jobs generated per fetch", "type": "int", "position": 1300},
+    "jobexpiry": {"title": "Job expiry", "type": "int", "position": 1600},
+  })
+  # SHA256 padding of an 80 byte block header, in the same word swapped byte order as the job data
+  padding = struct.pack("<12I", 0x80000000, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 640)
+
+
+  def __init__(self, core, state = None):
+    self.fetcherlock = Condition()
+    self.requestlock = RLock()
+    self.sendlock = RLock()
+    self.sock = None
+    super(StratumWorkSource, self).__init__(core, state)
+
+
+  def apply_settings(self):
+    super(StratumWorkSource, self).apply_settings()
+    if not "connecttimeout" in self.settings or not self.settings.connecttimeout:
+      self.settings.connecttimeout = 10
+    if not "sendsharetimeout" in self.settings or not self.settings.sendsharetimeout:
+      self.settings.sendsharetimeout = 10
+    if not "host" in self.settings: self.settings.host = ""
+    if self.started and self.settings.host != self.host: self.async_restart()
+    if not "port" in self.settings or not self.settings.port: self.settings.port = 3333
+    if self.started and self.settings.port != self.port: self.async_restart()
+    if not "username" in self.settings: self.settings.username = ""
+    if self.started and self.settings.username != self.username: self.async_restart()
+    if not "password" in self.settings: self.settings.password = ""
+    if self.started and self.settings.password != self.password: self.async_restart()
+    if not "useragent" in self.settings: self.settings.useragent = ""
+    if self.settings.useragent: self.useragent = self.settings.useragent
+    else: self.useragent = "%s (%s)" % (self.core.__class__.version, self.__class__.version)
+    if not "jobsperfetch" in self.settings or not self.settings.jobsperfetch: self.settings.jobsperfetch = 16
+    if not "jobexpiry" in self.settings or not self.settings.jobexpiry: self.settings.jobexpiry = 60
+
+
+  def _reset(self):
+    super(StratumWorkSource, self)._reset()
+    self.fetchersrunning = 0
+    self.fetcherspending = 0
+    self.connectionthread = None
+    self.minterthread = None
+    # Every connection is a new session, work from an old session can't be submitted anymore
+    self.session = 0
+    self.extranonce1 = None
+    self.extranonce2size = None
+    self.target = None
+    self.template = None
+    self.nextid = 1
+    self.requests = {}
+    self.stats.jobsminted = 0
+    self.stats.notifications = 0
+
+
+  def _start(self):
+    super(StratumWorkSource, self)._start()
+    self.host = self.settings.host
+    self.port = self.settings.port
+    self.username = self.settings.username
+    self.password = self.settings.password
+    if not self.settings.host or not self.settings.port: return
+    self.shutdown = False
+    self.connectionthread = Thread(None, self.connectionloop, "%s_connection" % self.settings.name)
+    self.connectionthread.daemon = True
+    self.connectionthread.start()
+    self.minterthread = Thread(None, self.minter, "%s_minter" % self.settings.name)
+    self.minterthread.daemon = True
+    self.minterthread.start()
+
+
+  def _stop(self):
+    self.shutdown = True
+    self._disconnect()
+    with self.fetcherlock: self.fetcherlock.notify_all()
+    if self.connectionthread: self.connectionthread.join(1)
+    if self.minterthread: self.minterthread.join(1)
+    super(StratumWorkSource, self)._stop()
+
+
+  def _get_statistics(self, stats, childstats):
+    super(StratumWorkSource, self)._get_statistics(stats, childstats)
+    stats.connected = self.template is not None
+    with self.stats.lock:
+      stats.jobsminted = self.stats.jobsminted
+      stats.notifications = self.stats.notifications
+
+
+  def _get_running_fetcher_count(self):
+    return self.fetchersrunning
+
+
+  def _start_fetcher(self):
+    # Jobs are generated locally, so there is nothing to do until the pool has sent work
+    if not self.template: return False
+    with self.fetcherlock:
+      if self.fetchersrunning >= 8: return 0
+      self.fetchersrunning += 1
+      self.fetcherspending += 1
+      self.fetcherlock.notify()
+    return 1
+
+
+  def minter(self):
+    while not self.shutdown:
+      with self.fetcherlock:
+        while not self.fetcherspending:
+          self.fetcherlock.wait()
+          if self.shutdown: return
+        count = self.fetcherspending
+        self.fetcherspending = 0
+      batches = []
+      try:
+        now = time.time()
+        for i in range(count): batches.append(self._mint_jobs(self.settings.jobsperfetch, now))
+        latency = time.time() - now
+      except:
+        self.core.log(self, "Error while generating jobs: %s\n" % (traceback.format_exc()), 200, "y")
+        self._handle_error()
+      finally:
+        with self.fetcherlock: self.fetchersrunning -= count
+      for jobs in batches: self._push_jobs(jobs, latency)
+
+
+  def _mint_jobs(self, count, now):
+    # Every job gets its own extranonce2, and thus its own coinbase transaction and merkle root
+    with self.statelock:
+      template = self.template
+      if not template: raise Exception("No work from the pool yet")
+      first = template.extranonce2
+      template.extranonce2 += count
+      target = self.target
+    jobs = [self._build_job(template, extranonce2, target, now) for extranonce2 in range(first, first + count)]
+    with self.stats.lock: self.stats.jobsminted += count
+    return jobs
+
+
+  def _build_job(self, template, extranonce2, target, now):
+    extranonce2 = unhexlify(("%0*x" % (2 * template.extranonce2size, extranonce2 % template.extranonce2limit)).encode("ascii"))
+    coinbase = template.coinbase1 + template.extranonce1 + extranonce2 + template.coinbase2
+    root = sha256(sha256(coinbase).digest()).digest()
+    for branch in template.merklebranch: root = sha256(sha256(root + branch).digest()).digest()
+    data = template.prefix + struct.pack("<8I", *struct.unpack(">8I", root)) + template.suffix
+    job = Job(self.core, self, now + self.settings.jobexpiry, data, target, None, template.jobid)
+    job.session = template.session
+    job.extranonce2 = hexlify(extranonce2).decode("ascii")
+    return job
+
+
+  def _nonce_found(self, job, data, nonce, noncediff):
+    if not job or job.session != self.session: return "Stale (work from an earlier stratum session)"
+    params = [self.username, job.identifier, job.extranonce2, hexlify(data[68:72]).decode("ascii"), hexlify(nonce).decode("ascii")]
+    result, error = self._call("mining.submit", params, self.settings.sendsharetimeout)
+    if result == True: return True
+    if isinstance(error, list) and len(error) > 1: return str(error[1])
+    if error: return str(error)
+    return False
+
+
+  def _call(self, method, params, timeout):
+    # Sends a request and waits for the matching response
+    response = Bunch(event = Event(), result = None, error = None)
+    def callback(result, error):
+      response.result = result
+      response.error = error
+      response.event.set()
+    id = self._request(method, params, callback)
+    response.event.wait(timeout)
+    if not response.event.is_set():
+      with self.requestlock: self.requests.pop(id, None)
+      raise Exception("Timeout while waiting for %s response" % method)
+    if response.error == "Connection lost": raise Exception("Connection lost while waiting for %s response" % method)
+    return response.result, response.error
+
+
+  def _request(self, method, params, callback = None):
+    with self.requestlock:
+      id = self.nextid
+      self.nextid += 1
+      if callback: self.requests[id] = callback
+    try: self._send({"id": id, "method": method, "params": params})
+    except:
+      with self.requestlock: self.requests.pop(id, None)
+      raise
+    return id
+
+
+  def _send(self, message):
+    data = (json.dumps(message) + "\n").encode("utf_8")
+    with self.sendlock:
+      if not self.sock: raise Exception("Not connected")
+      self.sock.sendall(data)
+
+
+  def _disconnect(self):
+    with self.sendlock:
+      sock = self.sock
+      self.sock = None
+    if sock:
+      try: sock.shutdown(socket.SHUT_RDWR)
+      except: pass
+      sock.close()
+
+
+  def connectionloop(self):
+    tries = 0
+    while not self.shutdown:
+      try:
+        sock = socket.create_connection((self.host, self.port), self.settings.connecttimeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(None)
+        with self.sendlock: self.sock = sock
+        with self.statelock: self.session += 1
+        self._request("mining.subscribe", [self.useragent], self._subscribed)
+        self._request("mining.authorize", [self.username, self.password], self._authorized)
+        buffer = b""
+        while not self.shutdown:
+          data = sock.recv(65536)
+          if not data: raise Exception("Connection closed by the pool")
+          buffer += data
+          lines = buffer.split(b"\n")
+          buffer = lines.pop()
+          for line in lines:
+            if line.strip(): self._handle_message(json.loads(line.decode("utf_8")))
+          tries = 0
+      except:
+        if self.shutdown: break
+        self.core.log(self, "Stratum connection failed: %s\n" % (traceback.format_exc()), 200, "y")
+        self._handle_error()
+        tries += 1
+      finally:
+        self._connection_lost()
+      if not self.shutdown: time.sleep(min(30, tries))
+
+
+  def _connection_lost(self):
+    self._disconnect()
+    with self.statelock:
+      self.template = None
+      self.signals_new_block = False
+    with self.requestlock:
+      callbacks = list(self.requests.values())
+      self.requests = {}
+    for callback in callbacks: callback(None, "Connection lost")
+    self._cancel_jobs()
+
+
+  def _handle_message(self, message):
+    method = message.get("method")
+    if method == "mining.notify": self._notify(*message["params"][:9])
+    elif method == "mining.set_difficulty": self._set_difficulty(message["params"][0])
+    elif method: self.core.log(self, "Ignoring unknown stratum notification %s\n" % method, 500)
+    else:
+      with self.requestlock: callback = self.requests.pop(message.get("id"), None)
+      if callback: callback(message.get("result"), message.get("error"))
+
+
+  def _subscribed(self, result, error):
+    if error or not result:
+      self.core.log(self, "Stratum subscription failed: %s\n" % str(error), 200, "y")
+      return self._disconnect()
+    with self.statelock:
+      self.extranonce1 = unhexlify(result[1].encode("ascii"))
+      self.extranonce2size = int(result[2])
+
+
+  def _authorized(self, result, error):
+    if result != True:
+      self.core.log(self, "Stratum authorization failed: %s\n" % str(error), 200, "y")
+      return self._disconnect()
+    self.core.log(self, "Authorized as %s\n" % self.username, 500, "g")
+
+
+  def _set_difficulty(self, difficulty):
+    # Applies to all jobs generated from now on
+    target = int(0xffff * 2**208 / float(difficulty))
+    with self.statelock:
+      self.target = struct.pack("<4Q", target & 0xffffffffffffffff, (target >> 64) & 0xffffffffffffffff,
+                                (target >> 128) & 0xffffffffffffffff, target >> 192)
+
+
+  def _notify(self, jobid, prevhash, coinbase1, coinbase2, merklebranch, version, nbits, ntime, clean):
+    with self.stats.lock: self.stats.notifications += 1
+    with self.statelock:
+      if self.extranonce1 is None: raise Exception("Got work before the subscription was confirmed")
+      if not self.target: self._set_difficulty(1)
+      # Stratum sends the fields in the same (word swapped) byte order that the job data uses
+      self.template = Bunch(jobid = jobid, session = self.session, extranonce1 = self.extranonce1,
+                            extranonce2size = self.extranonce2size, extranonce2limit = 2**(8 * self.extranonce2size),
+                            extranonce2 = 0, coinbase1 = unhexlify(coinbase1.encode("ascii")),
+                            coinbase2 = unhexlify(coinbase2.encode("ascii")),
+                            merklebranch = [unhexlify(branch.encode("ascii")) for branch in merklebranch],
+                            prefix = unhexlify(version.encode("ascii")) + unhexlify(prevhash.encode("ascii")),
+                            suffix = unhexlify(ntime.encode("ascii")) + unhexlify(nbits.encode("ascii")) + b"\0\0\0\0" + self.padding)
+      self.signals_new_block = True
+    self.core.log(self, "Got stratum job %s%s\n" % (jobid, " (clean)" if clean else ""), 500)
+    # Jobs of superseded templates are canceled here, new blocks are detected by Blockchain.check_job
+    if clean: self._cancel_jobs()
+    self.core.fetcher.wakeup()
@@ -27,13 +27,12 @@ from ..decorators import jsonapi
 
 @jsonapi
 def getworkerstats(core, webui, httprequest, path, request, privileges):
-  now = time.time()
-  ghashes = core.stats.ghashes
+  stats = core.get_core_statistics()
   return {
-    "timestamp": now,
-    "starttime": core.stats.starttime,
-    "ghashes": ghashes,
-    "avgmhps": 1000. * ghashes / (now - core.stats.starttime),
+    "timestamp": time.time(),
+    "starttime": stats.starttime,
+    "ghashes": stats.ghashes,
+    "avgmhps": stats.avgmhps,
     "workers": core.get_worker_statistics(),
   }
 
@@ -56,14 +55,15 @@ def getblockchainstats(core, webui, httprequest, path, request, privileges):
 
 @jsonapi
 def getallstats(core, webui, httprequest, path, request, privileges):
-  now = time.time()
-  ghashes = core.stats.ghashes
+  stats = core.get_core_statistics()
   return {
-    "timestamp": now,
-    "starttime": core.stats.starttime,
-    "ghashes": ghashes,
-    "avgmhps": 1000. * ghashes / (now - core.stats.starttime),
+    "timestamp": time.time(),
+    "starttime": stats.starttime,
+    "ghashes": stats.ghashes,
+    "avgmhps": stats.avgmhps,
     "workers": core.get_worker_statistics(),
     "worksources": core.get_work_source_statistics(),
     "blockchains": core.get_blockchain_statistics(),
+    "fetcher": core.get_fetcher_statistics(),
+    "httppool": core.get_httppool_statistics(),
   }
@@ -168,14 +168,18 @@ class ZtexBoardProxy(Process):
         if now > self.checklockout and self.job:
           errorcount[self.multiplier] *= 0.995
           errorweight[self.multiplier] = errorweight[self.multiplier] * 0.995 + 1
-          for nonce in nonces:
-            invalid = True
-            for offset in (0, 1, -1, 2, -2):
-              hash = Job.calculate_hash(self.job[:76] + struct.pack("<I", nonce[1] + offset))
-              if struct.unpack("!I", hash[-4:])[0] == (nonce[2] + 0x5be0cd19) & 0xffffffff:
-                invalid = False
-                break
-            if invalid: errorcount[self.multiplier] += 1. / len(nonces)
+          # Almost all nonces match at offset 0, so that is checked for all of them in one batch first.
+          # Only the misses are hashed again, with all other candidate offsets in a second batch.
+          header = Job.prepare_header(self.job)
+          expected = [struct.pack("!I", (nonce[2] + 0x5be0cd19) & 0xffffffff) for nonce in nonces]
+          hashes = Job.hash_nonces(header, [struct.pack("<I", nonce[1]) for nonce in nonces])
+          misses = [i for i, hash in enumerate(hashes) if hash[-4:] != expected[i]]
+          offsets = (1, -1, 2, -2)
+          candidates = [struct.pack("<I", (nonces[i][1] + offset) & 0xffffffff) for i in misses for offset in offsets]
+          hashes = Job.hash_nonces(header, candidates)
+          for j, i in enumerate(misses):
+            if not expected[i] in [hash[-4:] for hash in hashes[j * len(offsets) : (j + 1) * len(offsets)]]:
+              errorcount[self.multiplier] += 1. / len(nonces)
           certainty = min(1, errorweight[self.multiplier] / 100)
           errorrate = errorcount[self.multiplier] / errorweight[self.multiplier]
           maxerrorrate[self.multiplier] = max(maxerrorrate[self.multiplier], errorrate * certainty)
@@ -291,6 +291,13 @@ class ZtexWorker(BaseWorker):
       # wake up the main thread so that it can request and upload a new job immediately.
       if self.job == job: self.workloopwakeup.notify()
 
+      
+  # Batch version of notify_canceled, called once for all of our jobs that were canceled
+  # at the same time (e.g. after a new block was found). Only grab the lock once.
+  def notify_canceled_batch(self, jobs, graceful):
+    with self.workloopwakeup:
+      if self.job in jobs: self.workloopwakeup.notify()
+
         
   # Main thread entry point
   # This thread is responsible for fetching work and pushing it to the device.
@@ -48,6 +48,8 @@ if __name__ == "__main__":
                     help = "Autodetect available workers and add them to the instance")
   parser.add_option("--add-example-work-sources", action = "store_true", default = False,
                     help = "Add the example work sources to the instance")
+  parser.add_option("--fetcher-controller", action = "store", type = "choice", choices = ["legacy", "predictive"],
+                    help = "Select the work fetcher controller (legacy or predictive) and store it in the instance")
   (options, args) = parser.parse_args()
   
   # Figure out instance name
@@ -58,6 +60,11 @@ if __name__ == "__main__":
   # Create core instance, will load saved instance state if present
   core = Core(instance = instancename, default_loglevel = options.default_loglevel)
   
+  # Switch the work fetcher controller if requested
+  if options.fetcher_controller:
+    core.fetcher.settings.controller = options.fetcher_controller
+    core.fetcher.apply_settings()
+    
   # Autodetect appropriate frontends if requested or if a new instance is being set up
   if options.detect_frontends or core.is_new_instance:
     core.detect_frontends()